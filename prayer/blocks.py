@@ -1,5 +1,5 @@
 import zlib
-from collections import MutableSequence
+from collections.abc import MutableSequence
 
 
 class Block:
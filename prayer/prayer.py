@@ -2,11 +2,9 @@ from prayer.blocks import Block
 
 
 class Pray:
-    # This list contains all the Blocks the given PRAY file contains.
-    blocks = list()
-
     def __init__(self, pray=None):
-        self.blocks.clear()
+        # This list contains all the Blocks the given PRAY file contains.
+        self.blocks = list()
         if pray is None:
             data = bytes("PRAY", encoding="latin-1")
         elif type(pray) == bytes:
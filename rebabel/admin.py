@@ -0,0 +1,122 @@
+"""
+The admin API: JSON commands over a local Unix socket, one request and one
+reply per line.
+
+    {"command": "sessions"}
+    {"ok": true, "result": [...]}
+
+    python -m rebabel.admin sessions
+    python -m rebabel.admin kick '{"user_ids": [123]}'
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class AdminError(Exception):
+    """A command failed, the message is sent back to the client."""
+
+
+class _AdminHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = self.server.admin.run(line)
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+
+class _AdminUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class AdminServer:
+    """
+    Serves commands, a dict of name -> callable(**arguments) returning
+    something JSON serializable, on the Unix socket at path. Only the owner
+    of the server process may connect.
+    """
+
+    def __init__(self, path, commands):
+        self.path = path
+        self.commands = commands
+        if os.path.exists(path):
+            os.remove(path)
+        # Created without access for others, rather than chmod'ed after it
+        # was bound, when they could have connected already.
+        umask = os.umask(0o177)
+        try:
+            self._server = _AdminUnixServer(path, _AdminHandler)
+        finally:
+            os.umask(umask)
+        self._server.admin = self
+
+    def start(self):
+        threading.Thread(
+            target=self._server.serve_forever, name="admin", daemon=True
+        ).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def run(self, line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise AdminError("a request is a JSON object")
+            arguments = dict(request)
+            name = arguments.pop("command", None)
+            command = self.commands.get(name)
+            if command is None:
+                raise AdminError(f"unknown command {name!r}")
+            return {"ok": True, "result": command(**arguments)}
+        except (AdminError, ValueError, TypeError) as exception:
+            return {"ok": False, "error": str(exception)}
+        except Exception as exception:
+            log.exception("admin command failed")
+            return {"ok": False, "error": str(exception)}
+
+
+def call(path, command, **arguments):
+    """Runs one command on the admin socket at path, returns its result."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        request = dict(arguments, command=command)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    reply = json.loads(reply)
+    if not reply["ok"]:
+        raise AdminError(reply["error"])
+    return reply["result"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command")
+    parser.add_argument("arguments", nargs="?", default="{}", help="a JSON object")
+    parser.add_argument("--socket", default="./rebabel-admin.sock")
+    options = parser.parse_args(argv)
+    try:
+        result = call(options.socket, options.command, **json.loads(options.arguments))
+    except AdminError as exception:
+        raise SystemExit(f"error: {exception}")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
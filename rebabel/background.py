@@ -0,0 +1,79 @@
+import logging
+import threading
+from collections import deque
+
+
+log = logging.getLogger(__name__)
+
+
+class BackgroundQueue:
+    """
+    Hands items to a pool of worker threads through a bounded queue. The
+    caller never waits: an item that doesn't fit is dropped and counted.
+    Each worker takes up to batch_size items at a time and passes them to
+    handle(batch), so slow work like disk writes is done in batches.
+    """
+
+    def __init__(self, handle, workers=2, max_items=256, batch_size=32, name=None):
+        self.handle = handle
+        self.max_items = max_items
+        self.batch_size = batch_size
+        self.handled = 0
+        self.dropped = 0
+        self.closed = False
+        self._queue = deque()
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._workers = [
+            threading.Thread(target=self._run, name=f"{name}-{n}", daemon=True)
+            for n in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, item):
+        """Queues item, returns False if it was dropped."""
+        with self._lock:
+            if self.closed or len(self._queue) >= self.max_items:
+                self.dropped += 1
+                return False
+            self._queue.append(item)
+            self._not_empty.notify()
+        return True
+
+    def join(self, timeout=None):
+        """Waits until everything queued was handled."""
+        with self._lock:
+            return self._idle.wait_for(
+                lambda: not self._queue and not self._busy, timeout=timeout
+            )
+
+    def close(self, timeout=None):
+        """Handles what is queued and stops the workers."""
+        self.join(timeout)
+        with self._lock:
+            self.closed = True
+            self._not_empty.notify_all()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._not_empty.wait_for(lambda: self._queue or self.closed)
+                if not self._queue:
+                    return
+                count = min(self.batch_size, len(self._queue))
+                batch = [self._queue.popleft() for _ in range(count)]
+                self._busy += 1
+            try:
+                self.handle(batch)
+            except Exception:
+                log.exception("background work failed")
+            with self._lock:
+                self._busy -= 1
+                self.handled += len(batch)
+                self._idle.notify_all()
+
+    def __len__(self):
+        return len(self._queue)
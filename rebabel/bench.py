@@ -0,0 +1,355 @@
+"""
+Microbenchmarks of the server's protocol handlers, run in this process over
+socket pairs, without any network.
+
+    python -m rebabel.bench --output before.json
+    python -m rebabel.bench --compare before.json
+
+Run it from the repository root, it imports server.py. Each reply function
+and each message type through ThreadedTCPRequestHandler is timed in ns per
+message, with the bytes it allocates at its peak (from tracemalloc), and
+PRAYs of increasing size are relayed between two sessions for throughput.
+Rate limits and PRAY recompression are switched off and senders wait for
+slow recipients, only the handlers are measured.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from rebabel.loadgen import login_package, pray_package
+from rebabel.netbabel import HEADER, Message, server_frame_length
+
+
+# The packets in netbabel_stuff.md and pray_message_information.md. In the
+# document's hex the login request has two stray bytes ("7300") after the
+# username, they are left out like in its dump.
+SAMPLE_LOGIN = bytes.fromhex(
+    "2500000000000000000000001b00000001000a0005000000000000000000000001000000"
+    "02000000000000000b0000000900000057697a6172644e6f726e00313233343536373800"
+)
+SAMPLE_LOGIN_USER = ("WizardNorn", "12345678")
+# A PRAY MESG from bob (234) to testuser (42).
+SAMPLE_PRAY = bytes.fromhex(
+    "0900000040524b28eb000000ea00000001000a000000000027010000000000002a000000"
+    "010000002701000001000000ea0000000f01000000000000010000000c00000000000000"
+    "00000000505241594d4553473233342b3132303139303631373039303730385f6d657373"
+    "616765000000000000000000000000000000000000000000000000000000000000000000"
+    "000000000000000000000000000000000000000000000000000000000000000000000000"
+    "00000000000000000000000000000000000000000000000000000000000000006f000000"
+    "8100000001000000789c636060606005624e2076492c4955084ecd2be103728c0c0c2d0d"
+    "cc0ccd0d2c0dcc0d2cd88122bea9c5c589e9a92c4066527e4a253f90062a4e492d52f0cb"
+    "4ccece4bcc4d65064b25f12264428b538b3c5d401618199b681b828c092e4dca4a4d2e01"
+    "1993919a98020061e11bb2"
+)
+SAMPLE_ECHO_LOAD = SAMPLE_PRAY[4:12]
+SENDER = ("bob", "bob")  # 234
+RECIPIENT = ("testuser", "notsecure")  # 42
+RECIPIENT_ID = 42
+
+# Requests are 32 byte headers, see netbabel_stuff.md: (name, type, user id).
+REQUESTS = (
+    ("ulin", 0x13, RECIPIENT_ID),
+    ("stat", 0x18, 0),
+    ("ruso", 0x0221, 0),
+    ("unik", 0x0F, RECIPIENT_ID),
+    ("status", 0x10, RECIPIENT_ID),
+)
+# Messages written at once to a session, and replies read back, per round.
+WINDOW = 32
+
+
+def request(message_type, user_id, package_count=1, body=b""):
+    return (
+        HEADER.pack(
+            message_type,
+            SAMPLE_ECHO_LOAD,
+            user_id,
+            1,
+            0x0A,
+            package_count,
+            len(body),
+            0,
+        )
+        + body
+    )
+
+
+def crea_hist():
+    body = bytes(4) + b"001-norn-abcde-fghij-klmno-pqrst" + bytes(28)
+    return request(0x0321, 0, body=body)
+
+
+def sized_pray(size):
+    """The sample PRAY with a FILE block that makes it size bytes longer."""
+    raw = bytes(SAMPLE_PRAY[76:])
+    data = os.urandom(max(0, size - 144))
+    block = (
+        b"FILE"
+        + b"bench".ljust(128, b"\0")
+        + len(data).to_bytes(4, "little") * 2
+        + bytes(4)
+        + data
+    )
+    return pray_package(SAMPLE_ECHO_LOAD, 234, RECIPIENT_ID, raw + block)
+
+
+class Session:
+    """A client connected to a ThreadedTCPRequestHandler by a socket pair."""
+
+    def __init__(self, server, name, buffer_size=1024 * 1024):
+        self.sock, handler_sock = socket.socketpair()
+        # Received into a buffer of its own, so the benchmarks' allocations
+        # are the handler's.
+        self.buffer = bytearray(buffer_size)
+        self.pending = bytearray()
+
+        def run():
+            try:
+                server.ThreadedTCPRequestHandler(handler_sock, (name, 0), None)
+            finally:
+                handler_sock.close()
+
+        self.thread = threading.Thread(target=run, name=f"bench-{name}")
+        self.thread.start()
+
+    def login(self, packet):
+        self.sock.sendall(packet)
+        return self.read(1)[0]
+
+    def read(self, count):
+        """Returns the next count messages from the server."""
+        messages = []
+        while len(messages) < count:
+            length = server_frame_length(self.pending)
+            if length is not None and len(self.pending) >= length:
+                messages.append(bytes(self.pending[:length]))
+                del self.pending[:length]
+                continue
+            received = self.sock.recv_into(self.buffer)
+            if not received:
+                raise ConnectionError("the handler closed the session")
+            self.pending += memoryview(self.buffer)[:received]
+        return messages
+
+    def close(self):
+        self.sock.close()
+        self.thread.join()
+
+
+def measure(run, iterations, operations=1):
+    """Times run(), which handles operations messages, and its allocations."""
+    run()
+    started = time.perf_counter_ns()
+    for _ in range(iterations):
+        run()
+    elapsed = time.perf_counter_ns() - started
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "ns_per_op": elapsed / (iterations * operations),
+        "peak_alloc_bytes": (peak - before) / operations,
+    }
+
+
+def setup_server(directory):
+    import server
+
+    server.TCP_KEEPALIVE = None  # Not for Unix sockets.
+    server.rate_limiter = server.RateLimiter({})
+    server.recompressor = None
+    # The relay benchmarks send as fast as they can, a sender has to wait for
+    # its recipient rather than get it disconnected.
+    server.OUTBOUND_OPTIONS = dict(server.OUTBOUND_OPTIONS, policy="block")
+    server.ADMIN_SOCKET = None
+    server.user_store = server.open_user_store(os.path.join(directory, "users.db"))
+    server.user_store.add_user(*SAMPLE_LOGIN_USER)
+    server.spool = server.Spool(os.path.join(directory, "spool"))
+    server.history = server.HistoryStore(os.path.join(directory, "history"))
+    return server
+
+
+def bench_functions(server, iterations, login_iterations):
+    login = Message(SAMPLE_LOGIN)
+    pray = Message(SAMPLE_PRAY)
+    requests = {name: Message(request(t, u)) for name, t, u in REQUESTS}
+    cases = {
+        "Message": (lambda: Message(SAMPLE_PRAY), iterations),
+        "net_line_reply_package": (
+            lambda: server.net_line_reply_package(login),
+            login_iterations,
+        ),
+        "net_ulin_reply_package": (
+            lambda: server.net_ulin_reply_package(requests["ulin"]),
+            iterations,
+        ),
+        "net_stat_reply_package": (
+            lambda: server.net_stat_reply_package(requests["stat"]),
+            iterations,
+        ),
+        "net_ruso_reply_package": (
+            lambda: server.net_ruso_reply_package(requests["ruso"]),
+            iterations,
+        ),
+        "net_unik_reply_package": (
+            lambda: server.net_unik_reply_package(requests["unik"]),
+            iterations,
+        ),
+        "user_status_package": (
+            lambda: server.user_status_package(RECIPIENT_ID),
+            iterations,
+        ),
+        "encode_user_status": (
+            lambda: server.encode_user_status(RECIPIENT_ID),
+            iterations,
+        ),
+        "pray_package": (
+            lambda: server.pray_package(234, pray.raw_pray),
+            iterations,
+        ),
+    }
+    return {name: measure(run, count) for name, (run, count) in cases.items()}
+
+
+def bench_handlers(server, session, iterations, login_iterations):
+    results = {}
+
+    def login():
+        client = Session(server, "bench-login", buffer_size=4096)
+        client.login(SAMPLE_LOGIN)
+        client.close()
+
+    results["line"] = measure(login, login_iterations)
+    messages = {name: request(t, u) for name, t, u in REQUESTS}
+    messages["crea_hist"] = crea_hist()
+    rounds = max(1, iterations // WINDOW)
+    for name, message in messages.items():
+        window = message * WINDOW
+
+        def run():
+            session.sock.sendall(window)
+            session.read(WINDOW)
+
+        results[name] = measure(run, rounds, WINDOW)
+    return results
+
+
+def bench_pray(server, sender, recipient, sizes, iterations):
+    results = {}
+    for size in sizes:
+        message = SAMPLE_PRAY if size is None else sized_pray(size)
+        # Enough messages for about 64 MiB, as long as that is in iterations.
+        count = max(2, min(iterations, 64 * 1024 * 1024 // len(message)))
+        messages = message * count
+
+        def run():
+            writer = threading.Thread(target=sender.sock.sendall, args=(messages,))
+            writer.start()
+            recipient.read(count)
+            writer.join()
+
+        result = measure(run, 1, count)
+        result["bytes"] = len(message)
+        result["mib_per_second"] = len(message) / result["ns_per_op"] * 1e9 / 2**20
+        results["sample" if size is None else str(size)] = result
+    return results
+
+
+def run_benchmarks(iterations, login_iterations, pray_sizes):
+    from rebabel.protolog import setup_logging
+
+    setup_logging(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        server = setup_server(directory)
+        sender = Session(server, "bench-sender")
+        recipient = Session(server, "bench-recipient")
+        try:
+            sender.login(login_package(*SENDER))
+            recipient.login(login_package(*RECIPIENT))
+            report = {
+                "python": platform.python_version(),
+                "iterations": iterations,
+                "functions": bench_functions(server, iterations, login_iterations),
+                "handlers": bench_handlers(
+                    server, sender, iterations, login_iterations
+                ),
+                "pray": bench_pray(
+                    server, sender, recipient, [None] + pray_sizes, iterations
+                ),
+            }
+        finally:
+            sender.close()
+            recipient.close()
+            server.history.close()
+            server.user_store.close()
+    return report
+
+
+def print_report(report, baseline=None):
+    for group in ("functions", "handlers", "pray"):
+        print(
+            f"{group:<24} {'ns/op':>12} {'alloc B/op':>12}"
+            + (f" {'MiB/s':>9}" if group == "pray" else "")
+            + (f" {'change':>8}" if baseline else "")
+        )
+        for name, row in report[group].items():
+            line = f"  {name:<22} {row['ns_per_op']:>12.0f}"
+            line += f" {row['peak_alloc_bytes']:>12.0f}"
+            if group == "pray":
+                line += f" {row['mib_per_second']:>9.1f}"
+            before = (baseline or {}).get(group, {}).get(name)
+            if before:
+                change = row["ns_per_op"] / before["ns_per_op"] - 1
+                line += f" {change:>+8.1%}"
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument(
+        "--login-iterations",
+        type=int,
+        default=20,
+        help="logins check a password hash, they are slow",
+    )
+    parser.add_argument(
+        "--pray-sizes",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=[4096, 65536, 1024 * 1024, 8 * 1024 * 1024],
+        help="comma separated PRAY sizes in bytes, besides the sample",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a JSON file of earlier results")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    options = parser.parse_args(argv)
+
+    report = run_benchmarks(
+        options.iterations, options.login_iterations, options.pray_sizes
+    )
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if options.json:
+        print(json.dumps(report, indent=2))
+        return
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Session captures: the traffic of every connection to the server, stored as
+timestamped, direction tagged records.
+
+A capture file starts with MAGIC, followed by records of
++------------------+---------------+--------------+------------+------------+
+| 8B Int time (ns) | 4B Session ID | 1B Direction | 4B Int len | len B Data |
++------------------+---------------+--------------+------------+------------+
+Client records hold what one recv() returned, server records what one write
+to the socket sent (or, recorded by the proxy in run.py, what one recv()
+from the upstream server returned). Use frames() to split either side into
+messages.
+"""
+import collections
+import itertools
+import logging
+import struct
+import threading
+import time
+
+from rebabel.netbabel import client_frame_length, server_frame_length
+
+
+MAGIC = b"RBCAP\x00\x01\x00"
+RECORD = struct.Struct("<QIBI")
+
+CLIENT = 0  # client -> server
+SERVER = 1  # server -> client
+
+Record = collections.namedtuple("Record", "timestamp session direction data")
+
+log = logging.getLogger(__name__)
+
+
+class CaptureWriter:
+    """Appends records to a capture file, safe to use from any thread."""
+
+    def __init__(self, path, buffer_size=1024 * 1024):
+        self.path = path
+        self._file = open(path, "wb", buffering=buffer_size)
+        self._file.write(MAGIC)
+        self._sessions = itertools.count(1)
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def session(self):
+        """Returns a new session id, one per connection."""
+        return next(self._sessions)
+
+    def write(self, session, direction, data):
+        header = RECORD.pack(time.time_ns(), session, direction, len(data))
+        with self._lock:
+            if self.closed:
+                return
+            self._file.write(header)
+            self._file.write(data)
+
+    def flush(self):
+        with self._lock:
+            if not self.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                self._file.close()
+
+
+class BackgroundCaptureWriter(CaptureWriter):
+    """
+    A CaptureWriter that only queues records, a thread of its own writes
+    out whatever is queued at once, so recording never waits for the disk
+    and a capture is on disk even if the process is killed. When more than
+    max_pending bytes are waiting, records are dropped and counted instead.
+    """
+
+    def __init__(self, path, buffer_size=1024 * 1024, max_pending=64 * 1024 * 1024):
+        super().__init__(path, buffer_size)
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = []
+        self._pending_bytes = 0
+        self._writing = False
+        self._ready = threading.Condition(self._lock)
+        self._writer = threading.Thread(
+            target=self._run, name="capture", daemon=True
+        )
+        self._writer.start()
+
+    def write(self, session, direction, data):
+        header = RECORD.pack(time.time_ns(), session, direction, len(data))
+        with self._lock:
+            if self.closed:
+                return
+            if self._pending_bytes + len(data) > self.max_pending:
+                self.dropped += 1
+                return
+            # data may be a view of a buffer that is about to be reused.
+            self._pending.append(header + data)
+            self._pending_bytes += len(data)
+            self._ready.notify_all()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._ready.wait_for(lambda: self._pending or self.closed)
+                records = self._pending
+                self._pending = []
+                self._pending_bytes = 0
+                if not records:
+                    self._file.close()
+                    return
+                self._writing = True
+            self._file.write(b"".join(records))
+            self._file.flush()
+            with self._lock:
+                self._writing = False
+                self._ready.notify_all()
+
+    def flush(self):
+        """Writes what is queued so far."""
+        with self._lock:
+            if self.closed:
+                return
+            self._ready.wait_for(lambda: not self._pending and not self._writing)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._ready.notify_all()
+        self._writer.join()
+        if self.dropped:
+            log.warning("%s: %s records were dropped", self.path, self.dropped)
+
+
+def read_capture(path):
+    """Yields the Records of a capture file in the order they were written."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, session, direction, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # The capture was cut off in the middle of a record.
+                return
+            yield Record(timestamp, session, direction, data)
+
+
+def frame_length(data, direction=SERVER):
+    """
+    Length of the message at the start of data, or None if data doesn't
+    hold enough of it to tell.
+    """
+    if direction == CLIENT:
+        return client_frame_length(data)
+    return server_frame_length(data)
+
+
+def frames(data, direction=SERVER):
+    """Splits a byte stream into messages, returns (messages, rest)."""
+    messages = []
+    view = memoryview(data)
+    offset = 0
+    while True:
+        length = frame_length(view[offset:], direction)
+        if length is None or len(data) - offset < length:
+            break
+        messages.append(bytes(view[offset : offset + length]))
+        offset += length
+    return messages, bytes(view[offset:])
@@ -0,0 +1,296 @@
+import logging
+import os
+import signal
+import socket
+import struct
+import threading
+import traceback
+
+
+log = logging.getLogger(__name__)
+
+# Messages on the bus between the workers and the hub in the parent process:
+# +----------------+---------+-------------+----------------+
+# | 4B Int len     | 1B Kind | 4B User ID  | (len - 5)B Data |
+# +----------------+---------+-------------+----------------+
+BUS_HEADER = struct.Struct("<IBI")
+
+ONLINE = 1  # worker -> hub: user logged in here, hub -> worker: user is online
+OFFLINE = 2  # worker -> hub: user logged out here, hub -> worker: user is offline
+RELAY = 3  # a message for a user, the hub routes it to their worker
+SPOOL = 4  # worker -> hub: store this message, the user isn't connected here
+# One message for many users, the data starts with their count and ids.
+FANOUT = 5
+
+
+def _send(sock, lock, kind, user_id, data=b"", length=None):
+    """With length given, data is an iterable of the message's parts."""
+    if length is None:
+        data, length = (data,), len(data)
+    with lock:
+        sock.sendall(BUS_HEADER.pack(BUS_HEADER.size - 4 + length, kind, user_id))
+        for part in data:
+            if part:
+                sock.sendall(part)
+
+
+def _pack_fanout(user_ids, data):
+    return struct.pack(f"<I{len(user_ids)}I", len(user_ids), *user_ids) + data
+
+
+def _unpack_fanout(data):
+    (count,) = struct.unpack_from("<I", data)
+    user_ids = struct.unpack_from(f"<{count}I", data, 4)
+    return user_ids, data[4 + 4 * count :]
+
+
+def _read_exactly(sock, length):
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+    return bytes(buffer)
+
+
+def _read_messages(sock):
+    while True:
+        header = _read_exactly(sock, BUS_HEADER.size)
+        if header is None:
+            return
+        length, kind, user_id = BUS_HEADER.unpack(header)
+        data = b""
+        if length > BUS_HEADER.size - 4:
+            data = _read_exactly(sock, length - (BUS_HEADER.size - 4))
+            if data is None:
+                return
+        yield kind, user_id, data
+
+
+class Hub:
+    """
+    Runs in the parent process. Knows which worker holds which user, routes
+    relayed messages to that worker, tells every worker about logins and
+    logouts and spools messages for users that are offline everywhere.
+    """
+
+    def __init__(self, path, spool):
+        self.path = path
+        self.spool = spool
+        self.locations = {}
+        self.workers = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+
+    def start(self):
+        threading.Thread(target=self._accept, name="hub", daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                worker, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._serve, args=(worker,), name="hub-worker", daemon=True
+            ).start()
+
+    def _serve(self, worker):
+        worker_lock = threading.Lock()
+        with self._lock:
+            self.workers[worker] = worker_lock
+            online = list(self.locations)
+        for user_id in online:
+            _send(worker, worker_lock, ONLINE, user_id)
+        try:
+            for kind, user_id, data in _read_messages(worker):
+                if kind == ONLINE:
+                    self._online(worker, user_id)
+                elif kind == OFFLINE:
+                    self._offline(worker, user_id)
+                elif kind == RELAY:
+                    self._relay(user_id, data)
+                elif kind == SPOOL:
+                    self._spool(user_id, data)
+                elif kind == FANOUT:
+                    self._fan_out(*_unpack_fanout(data))
+        except OSError as exception:
+            log.info("hub: worker connection failed, %s", exception)
+        with self._lock:
+            del self.workers[worker]
+            gone = [uid for uid, owner in self.locations.items() if owner is worker]
+        for user_id in gone:
+            self._offline(worker, user_id)
+        worker.close()
+
+    def _broadcast(self, kind, user_id, exclude=None):
+        with self._lock:
+            workers = list(self.workers.items())
+        for worker, worker_lock in workers:
+            if worker is not exclude:
+                try:
+                    _send(worker, worker_lock, kind, user_id)
+                except OSError:
+                    pass
+
+    def _online(self, worker, user_id):
+        with self._lock:
+            self.locations[user_id] = worker
+            worker_lock = self.workers[worker]
+        self._broadcast(ONLINE, user_id, exclude=worker)
+
+        def send(batch):
+            _send(worker, worker_lock, RELAY, user_id, batch)
+            return True
+
+        # Hand the user's backlog to the worker that now holds them.
+        self.spool.deliver(user_id, send)
+
+    def _offline(self, worker, user_id):
+        with self._lock:
+            if self.locations.get(user_id) is not worker:
+                return
+            del self.locations[user_id]
+        self._broadcast(OFFLINE, user_id, exclude=worker)
+
+    def _relay(self, user_id, data):
+        with self._lock:
+            worker = self.locations.get(user_id)
+            worker_lock = self.workers.get(worker)
+        if worker is None:
+            self._spool(user_id, data)
+            return
+        try:
+            _send(worker, worker_lock, RELAY, user_id, data)
+        except OSError:
+            self._spool(user_id, data)
+
+    def _fan_out(self, user_ids, data):
+        by_worker = {}
+        with self._lock:
+            for user_id in user_ids:
+                by_worker.setdefault(self.locations.get(user_id), []).append(user_id)
+            locks = {worker: self.workers.get(worker) for worker in by_worker}
+        for worker, recipients in by_worker.items():
+            if worker is not None:
+                message = _pack_fanout(recipients, data)
+                try:
+                    _send(worker, locks[worker], FANOUT, 0, message)
+                    continue
+                except OSError:
+                    pass
+            for user_id in recipients:
+                self._spool(user_id, data)
+
+    def _spool(self, user_id, data):
+        if not self.spool.append(user_id, data):
+            log.error("hub: spool for %s is full, message dropped", user_id)
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ClusterClient:
+    """
+    A worker's connection to the hub. remote_users holds the users that are
+    connected to other workers; messages the hub routes to this worker are
+    passed to `on_relay(user_id, data)` and `on_presence(user_id)` is called
+    after a remote user logged in or out.
+    """
+
+    def __init__(self, path, on_relay, on_presence=None):
+        self.on_relay = on_relay
+        self.on_presence = on_presence
+        self.remote_users = set()
+        self._lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        threading.Thread(target=self._read, name="cluster", daemon=True).start()
+
+    def _read(self):
+        for kind, user_id, data in _read_messages(self.sock):
+            if kind == RELAY:
+                self.on_relay(user_id, data)
+                continue
+            if kind == FANOUT:
+                user_ids, data = _unpack_fanout(data)
+                for user_id in user_ids:
+                    self.on_relay(user_id, data)
+                continue
+            if kind == ONLINE:
+                self.remote_users.add(user_id)
+            elif kind == OFFLINE:
+                self.remote_users.discard(user_id)
+            if self.on_presence is not None:
+                self.on_presence(user_id)
+        log.error("cluster: lost the connection to the hub")
+
+    def online(self, user_id):
+        _send(self.sock, self._lock, ONLINE, user_id)
+
+    def offline(self, user_id):
+        _send(self.sock, self._lock, OFFLINE, user_id)
+
+    def relay(self, user_id, data, length=None):
+        _send(self.sock, self._lock, RELAY, user_id, data, length)
+
+    def spool(self, user_id, data, length=None):
+        _send(self.sock, self._lock, SPOOL, user_id, data, length)
+
+    def fan_out(self, user_ids, data):
+        """Relays data to many users, sent over the bus once per worker."""
+        _send(self.sock, self._lock, FANOUT, 0, _pack_fanout(user_ids, data))
+
+
+def fork_workers(count, bus_path, spool, run_worker):
+    """
+    Starts `count` worker processes that each call run_worker(index) and
+    routes messages between them until they have all exited.
+    """
+    hub = Hub(bus_path, spool)
+    children = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            hub.sock.close()
+            status = 0
+            try:
+                run_worker(index)
+            except SystemExit:
+                pass
+            except BaseException:
+                # Logging may go through a queue the worker no longer drains.
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children.append(pid)
+    hub.start()
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in children:
+        while True:
+            try:
+                pid, status = os.wait()
+                break
+            except InterruptedError:
+                continue
+        log.info("worker %s exited with status %s", pid, status)
+    hub.close()
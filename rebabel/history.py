@@ -0,0 +1,151 @@
+import os
+import re
+import struct
+import threading
+import time
+
+from rebabel.background import BackgroundQueue
+
+
+# Every history package is stored as a record header followed by the message.
+# +-------------------+----------------+-----------------+---------------+
+# | 8B Double stored  | 4B Int User ID | 4B Int len(msg) | nB Message    |
+# +-------------------+----------------+-----------------+---------------+
+RECORD = struct.Struct("<dII")
+
+# The layout of CREA HIST isn't known, the monikers in it are found by their
+# shape, e.g. "001-moth-aiqbx-n7myw-jv3qs-9whgk".
+MONIKER = re.compile(rb"\d{3}-[a-z0-9]{4}(?:-[a-z0-9]{5}){4}")
+
+
+def monikers(data):
+    """The distinct creature monikers in a CREA HIST message, in order."""
+    return list(dict.fromkeys(m.decode("latin-1") for m in MONIKER.findall(data)))
+
+
+class HistoryStore:
+    """
+    An append-only log of CREA HIST packages in `directory`, indexed by
+    creature moniker and by the user who sent them. append() only queues a
+    package: a single writer thread writes everything queued at once and
+    syncs it with one fsync, so a burst costs one disk flush and the sender
+    never waits for it. Packages are visible to queries once they are
+    written. Only the index is kept in memory, it is rebuilt from the log
+    on start.
+    """
+
+    def __init__(self, directory, max_pending=4096, batch_size=512, fsync=True):
+        self.directory = directory
+        self.fsync = fsync
+        self.path = os.path.join(directory, "history.log")
+        # moniker -> [(offset, length, stored_at, user_id)] and the same by
+        # user id; packages without a moniker are only in by_user.
+        self.by_moniker = {}
+        self.by_user = {}
+        # user id -> the monikers in their packages, as dict keys for order
+        self.user_monikers = {}
+        self.records = 0
+        self.commits = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = self._load()
+        self._file = open(self.path, "ab")
+        self._writer = BackgroundQueue(
+            self._commit,
+            workers=1,
+            max_items=max_pending,
+            batch_size=batch_size,
+            name="history",
+        )
+
+    @property
+    def dropped(self):
+        return self._writer.dropped
+
+    def _index(self, record, data):
+        self.records += 1
+        self.by_user.setdefault(record[3], []).append(record)
+        for moniker in monikers(data):
+            self.by_moniker.setdefault(moniker, []).append(record)
+            self.user_monikers.setdefault(record[3], {})[moniker] = None
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return 0
+        offset = 0
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                stored_at, user_id, length = RECORD.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                record = (offset + RECORD.size, length, stored_at, user_id)
+                self._index(record, data)
+                offset += RECORD.size + length
+        if offset != os.path.getsize(self.path):
+            # Drop a record that was only partially written.
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+        return offset
+
+    def append(self, user_id, data):
+        """Queues a package, returns False if too many are waiting already."""
+        return self._writer.submit((time.time(), user_id, bytes(data)))
+
+    def _commit(self, batch):
+        parts = []
+        records = []
+        offset = self._size
+        for stored_at, user_id, data in batch:
+            parts.append(RECORD.pack(stored_at, user_id, len(data)))
+            parts.append(data)
+            record = (offset + RECORD.size, len(data), stored_at, user_id)
+            records.append((record, data))
+            offset += RECORD.size + len(data)
+        self._file.write(b"".join(parts))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._size = offset
+        with self._lock:
+            self.commits += 1
+            for record, data in records:
+                self._index(record, data)
+
+    def _read(self, records, limit):
+        if limit is not None:
+            records = records[-limit:]
+        result = []
+        with open(self.path, "rb") as f:
+            for offset, length, stored_at, user_id in records:
+                f.seek(offset)
+                result.append((stored_at, user_id, f.read(length)))
+        return result
+
+    def creature(self, moniker, limit=None):
+        """[(stored_at, user_id, message)] of a creature, oldest first."""
+        with self._lock:
+            records = list(self.by_moniker.get(moniker, ()))
+        return self._read(records, limit)
+
+    def user(self, user_id, limit=None):
+        """[(stored_at, user_id, message)] a user sent, oldest first."""
+        with self._lock:
+            records = list(self.by_user.get(user_id, ()))
+        return self._read(records, limit)
+
+    def creatures(self, user_id):
+        """The monikers in the packages a user sent."""
+        with self._lock:
+            return list(self.user_monikers.get(user_id, ()))
+
+    def flush(self, timeout=None):
+        """Waits until everything queued is written."""
+        return self._writer.join(timeout)
+
+    def close(self, timeout=None):
+        self._writer.close(timeout)
+        self._file.close()
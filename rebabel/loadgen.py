@@ -0,0 +1,351 @@
+"""
+Opens a number of simulated Docking Station clients against a server and
+reports latency per message type, throughput and the server's memory use.
+
+    python -m rebabel.loadgen --clients 200 --duration 60 --server-pid 1234
+
+The clients log in as <prefix><n> with a shared password, use
+--create-users to add those accounts to a local server's user database.
+"""
+import argparse
+import collections
+import json
+import random
+import socket
+import struct
+import threading
+import time
+
+from rebabel.netbabel import HEADER, server_frame_length
+
+
+MESSAGE_TYPES = {
+    "ulin": 0x13,
+    "stat": 0x18,
+    "ruso": 0x0221,
+    "unik": 0x0F,
+    "status": 0x10,
+    "pray": 0x09,
+}
+# Replies to user status requests come back as "online" or "offline".
+REPLY_TYPES = {0x10: (0x0D, 0x0E)}
+# The server also sends those whenever a user a client asked the status of
+# logs in or out.
+PRESENCE_TYPES = (0x0D, 0x0E)
+
+DEFAULT_MIX = "ulin=30,status=30,stat=10,ruso=10,unik=10,pray=10"
+REPLY_TIMEOUT = 10
+
+
+def login_package(username, password, package_count=1):
+    username = username.encode("latin-1") + b"\0"
+    password = password.encode("latin-1") + b"\0"
+    return (
+        HEADER.pack(0x25, bytes(8), 0, 1, 0x0A, package_count, 0, 0)
+        + struct.pack("<IIIII", 1, 2, 0, len(username), len(password))
+        + username
+        + password
+    )
+
+
+def request_package(message_type, echo_load, user_id, package_count):
+    return HEADER.pack(message_type, echo_load, user_id, 1, 0, package_count, 0, 0)
+
+
+def pray_package(echo_load, sender_id, recipient_id, raw_pray):
+    # The same layout as the PRAY messages in pray_message_information.md.
+    body = (
+        struct.pack(
+            "<IIIIIIIII",
+            recipient_id,
+            1,
+            len(raw_pray) + 36,
+            1,
+            sender_id,
+            len(raw_pray) + 12,
+            0,
+            1,
+            0x0C,
+        )
+        + bytes(8)
+        + raw_pray
+    )
+    return HEADER.pack(9, echo_load, sender_id, 1, 0x0A, 0, len(body) - 8, 0) + body
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def server_rss(pid):
+    """Resident set size of pid in bytes, read from /proc."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Results:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.sent = collections.Counter()
+        self.presence_pushes = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, latency):
+        with self._lock:
+            self.latencies[name].append(latency)
+
+    def error(self, name):
+        with self._lock:
+            self.errors[name] += 1
+
+    def presence_push(self):
+        with self._lock:
+            self.presence_pushes += 1
+
+
+class SimulatedClient:
+    """One logged in client, a sender thread and a reader thread."""
+
+    def __init__(self, options, results, username, online):
+        self.options = options
+        self.results = results
+        self.username = username
+        self.online = online
+        self.user_id = None
+        self.echo_load = bytes(8)
+        self.package_count = 1
+        self.pending = collections.deque()
+        self.replied = threading.Condition()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.options.host, self.options.port))
+        self.sock.sendall(login_package(self.username, self.options.password))
+        reply = self.sock.recv(4096)
+        self.user_id = int.from_bytes(reply[12:16], byteorder="little")
+        if len(reply) < 32 or self.user_id == 0:
+            raise ConnectionError(f"{self.username} could not log in")
+        self.echo_load = reply[4:12]
+
+    def read_frames(self):
+        buffer = bytearray()
+        while True:
+            try:
+                chunk = self.sock.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+            while True:
+                length = server_frame_length(buffer)
+                if length is None or len(buffer) < length:
+                    break
+                self.received(bytes(buffer[:length]))
+                del buffer[:length]
+
+    def received(self, frame):
+        now = time.perf_counter()
+        message_type = int.from_bytes(frame[0:4], byteorder="little")
+        if message_type == 0x09:
+            # The sender put its send time right after the PRAY magic.
+            sent_at = struct.unpack_from("<d", frame, 72)[0]
+            self.results.add("pray", now - sent_at)
+            return
+        with self.replied:
+            if message_type in PRESENCE_TYPES and not self.is_reply(
+                message_type, frame
+            ):
+                self.results.presence_push()
+                return
+            if not self.pending:
+                self.results.error("unexpected")
+                return
+            name, expected, _, sent_at = self.pending.popleft()
+            if message_type in expected:
+                self.results.add(name, now - sent_at)
+            else:
+                self.results.error(name)
+            self.replied.notify()
+
+    def is_reply(self, message_type, frame):
+        """Whether a status frame answers the request waiting for a reply."""
+        if not self.pending:
+            return False
+        _, expected, target, _ = self.pending[0]
+        user_id = int.from_bytes(frame[12:16], byteorder="little")
+        return message_type in expected and user_id == target
+
+    def send(self, name):
+        message_type = MESSAGE_TYPES[name]
+        if message_type == 0x09:
+            recipient = random.choice(self.online)
+            size = random.choice(self.options.pray_sizes)
+            raw_pray = b"PRAY" + struct.pack("<d", time.perf_counter())
+            raw_pray += bytes(max(0, size - len(raw_pray)))
+            self.sock.sendall(
+                pray_package(self.echo_load, self.user_id, recipient, raw_pray)
+            )
+            self.results.sent[name] += 1
+            return
+        self.package_count += 1
+        target = random.choice(self.online)
+        expected = REPLY_TYPES.get(message_type, (message_type,))
+        with self.replied:
+            self.pending.append((name, expected, target, time.perf_counter()))
+            self.sock.sendall(
+                request_package(
+                    message_type, self.echo_load, target, self.package_count
+                )
+            )
+            self.results.sent[name] += 1
+            # Wait for the reply, like a CAOS script blocking on the command.
+            if not self.replied.wait_for(
+                lambda: not self.pending, timeout=REPLY_TIMEOUT
+            ):
+                self.pending.clear()
+                self.results.error(name + "_timeout")
+
+    def run(self, mix, deadline):
+        names, weights = zip(*mix.items())
+        reader = threading.Thread(target=self.read_frames, daemon=True)
+        reader.start()
+        while time.monotonic() < deadline:
+            try:
+                self.send(random.choices(names, weights)[0])
+            except OSError:
+                self.results.error("disconnected")
+                return
+            if self.options.think_time:
+                time.sleep(random.expovariate(1 / self.options.think_time))
+        self.sock.close()
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in MESSAGE_TYPES:
+            raise argparse.ArgumentTypeError(f"unknown message type {name!r}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def create_users(path, usernames, password):
+    from rebabel.userstore import SQLiteUserStore
+
+    store = SQLiteUserStore(path)
+    for username in usernames:
+        if store.get_user_id(username) is None:
+            store.add_user(username, password)
+    store.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1337)
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument(
+        "--pray-sizes",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=[300, 4096, 65536],
+        help="comma separated PRAY sizes in bytes, picked at random",
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=0.0, help="mean seconds between sends"
+    )
+    parser.add_argument("--user-prefix", default="loadtest")
+    parser.add_argument("--password", default="loadtest")
+    parser.add_argument(
+        "--create-users", metavar="DATABASE", help="add the accounts to this database"
+    )
+    parser.add_argument("--server-pid", type=int, help="report this process' RSS")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    options = parser.parse_args(argv)
+
+    usernames = [f"{options.user_prefix}{n:05d}" for n in range(options.clients)]
+    if options.create_users:
+        create_users(options.create_users, usernames, options.password)
+
+    results = Results()
+    online = []
+    clients = []
+    for username in usernames:
+        client = SimulatedClient(options, results, username, online)
+        client.connect()
+        online.append(client.user_id)
+        clients.append(client)
+
+    rss_samples = []
+    started = time.monotonic()
+    deadline = started + options.duration
+    threads = [
+        threading.Thread(target=client.run, args=(options.mix, deadline))
+        for client in clients
+    ]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        if options.server_pid:
+            rss = server_rss(options.server_pid)
+            if rss is not None:
+                rss_samples.append(rss)
+        time.sleep(1)
+    elapsed = time.monotonic() - started
+
+    report = {
+        "clients": options.clients,
+        "seconds": elapsed,
+        "messages_per_second": sum(results.sent.values()) / elapsed,
+        "types": {
+            name: {
+                "sent": results.sent[name],
+                "completed": len(latencies),
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+            }
+            for name, latencies in sorted(results.latencies.items())
+        },
+        "errors": dict(results.errors),
+        "presence_pushes": results.presence_pushes,
+    }
+    if rss_samples:
+        report["server_rss"] = rss_samples[-1]
+        report["server_rss_peak"] = max(rss_samples)
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{options.clients} clients, {elapsed:.1f}s")
+    print(f"{report['messages_per_second']:.1f} messages/s")
+    print(f"{'type':<8} {'sent':>8} {'done':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, row in report["types"].items():
+        print(
+            f"{name:<8} {row['sent']:>8} {row['completed']:>8}"
+            f" {row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f}"
+        )
+    if results.errors:
+        print("errors:", dict(results.errors))
+    if results.presence_pushes:
+        print("presence pushes:", results.presence_pushes)
+    if rss_samples:
+        print(
+            f"server RSS: {rss_samples[-1] / 2**20:.1f} MiB"
+            f" (peak {max(rss_samples) / 2**20:.1f} MiB)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import collections
+import tempfile
+import threading
+
+
+class MemoryBudget:
+    """
+    Counts the bytes held for messages in flight by category ("outbound",
+    "assembly", ...) and refuses reservations that would take the total
+    over limit. None means no limit, the bytes are still counted.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.total = 0
+        self.peak = 0
+        self.held = collections.Counter()
+        self.refused = collections.Counter()
+        self._lock = threading.Lock()
+
+    def reserve(self, category, count, force=False):
+        """Returns False if count bytes don't fit, unless force is set."""
+        with self._lock:
+            if (
+                not force
+                and self.limit is not None
+                and self.total + count > self.limit
+            ):
+                self.refused[category] += 1
+                return False
+            self.total += count
+            self.held[category] += count
+            if self.total > self.peak:
+                self.peak = self.total
+        return True
+
+    def release(self, category, count):
+        with self._lock:
+            self.total -= count
+            self.held[category] -= count
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "total": self.total,
+                "peak": self.peak,
+                "held": dict(self.held),
+                "refused": dict(self.refused),
+            }
+
+
+class Assembly:
+    """
+    Collects the parts of a message as they arrive. Up to spill_threshold
+    bytes are kept in memory, as long as the budget has room for them,
+    the rest goes to a temporary file in directory.
+    """
+
+    def __init__(self, budget, spill_threshold, directory=None):
+        self.budget = budget
+        self.spill_threshold = spill_threshold
+        self.directory = directory
+        self.size = 0
+        self.in_memory = 0
+        self._chunks = []
+        self._file = None
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def write(self, data):
+        self.size += len(data)
+        if self._file is None:
+            if self.in_memory + len(data) <= self.spill_threshold and (
+                self.budget.reserve("assembly", len(data))
+            ):
+                self._chunks.append(data)
+                self.in_memory += len(data)
+                return
+            self._file = tempfile.TemporaryFile(dir=self.directory)
+            for chunk in self._chunks:
+                self._file.write(chunk)
+            self._chunks = []
+            self.budget.release("assembly", self.in_memory)
+            self.in_memory = 0
+        self._file.write(data)
+
+    def getvalue(self):
+        """The whole message, read back into memory if it was spilled."""
+        if self._file is None:
+            return b"".join(self._chunks)
+        self._file.seek(0)
+        data = self._file.read()
+        # Held until close(), whether there is room for it or not.
+        self.budget.reserve("assembly", len(data), force=True)
+        self.in_memory = len(data)
+        return data
+
+    def chunks(self, size):
+        """
+        Yields the whole message in parts, a spilled one read from its file
+        size bytes at a time rather than all at once.
+        """
+        if self._file is None:
+            yield from self._chunks
+            return
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.budget.release("assembly", self.in_memory)
+        self.in_memory = 0
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
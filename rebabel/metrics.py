@@ -0,0 +1,265 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+MESSAGE_NAMES = {
+    0x09: "PRAY",
+    0x0A: "LINE_REPLY",
+    0x0D: "USER_ONLINE",
+    0x0E: "USER_OFFLINE",
+    0x0F: "UNIK",
+    0x10: "USER_STATUS",
+    0x13: "ULIN",
+    0x18: "STAT",
+    0x25: "LINE",
+    0x0221: "RUSO",
+    0x0321: "CREA_HIST",
+}
+
+
+# Upper bounds of the reply latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def message_name(message_type):
+    return MESSAGE_NAMES.get(message_type, f"0x{message_type:x}")
+
+
+class Histogram:
+    """Counts of values by bucket, the last bucket holds everything larger."""
+
+    __slots__ = ("buckets", "counts", "count", "sum", "max", "_lock")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket the value at fraction falls into."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return min(bound, self.max)
+        return self.max
+
+
+class ConnectionStats:
+    """
+    Traffic counters of one connection. The handler thread only touches the
+    *_in counters and the connection's writer only the *_out counters, so
+    updating them needs no locking.
+    """
+
+    __slots__ = (
+        "name",
+        "connected_at",
+        "bytes_in",
+        "bytes_out",
+        "messages_in",
+        "messages_out",
+    )
+
+    def __init__(self, name=None):
+        self.name = name
+        self.connected_at = time.monotonic()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = {}
+        self.messages_out = {}
+
+    def received(self, data):
+        self.bytes_in += len(data)
+
+    def received_message(self, message_type):
+        self.messages_in[message_type] = self.messages_in.get(message_type, 0) + 1
+
+    def sent(self, data):
+        self.bytes_out += len(data)
+        message_type = int.from_bytes(data[0:4], byteorder="little")
+        self.messages_out[message_type] = self.messages_out.get(message_type, 0) + 1
+
+    def sent_bytes(self, count):
+        """Counts the continuation of a message passed to sent() before."""
+        self.bytes_out += count
+
+    @property
+    def uptime(self):
+        return time.monotonic() - self.connected_at
+
+
+class Metrics:
+    """Global counters, the sum of all live and all closed connections."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.connections = set()
+        self.closed = ConnectionStats()
+        # Message type -> Histogram of the time from receiving a message to
+        # sending the reply to it.
+        self.latency = {}
+        self._lock = threading.Lock()
+
+    def observe_latency(self, message_type, seconds):
+        histogram = self.latency.get(message_type)
+        if histogram is None:
+            with self._lock:
+                histogram = self.latency.setdefault(message_type, Histogram())
+        histogram.observe(seconds)
+
+    def live(self):
+        """The stats of the connections that are open."""
+        with self._lock:
+            return list(self.connections)
+
+    def connection(self, name=None):
+        stats = ConnectionStats(name)
+        with self._lock:
+            self.connections.add(stats)
+        return stats
+
+    def close(self, stats):
+        with self._lock:
+            if stats not in self.connections:
+                return
+            self.connections.discard(stats)
+            self.closed.bytes_in += stats.bytes_in
+            self.closed.bytes_out += stats.bytes_out
+            _add_counts(self.closed.messages_in, dict(stats.messages_in))
+            _add_counts(self.closed.messages_out, dict(stats.messages_out))
+
+    @property
+    def uptime(self):
+        return time.monotonic() - self.started_at
+
+    def totals(self):
+        with self._lock:
+            totals = {
+                "uptime": self.uptime,
+                "connections": len(self.connections),
+                "bytes_in": self.closed.bytes_in,
+                "bytes_out": self.closed.bytes_out,
+                "messages_in": dict(self.closed.messages_in),
+                "messages_out": dict(self.closed.messages_out),
+            }
+            for stats in self.connections:
+                totals["bytes_in"] += stats.bytes_in
+                totals["bytes_out"] += stats.bytes_out
+                _add_counts(totals["messages_in"], dict(stats.messages_in))
+                _add_counts(totals["messages_out"], dict(stats.messages_out))
+        return totals
+
+    def prometheus(self, online=None):
+        """Returns the counters in the Prometheus text exposition format."""
+        totals = self.totals()
+        lines = [
+            "# TYPE rebabel_uptime_seconds gauge",
+            f"rebabel_uptime_seconds {totals['uptime']:.3f}",
+            "# TYPE rebabel_connections gauge",
+            f"rebabel_connections {totals['connections']}",
+        ]
+        if online is not None:
+            lines += [
+                "# TYPE rebabel_users_online gauge",
+                f"rebabel_users_online {online}",
+            ]
+        lines += [
+            "# TYPE rebabel_received_bytes_total counter",
+            f"rebabel_received_bytes_total {totals['bytes_in']}",
+            "# TYPE rebabel_sent_bytes_total counter",
+            f"rebabel_sent_bytes_total {totals['bytes_out']}",
+            "# TYPE rebabel_received_messages_total counter",
+        ]
+        for message_type, count in sorted(totals["messages_in"].items()):
+            lines.append(
+                f'rebabel_received_messages_total{{type="{message_name(message_type)}"}} {count}'
+            )
+        lines.append("# TYPE rebabel_sent_messages_total counter")
+        for message_type, count in sorted(totals["messages_out"].items()):
+            lines.append(
+                f'rebabel_sent_messages_total{{type="{message_name(message_type)}"}} {count}'
+            )
+        lines.append("# TYPE rebabel_reply_latency_seconds histogram")
+        for message_type, histogram in sorted(self.latency.items()):
+            name = message_name(message_type)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'rebabel_reply_latency_seconds_bucket{{type="{name}",le="{bound}"}} {cumulative}'
+                )
+            lines += [
+                f'rebabel_reply_latency_seconds_bucket{{type="{name}",le="+Inf"}} {histogram.count}',
+                f'rebabel_reply_latency_seconds_sum{{type="{name}"}} {histogram.sum:.6f}',
+                f'rebabel_reply_latency_seconds_count{{type="{name}"}} {histogram.count}',
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def _add_counts(into, counts):
+    for key, count in counts.items():
+        into[key] = into.get(key, 0) + count
+
+
+def serve_metrics(metrics, port, host="127.0.0.1", online=None):
+    """
+    Serves the metrics on http://host:port/metrics from a background thread.
+    `online` is an optional callable returning the number of users online.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus(
+                online=None if online is None else online()
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(
+        target=http_server.serve_forever, name="metrics", daemon=True
+    ).start()
+    return http_server
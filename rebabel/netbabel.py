@@ -0,0 +1,288 @@
+"""
+Decoding NetBabel messages.
+
+Every message starts with the same 32 byte header:
++---------+--------------+------------+--------+----+--------------+------------+----+
+| 4B Type | 8B Echo Load | 4B User ID | 2B HID | 2B | 4B Pkg Count | 4B Pld Len | 4B |
++---------+--------------+------------+--------+----+--------------+------------+----+
+A Message unpacks all of it at once and leaves the body where it is, the
+properties for the body of a particular message type read it on access.
+"""
+import struct
+
+
+HEADER = struct.Struct("<I8sIHHIII")
+# NET: LINE, the username and password lengths, followed by both strings.
+LOGIN_LENGTHS = struct.Struct("<II")
+LOGIN_LENGTHS_OFFSET = 44
+LOGIN_STRINGS_OFFSET = 52
+# PRAY from a client, the recipient follows the header and the raw PRAY data
+# starts at PRAY_DATA_OFFSET.
+PRAY_RECIPIENT = struct.Struct("<I")
+PRAY_DATA_OFFSET = 76
+
+
+class Message:
+    """
+    A message at the start of data. The header fields are decoded up front,
+    data itself is only referenced through a memoryview, never copied.
+    length is the length of the whole message, data may hold less of it
+    (see MessageReader.read_message).
+    """
+
+    __slots__ = (
+        "data",
+        "length",
+        "type",
+        "echo_load",
+        "user_id",
+        "user_hid",
+        "flags",
+        "package_count",
+        "payload_length",
+        "reserved",
+    )
+
+    def __init__(self, data, length=None):
+        self.data = memoryview(data)
+        self.length = len(self.data) if length is None else length
+        (
+            self.type,
+            self.echo_load,
+            self.user_id,
+            self.user_hid,
+            self.flags,
+            self.package_count,
+            self.payload_length,
+            self.reserved,
+        ) = HEADER.unpack_from(self.data)
+
+    @property
+    def complete(self):
+        return len(self.data) >= self.length
+
+    @property
+    def header(self):
+        return self.data[: HEADER.size]
+
+    @property
+    def body(self):
+        return self.data[HEADER.size : self.length]
+
+    @property
+    def credentials(self):
+        """NET: LINE, (username, password)"""
+        username_length, password_length = LOGIN_LENGTHS.unpack_from(
+            self.data, LOGIN_LENGTHS_OFFSET
+        )
+        # Both lengths count the terminating NUL.
+        start = LOGIN_STRINGS_OFFSET
+        username = self.data[start : start + max(0, username_length - 1)]
+        start += username_length
+        password = self.data[start : start + max(0, password_length - 1)]
+        return str(username, "latin-1"), str(password, "latin-1")
+
+    @property
+    def recipient_id(self):
+        """PRAY"""
+        return PRAY_RECIPIENT.unpack_from(self.data, HEADER.size)[0]
+
+    @property
+    def raw_pray(self):
+        """PRAY, as much of the raw PRAY data as data holds."""
+        return self.data[PRAY_DATA_OFFSET : self.length]
+
+    def __repr__(self):
+        return (
+            f"<Message {self.type:#x} from {self.user_id}+{self.user_hid}"
+            f" #{self.package_count}, {self.length} bytes>"
+        )
+
+
+def client_frame_length(data):
+    """
+    Length of the client message at the start of data, or None if data
+    doesn't hold enough of it to tell.
+    """
+    if len(data) < HEADER.size:
+        return None
+    message_type, _, _, _, _, _, payload_length, _ = HEADER.unpack_from(data)
+    if message_type == 0x25:
+        # NET: LINE, username and password follow the 52 byte login block.
+        if len(data) < LOGIN_STRINGS_OFFSET:
+            return None
+        return LOGIN_STRINGS_OFFSET + sum(
+            LOGIN_LENGTHS.unpack_from(data, LOGIN_LENGTHS_OFFSET)
+        )
+    if message_type == 0x09:
+        return 40 + payload_length  # PRAY
+    return 32 + payload_length
+
+
+def server_frame_length(data):
+    """Like client_frame_length, for a message sent by the server."""
+    if len(data) < HEADER.size:
+        return None
+    message_type, _, user_id, _, _, _, payload_length, _ = HEADER.unpack_from(data)
+    if message_type == 0x18:
+        return 48  # NET: STAT reply
+    if message_type == 0x0A:
+        # NET: LINE reply, failed logins carry no server list.
+        if user_id == 0:
+            return 60
+        if len(data) < 48:
+            return None
+        return 48 + int.from_bytes(data[44:48], byteorder="little")
+    return 32 + payload_length
+
+
+class MessageReader:
+    """
+    Splits what a connection receives into client messages, however they
+    were split up or run together by TCP. recv(size) is called for more
+    data and returns b"" once the connection is closed. A message that
+    arrived in one piece is handed out as a view of the received data.
+    """
+
+    def __init__(self, recv, recv_size=64 * 1024):
+        self._recv = recv
+        self.recv_size = recv_size
+        self._pending = memoryview(b"")
+
+    @property
+    def buffered(self):
+        """Bytes received that weren't handed out yet."""
+        return len(self._pending)
+
+    def _fill(self, size):
+        """Receives until size bytes are pending, False if the connection closed."""
+        if len(self._pending) >= size:
+            return True
+        chunks = [self._pending]
+        pending = len(self._pending)
+        while pending < size:
+            data = self._recv(self.recv_size)
+            if not data:
+                break
+            chunks.append(data)
+            pending += len(data)
+        if len(chunks) == 2 and not chunks[0]:
+            self._pending = memoryview(chunks[1])
+        else:
+            self._pending = memoryview(b"".join(chunks))
+        return pending >= size
+
+    def read_message(self, max_length=None, prefix_length=HEADER.size):
+        """
+        Returns the next Message, or None if the connection closed before
+        it was complete. A message longer than max_length is returned as
+        soon as at least its first prefix_length bytes are there, the rest
+        is up to the caller to read().
+        """
+        if not self._fill(HEADER.size):
+            return None
+        length = client_frame_length(self._pending)
+        if length is None:
+            if not self._fill(LOGIN_STRINGS_OFFSET):
+                return None
+            length = client_frame_length(self._pending)
+        if max_length is not None and length > max_length:
+            if not self._fill(min(length, prefix_length)):
+                return None
+            available = min(length, len(self._pending))
+        else:
+            if not self._fill(length):
+                return None
+            available = length
+        message = Message(self._pending[:available], length)
+        self._pending = self._pending[available:]
+        return message
+
+    def read(self, size):
+        """Up to size bytes of what follows, b"" if the connection closed."""
+        if self._pending:
+            data = bytes(self._pending[:size])
+            self._pending = self._pending[len(data) :]
+            return data
+        return self._recv(min(size, self.recv_size))
+
+    def skip(self, length):
+        """Reads and discards length bytes, False if the connection closed."""
+        while length > 0:
+            data = self.read(length)
+            if not data:
+                return False
+            length -= len(data)
+        return True
+
+
+# The fields of PRAY messages as far as they are known, see
+# pray_message_information.md: (name, start, end, "int" or "raw").
+_PRAY_HEADER_FIELDS = (
+    ("type", 0, 4, "raw"),
+    ("echo_load", 4, 12, "raw"),
+    ("user_id_01", 12, 16, "int"),
+    ("user_hid", 16, 18, "int"),
+    ("mystery_01", 18, 20, "raw"),
+    ("mystery_02", 20, 24, "raw"),
+    ("pld_len_01", 24, 28, "int"),  # Always pld_len_no_header - 8
+    ("mystery_03", 28, 32, "raw"),  # The Payload len might occupy 8 Bytes ?
+)
+PRAY_FIELDS = _PRAY_HEADER_FIELDS + (
+    ("sender_uid", 32, 36, "int"),
+    ("sender_hid", 36, 38, "int"),
+    ("mystery_04", 38, 40, "raw"),
+    ("pld_len_02", 40, 44, "int"),
+    ("mystery_12", 44, 48, "int"),
+    ("user_id_02", 48, 52, "int"),
+    ("pld_len_minus_24_?", 52, 56, "int"),  # SOme Length :shrug:
+    ("mystery_07", 56, 60, "raw"),
+    ("mystery_08", 60, 64, "raw"),
+    ("mystery_09", 64, 68, "raw"),
+    ("mystery_10", 68, 72, "raw"),
+    ("mystery_11", 72, 76, "raw"),
+)
+RELAYED_PRAY_FIELDS = _PRAY_HEADER_FIELDS + (
+    ("pld_len", 32, 36, "int"),
+    ("mystery_04", 36, 40, "raw"),
+    ("mystery_12", 40, 44, "int"),
+    ("pld_len_minus_24_?", 44, 48, "int"),
+    ("mystery_10", 48, 52, "int"),
+    ("mystery_06", 52, 56, "int"),  # SOme Length :shrug:
+    ("mystery_07", 56, 60, "raw"),
+    ("mystery_08", 60, 64, "raw"),
+    ("mystery_09", 64, 68, "raw"),
+)
+RELAYED_PRAY_DATA_OFFSET = 68
+
+
+def pray_data(data, sent_by_server=False):
+    """The raw PRAY data in a PRAY message, as a view of data."""
+    offset = RELAYED_PRAY_DATA_OFFSET if sent_by_server else PRAY_DATA_OFFSET
+    return memoryview(data)[offset:]
+
+
+def pray_filename(raw_pray):
+    return str(raw_pray[:128], "latin-1").rstrip("\0")
+
+
+def describe_pray(data, sent_by_server=False):
+    """Returns a line for every field of a PRAY message, for poking at it."""
+    view = memoryview(data)
+    lines = [f"e tcp_pld_len: {len(view)}", f"e pld_len_no_header: {len(view) - 32}"]
+    fields = RELAYED_PRAY_FIELDS if sent_by_server else PRAY_FIELDS
+    for name, start, end, kind in fields:
+        value = view[start:end]
+        if kind == "int":
+            number = int.from_bytes(value, byteorder="little")
+            lines.append(f"i {name}: {number} - {value.hex()}")
+        else:
+            lines.append(f"r {name}: {value.hex()} {len(value)}")
+    raw_pray = pray_data(view, sent_by_server)
+    if len(raw_pray) > 9:
+        lines.append(f"r pray: {raw_pray[:8].hex()}... {len(raw_pray)}")
+    else:
+        lines.append(f"r pray: {raw_pray.hex()} {len(raw_pray)}")
+    filename = pray_filename(raw_pray)
+    lines.append(f"s pray_filename: '{filename}' - {filename.encode('latin-1').hex()}")
+    return lines
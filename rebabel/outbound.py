@@ -0,0 +1,381 @@
+import logging
+import threading
+import time
+from collections import deque
+from socket import SHUT_RDWR
+
+
+# What happens to a message put on a queue that is above its high watermark:
+#  - "block": wait (up to block_timeout) for the writer to drain the queue
+#    below its low watermark, then disconnect the recipient if it didn't.
+#  - "drop": drop the message.
+#  - "disconnect": close the recipient's connection.
+POLICIES = ("block", "drop", "disconnect")
+
+log = logging.getLogger(__name__)
+
+
+class OutboundQueue:
+    """
+    A bounded queue of outgoing messages for one connection, drained by a
+    single writer thread, so a sender never waits on a slow recipient's
+    socket. Messages longer than bulk_threshold and streams are bulk, they
+    are written chunk_size bytes at a time and the other, control, messages
+    go out ahead of them wherever one message ends. No message is ever cut
+    into by another. frame_length(data), if given, returns the length of
+    the message at the start of data, so control messages can also go
+    between the messages of a bulk entry holding several.
+    """
+
+    def __init__(
+        self,
+        sock,
+        high_watermark=1024 * 1024,
+        low_watermark=256 * 1024,
+        policy="disconnect",
+        block_timeout=5.0,
+        name=None,
+        stats=None,
+        tap=None,
+        latency=None,
+        memory=None,
+        bulk_threshold=16 * 1024,
+        chunk_size=64 * 1024,
+        frame_length=None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound policy {policy!r}")
+        self.sock = sock
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.name = name
+        # Optional rebabel.metrics.ConnectionStats, updated for each write.
+        self.stats = stats
+        # Optional callable, passed every piece of data written to the socket.
+        self.tap = tap
+        # Optional callable(message_type, seconds), see put().
+        self.latency = latency
+        # Optional rebabel.memory.MemoryBudget, queued bytes are held in it.
+        self.memory = memory
+        self.bulk_threshold = bulk_threshold
+        self.chunk_size = chunk_size
+        self.frame_length = frame_length
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self._congested = False
+        self._control = deque()
+        self._bulk = deque()
+        # How far the writer got into the bulk entry at the head of _bulk,
+        # and where the message it is in the middle of ends.
+        self._offset = 0
+        self._frame_end = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._progress = threading.Condition(self._lock)
+        self._writer = threading.Thread(
+            target=self._run, name=f"outbound-{name}", daemon=True
+        )
+        self._writer.start()
+
+    def put(self, data, block=False, request=None, policy=None):
+        """
+        Queues data for sending. Returns False if it was not queued.
+        With block set, a congested queue is waited on whatever the policy,
+        and the memory budget doesn't refuse data. policy otherwise replaces
+        the queue's own for this message. request is the (message
+        type, time.monotonic() it was received) of the message data answers,
+        the time until data is sent is passed to the latency callback.
+        """
+        with self._lock:
+            if not self._admit_locked("block" if block else policy or self.policy):
+                return False
+            if self.memory is not None and not self.memory.reserve(
+                "outbound", len(data), force=block
+            ):
+                self.dropped += 1
+                return False
+            if request is not None and self.latency is not None:
+                entry = _Reply(data, *request)
+            else:
+                entry = data
+            if len(data) > self.bulk_threshold:
+                self._bulk.append(entry)
+            else:
+                self._control.append(entry)
+            self._queued_locked(len(data))
+        return True
+
+    def stream(self, length, max_buffered=256 * 1024):
+        """
+        Queues a message of length bytes whose data is handed to the returned
+        OutboundStream as it arrives, or returns None if it was not queued.
+        It is bulk: no bulk message queued after it is sent before it.
+        """
+        with self._lock:
+            if not self._admit_locked(self.policy):
+                return None
+            stream = OutboundStream(self, length, max_buffered)
+            self._bulk.append(stream)
+        return stream
+
+    def _admit_locked(self, policy):
+        if self.closed:
+            return False
+        if self._congested:
+            if policy == "drop":
+                self.dropped += 1
+                return False
+            if policy == "block":
+                self._drained.wait_for(
+                    lambda: not self._congested or self.closed,
+                    timeout=self.block_timeout,
+                )
+                if self.closed:
+                    return False
+            if self._congested:
+                log.warning("%s> too far behind, disconnecting", self.name)
+                self._close_locked(shutdown=True)
+                return False
+        return True
+
+    def _queued_locked(self, length):
+        self.queued_bytes += length
+        if self.queued_bytes > self.high_watermark:
+            self._congested = True
+        self._not_empty.notify()
+
+    def close(self, flush=False, timeout=None):
+        """
+        Stops the writer, after sending what is queued if flush is set, for
+        up to timeout (by default block_timeout) seconds.
+        """
+        with self._lock:
+            if flush and not self.closed:
+                self._drained.wait_for(
+                    lambda: not (self._control or self._bulk) or self.closed,
+                    timeout=self.block_timeout if timeout is None else timeout,
+                )
+            self._close_locked(shutdown=False)
+
+    def _close_locked(self, shutdown):
+        if not self.closed:
+            self.closed = True
+            self._control.clear()
+            self._bulk.clear()
+            self._release_locked(self.queued_bytes)
+            self._not_empty.notify_all()
+            self._drained.notify_all()
+            self._progress.notify_all()
+        if shutdown:
+            try:
+                self.sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _in_message_locked(self):
+        """Whether the writer is in the middle of a bulk message."""
+        if not self._bulk:
+            return False
+        entry = self._bulk[0]
+        if isinstance(entry, OutboundStream):
+            return entry.started
+        return self._offset < self._frame_end
+
+    def _next_locked(self):
+        """
+        Waits for something to write, returns (entry, data, whether data
+        starts a message, whether entry is bulk) or None once closed.
+        """
+        while True:
+            self._not_empty.wait_for(
+                lambda: self._control or self._bulk or self.closed
+            )
+            if self.closed:
+                return None
+            if self._control and not self._in_message_locked():
+                entry = self._control[0]
+                return entry, _data(entry), True, False
+            entry = self._bulk[0]
+            if isinstance(entry, OutboundStream):
+                stream = entry
+                # Control messages may still go first while the stream waits
+                # for its first chunk.
+                self._not_empty.wait_for(
+                    lambda: stream.chunks
+                    or stream.padding
+                    or self.closed
+                    or stream.aborted
+                    or (self._control and not stream.started)
+                )
+                if self.closed:
+                    return None
+                if not stream.chunks and stream.padding:
+                    padding = bytes(min(stream.padding, self.chunk_size))
+                    stream.padding -= len(padding)
+                    stream.chunks.append(padding)
+                    stream.buffered += len(padding)
+                    if self.memory is not None:
+                        self.memory.reserve("outbound", len(padding), force=True)
+                    self._queued_locked(len(padding))
+                if not stream.chunks:
+                    continue
+                starts = not stream.started
+                stream.started = True
+                return stream, stream.chunks[0], starts, True
+            data = _data(entry)
+            starts = self._offset == self._frame_end
+            if starts:
+                length = None
+                if self.frame_length is not None:
+                    length = self.frame_length(memoryview(data)[self._offset :])
+                if not length or self._offset + length > len(data):
+                    length = len(data) - self._offset
+                self._frame_end = self._offset + length
+            end = min(self._frame_end, self._offset + self.chunk_size)
+            return entry, memoryview(data)[self._offset : end], starts, True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                task = self._next_locked()
+                if task is None:
+                    return
+                entry, data, starts, bulk = task
+            try:
+                self.sock.sendall(data)
+            except OSError as exception:
+                log.info("%s> write failed, %s", self.name, exception)
+                with self._lock:
+                    self._close_locked(shutdown=True)
+                return
+            if self.tap is not None:
+                self.tap(data)
+            if self.stats is not None:
+                if starts:
+                    self.stats.sent(data)
+                else:
+                    self.stats.sent_bytes(len(data))
+            with self._lock:
+                if self.closed:
+                    return
+                done = True
+                if isinstance(entry, OutboundStream):
+                    entry.chunks.popleft()
+                    entry.buffered -= len(data)
+                    entry.sent += len(data)
+                    done = entry.sent == entry.length
+                    self._progress.notify_all()
+                elif bulk:
+                    self._offset += len(data)
+                    done = self._offset == len(_data(entry))
+                if done:
+                    if bulk:
+                        self._bulk.popleft()
+                        self._offset = self._frame_end = 0
+                    else:
+                        self._control.popleft()
+                self._release_locked(len(data))
+                if self.queued_bytes <= self.low_watermark:
+                    self._congested = False
+                if not self._congested or not (self._control or self._bulk):
+                    self._drained.notify_all()
+            if done and isinstance(entry, _Reply):
+                self.latency(entry.message_type, time.monotonic() - entry.received_at)
+
+    def _release_locked(self, length):
+        self.queued_bytes -= length
+        if self.memory is not None:
+            self.memory.release("outbound", length)
+
+    def __len__(self):
+        return len(self._control) + len(self._bulk)
+
+
+def _data(entry):
+    return entry.data if isinstance(entry, _Reply) else entry
+
+
+class _Reply:
+    __slots__ = ("data", "message_type", "received_at")
+
+    def __init__(self, data, message_type, received_at):
+        self.data = data
+        self.message_type = message_type
+        self.received_at = received_at
+
+
+class OutboundStream:
+    """
+    A message on an OutboundQueue that is sent while it is still arriving,
+    see OutboundQueue.stream(). At most max_buffered bytes of it are held
+    at a time, write() waits for the writer to catch up beyond that.
+    """
+
+    def __init__(self, queue, length, max_buffered):
+        self.queue = queue
+        self.length = length
+        self.max_buffered = max_buffered
+        self.remaining = length
+        self.buffered = 0
+        self.sent = 0
+        self.started = False
+        self.aborted = False
+        # Zeros still to be sent in place of the data of an aborted stream.
+        self.padding = 0
+        self.chunks = deque()
+
+    def write(self, data):
+        """Queues the next part of the message. Returns False if it was not."""
+        if len(data) > self.remaining:
+            raise ValueError("More data than the length of the message")
+        queue = self.queue
+        with queue._lock:
+            queue._progress.wait_for(
+                lambda: self.buffered < self.max_buffered or queue.closed,
+                timeout=queue.block_timeout,
+            )
+            if queue.closed or self.aborted:
+                return False
+            if self.buffered >= self.max_buffered:
+                log.warning("%s> too slow for a stream, disconnecting", queue.name)
+                queue._close_locked(shutdown=True)
+                return False
+            self.chunks.append(data)
+            self.buffered += len(data)
+            self.remaining -= len(data)
+            # A stream's buffer is bounded by max_buffered already.
+            if queue.memory is not None:
+                queue.memory.reserve("outbound", len(data), force=True)
+            queue._queued_locked(len(data))
+        return True
+
+    def abort(self):
+        """
+        Gives up on a message that won't be completed. Once part of it is on
+        the wire the rest of it is sent as zeros, which keeps the recipient's
+        framing intact. Does nothing if all of it was written.
+        """
+        queue = self.queue
+        with queue._lock:
+            if not self.remaining or self.aborted or queue.closed:
+                return
+            self.aborted = True
+            if not self.started:
+                queue._bulk.remove(self)
+                queue._release_locked(self.buffered)
+                self.chunks.clear()
+                self.buffered = 0
+                queue._not_empty.notify()
+                return
+            log.info(
+                "%s> stream aborted, padding its last %s bytes",
+                queue.name,
+                self.remaining,
+            )
+            self.padding = self.remaining
+            self.remaining = 0
+            queue._not_empty.notify()
@@ -0,0 +1,111 @@
+import struct
+import threading
+
+
+PACKAGE_COUNT = struct.Struct("<I")
+PACKAGE_COUNT_OFFSET = 20
+
+
+def with_package_count(template, package_count):
+    """Returns a copy of an encoded reply with its package counter set."""
+    reply = bytearray(template)
+    PACKAGE_COUNT.pack_into(reply, PACKAGE_COUNT_OFFSET, package_count)
+    return reply
+
+
+class StatusReplyCache:
+    """
+    Encoded replies to user status requests. `encode(user_id, user_hid)`
+    builds a reply and returns (reply, online, cacheable); cacheable replies
+    are kept until invalidate(user_id) is called, which has to happen
+    whenever the user logs in, logs out or their profile changes.
+    """
+
+    def __init__(self, encode):
+        self.encode = encode
+        self._replies = {}
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, user_hid=1):
+        """Returns (reply, online) for the user."""
+        with self._lock:
+            entry = self._replies.get(user_id, {}).get(user_hid)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            generation = (self._epoch, self._generations.get(user_id, 0))
+        reply, online, cacheable = self.encode(user_id, user_hid)
+        entry = (bytes(reply), online)
+        if cacheable:
+            with self._lock:
+                # Don't store a reply that was built before an invalidation.
+                if (self._epoch, self._generations.get(user_id, 0)) == generation:
+                    self._replies.setdefault(user_id, {})[user_hid] = entry
+        return entry
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._replies.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._replies.clear()
+            self._generations.clear()
+            self._epoch += 1
+
+    def __len__(self):
+        return len(self._replies)
+
+
+class WatchIndex:
+    """
+    The "whose wanted" registers of all connections: which connections
+    want to hear when a user goes on or offline.
+    """
+
+    def __init__(self):
+        self._watchers = {}
+        # watcher -> the user ids it watches, as dict keys, oldest first
+        self._watching = {}
+        self._lock = threading.Lock()
+
+    def watch(self, watcher, user_id, limit=None):
+        """
+        Adds user_id to the watcher's register. Once it holds more than
+        limit users, the one watched longest ago is dropped.
+        """
+        with self._lock:
+            watching = self._watching.setdefault(watcher, {})
+            watching.pop(user_id, None)
+            watching[user_id] = None
+            self._watchers.setdefault(user_id, set()).add(watcher)
+            while limit is not None and len(watching) > limit:
+                oldest = next(iter(watching))
+                del watching[oldest]
+                self._discard(watcher, oldest)
+
+    def clear(self, watcher):
+        """Empties a watcher's register, also needed when it disconnects."""
+        with self._lock:
+            for user_id in self._watching.pop(watcher, ()):
+                self._discard(watcher, user_id)
+
+    def _discard(self, watcher, user_id):
+        watchers = self._watchers.get(user_id)
+        if watchers is not None:
+            watchers.discard(watcher)
+            if not watchers:
+                del self._watchers[user_id]
+
+    def watchers(self, user_id):
+        with self._lock:
+            return list(self._watchers.get(user_id, ()))
+
+    def __len__(self):
+        return len(self._watchers)
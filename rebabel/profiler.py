@@ -0,0 +1,93 @@
+import collections
+import os
+import sys
+import threading
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread each interval seconds from a thread of
+    its own, so it can be switched on and off on a running server and costs
+    nothing while off. A function's own samples are the ones it was running
+    in, its total samples the ones it was anywhere on the stack. Threads
+    blocked in a call, like a recv(), count for the function making it.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.own = collections.Counter()
+        self.total = collections.Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=None):
+        if interval is not None:
+            self.interval = interval
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self.samples = 0
+            self.own.clear()
+            self.total.clear()
+
+    def _run(self):
+        own_thread = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own_thread:
+                        continue
+                    self.samples += 1
+                    self.own[_location(frame)] += 1
+                    seen = set()
+                    while frame is not None:
+                        seen.add(_location(frame))
+                        frame = frame.f_back
+                    self.total.update(seen)
+            del frames
+
+    def top(self, count=20, by="own"):
+        """Returns [(location, own samples, total samples)] of the hottest."""
+        with self._lock:
+            counter = self.own if by == "own" else self.total
+            return [
+                (location, self.own[location], self.total[location])
+                for location, _ in counter.most_common(count)
+            ]
+
+    def report(self, count=20, by="own"):
+        with self._lock:
+            samples = self.samples
+        if not samples:
+            return "no samples"
+        lines = [f"{samples} samples, {by} time", "   own%  total%  function"]
+        for (filename, line, name), own, total in self.top(count, by):
+            lines.append(
+                f"{100 * own / samples:6.1f}% {100 * total / samples:6.1f}%"
+                f"  {name} ({os.path.basename(filename)}:{line})"
+            )
+        return "\n".join(lines)
+
+
+def _location(frame):
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
@@ -0,0 +1,163 @@
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+
+log = logging.getLogger("rebabel")
+# Hex dumps and PRAY decodes go to their own logger, so they can be switched
+# on without turning every other debug message on as well.
+trace_log = logging.getLogger("rebabel.trace")
+
+# Level each message type is logged at, by the first 4 header bytes as int.
+# Types that aren't listed use DEFAULT_MESSAGE_LEVEL.
+DEFAULT_MESSAGE_LEVEL = logging.INFO
+message_levels = {
+    0x0F: logging.DEBUG,  # NET: UNIK
+    0x10: logging.DEBUG,  # User status
+    0x13: logging.DEBUG,  # NET: ULIN
+    0x18: logging.DEBUG,  # NET: STAT
+    0x0221: logging.DEBUG,  # NET: RUSO
+}
+
+_HEX_DUMP_HEADER = (
+    "     0  1  2  3  4  5  6  7  8  9  A  B  C  D  E  F\n"
+    "    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+\n"
+)
+_HEX_DUMP_RULER = "    " + "+--" * 16 + "+"
+
+
+def hex_dump(payload, color_code=None):
+    """Renders payload in the 16 bytes per row layout of netbabel_stuff.md."""
+    payload = bytes(payload)
+    rows = [_HEX_DUMP_HEADER]
+    for i in range(0, len(payload), 16):
+        row = payload[i : i + 16]
+        if len(row) == 16:
+            ruler = _HEX_DUMP_RULER
+        else:
+            ruler = "    " + "+--" * len(row) + "+"
+        rows.append(f" {i // 16:02x} |{row.hex('|')}|\n{ruler}\n")
+    dump = "".join(rows)
+    if color_code is not None:
+        dump = f"{color_code}\n{dump}\033[00m"
+    return dump
+
+
+class _HexDump:
+    """Defers rendering a hex dump until the log record is written."""
+
+    __slots__ = ("payload", "color_code")
+
+    def __init__(self, payload, color_code=None):
+        self.payload = payload
+        self.color_code = color_code
+
+    def __str__(self):
+        return hex_dump(self.payload, self.color_code)
+
+
+class Sampler:
+    """Lets a fraction of events through, but no more than per_second."""
+
+    def __init__(self, rate=1.0, per_second=10):
+        self.rate = rate
+        self.per_second = per_second
+        self._tokens = float(per_second)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def __call__(self):
+        if self.rate < 1.0 and random.random() >= self.rate:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.per_second, self._tokens + (now - self._last) * self.per_second
+            )
+            self._last = now
+            if self._tokens < 1:
+                self.dropped += 1
+                return False
+            self._tokens -= 1
+        return True
+
+
+hex_dump_sampler = Sampler(rate=0.01, per_second=10)
+
+
+def message_level(message_type):
+    return message_levels.get(message_type, DEFAULT_MESSAGE_LEVEL)
+
+
+def log_message(message_type, msg, *args):
+    """Logs msg at the level configured for message_type."""
+    level = message_level(message_type)
+    if log.isEnabledFor(level):
+        log.log(level, msg, *args)
+
+
+def tracing():
+    """True if hex dumps / decodes should be produced for this message."""
+    return trace_log.isEnabledFor(logging.DEBUG) and hex_dump_sampler()
+
+
+def trace_dump(payload, msg, *args, color_code=None):
+    """Logs msg followed by a sampled, rate limited hex dump of payload."""
+    if tracing():
+        trace_log.debug(msg + "\n%s", *args, _HexDump(bytes(payload), color_code))
+
+
+class _BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread without formatting them, so the
+    request thread only pays for creating the record. Records are dropped
+    when the queue is full instead of blocking the caller.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+
+
+def setup_logging(level=logging.INFO, trace=False, stream=None, max_queued=10000):
+    """
+    Routes the rebabel loggers through a bounded queue to a background thread
+    that formats and writes them to stream (stderr by default).
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    log_queue = queue.Queue(maxsize=max_queued)
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    log.handlers[:] = [_BackgroundQueueHandler(log_queue)]
+    log.setLevel(level)
+    log.propagate = False
+    trace_log.setLevel(logging.DEBUG if trace else logging.WARNING)
+    return _listener
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,121 @@
+import collections
+import threading
+import time
+
+
+# What happens to a message over its limit:
+#  - "queue": hold the sender until there are tokens, for up to max_delay
+#    seconds, then drop it.
+#  - "drop": don't handle the message.
+#  - "disconnect": close the sender's connection.
+ACTIONS = ("queue", "drop", "disconnect")
+
+
+class TokenBucket:
+    """rate tokens per second, holding at most burst tokens."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self, cost):
+        """Seconds until cost tokens are there, 0 if they are now."""
+        # A cost above the burst size goes through whenever the bucket is full.
+        cost = min(cost, self.burst)
+        with self._lock:
+            self._refill()
+            if self._tokens >= cost:
+                return 0.0
+            return (cost - self._tokens) / self.rate
+
+    def take(self, cost):
+        cost = min(cost, self.burst)
+        with self._lock:
+            self._refill()
+            self._tokens -= cost
+
+    def try_take(self, cost):
+        """Takes cost tokens if they are there, returns delay(cost) first."""
+        cost = min(cost, self.burst)
+        with self._lock:
+            self._refill()
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return 0.0
+            return (cost - self._tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Per user and global token buckets for each message class. limits maps
+    a class name to {"user": (rate, burst), "global": (rate, burst),
+    "action": one of ACTIONS, "max_delay": seconds}; "user" and "global"
+    are optional. A user's buckets outlive their session, so reconnecting
+    doesn't refill them.
+    """
+
+    def __init__(self, limits):
+        for name, limit in limits.items():
+            if limit.get("action", "drop") not in ACTIONS:
+                raise ValueError(f"Unknown rate limit action for {name!r}")
+        self.limits = limits
+        self.global_buckets = {
+            name: TokenBucket(*limit["global"])
+            for name, limit in limits.items()
+            if limit.get("global") is not None
+        }
+        self.user_buckets = {}
+        self.limited = collections.Counter()
+        self._lock = threading.Lock()
+        self._take_lock = threading.Lock()
+
+    def _buckets(self, user_id, message_class):
+        limit = self.limits[message_class]
+        buckets = []
+        if limit.get("user") is not None:
+            with self._lock:
+                user = self.user_buckets.setdefault(user_id, {})
+                if message_class not in user:
+                    user[message_class] = TokenBucket(*limit["user"])
+                buckets.append(user[message_class])
+        if message_class in self.global_buckets:
+            buckets.append(self.global_buckets[message_class])
+        return buckets
+
+    def acquire(self, user_id, message_class, cost=1):
+        """
+        Takes cost tokens from the user's and the global bucket of the class.
+        Returns None if the message may be handled, otherwise the action
+        ("drop" or "disconnect") to take.
+        """
+        limit = self.limits.get(message_class)
+        if limit is None:
+            return None
+        buckets = self._buckets(user_id, message_class)
+        action = limit.get("action", "drop")
+        deadline = time.monotonic() + limit.get("max_delay", 1.0)
+        while True:
+            if len(buckets) == 1:
+                delay = buckets[0].try_take(cost)
+            else:
+                # Checked and taken at once, or two senders could both pass
+                # the check on the last tokens.
+                with self._take_lock:
+                    delay = max(bucket.delay(cost) for bucket in buckets)
+                    if not delay:
+                        for bucket in buckets:
+                            bucket.take(cost)
+            if not delay:
+                return None
+            if action != "queue" or time.monotonic() + delay > deadline:
+                self.limited[message_class] += 1
+                return "drop" if action == "queue" else action
+            time.sleep(delay)
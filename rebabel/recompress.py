@@ -0,0 +1,124 @@
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from prayer.blocks import Block
+from rebabel.ratelimit import TokenBucket
+
+
+# Every PRAY block starts with its type, its name, the length of its data as
+# stored, the length uncompressed and whether it is compressed, see
+# prayer.blocks.Block.
+BLOCK_HEADER = struct.Struct("<4s128sIII")
+
+
+def pray_blocks(raw_pray):
+    """
+    Yields (start, end, stored length, length, compressed) for every block
+    of raw PRAY data, without decompressing anything. Stops at the first
+    block that doesn't fit.
+    """
+    view = memoryview(raw_pray)
+    if bytes(view[:4]) != b"PRAY":
+        return
+    start = 4
+    while start + BLOCK_HEADER.size <= len(view):
+        _, _, stored, length, flag = BLOCK_HEADER.unpack_from(view, start)
+        end = start + BLOCK_HEADER.size + stored
+        if end > len(view):
+            return
+        yield start, end, stored, length, flag == 1 and stored != length
+        start = end
+
+
+class Recompressor:
+    """
+    Compresses the big uncompressed blocks of relayed PRAYs. Blocks of at
+    least threshold bytes are compressed on a pool of worker threads, and
+    only replaced if that saves min_saving of their size. A block is passed
+    through as is when all workers are busy or more than max_rate bytes per
+    second (burst bytes at once) would be compressed, which caps the CPU
+    spent on it.
+    """
+
+    def __init__(self, threshold, min_saving, workers=2, max_rate=None, burst=None):
+        self.threshold = threshold
+        self.min_saving = min_saving
+        self.bucket = None
+        if max_rate is not None:
+            self.bucket = TokenBucket(max_rate, burst or max_rate)
+        self.compressed = 0
+        self.kept = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_saved = 0
+        self._slots = threading.BoundedSemaphore(workers)
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="recompress")
+        self._lock = threading.Lock()
+
+    def _take(self, length):
+        if not self._slots.acquire(blocking=False):
+            return False
+        if self.bucket is not None and self.bucket.try_take(length):
+            self._slots.release()
+            return False
+        return True
+
+    def _compress(self, block):
+        try:
+            return Block(block).zblock_data
+        finally:
+            self._slots.release()
+
+    def recompress(self, raw_pray):
+        """
+        Returns raw_pray with its big uncompressed blocks compressed, or
+        raw_pray itself if none of them was worth it.
+        """
+        view = memoryview(raw_pray)
+        jobs = []
+        for start, end, _, length, compressed in pray_blocks(view):
+            if compressed or length < self.threshold:
+                continue
+            if not self._take(length):
+                with self._lock:
+                    self.skipped += 1
+                continue
+            block = bytes(view[start:end])
+            jobs.append((start, end, self._pool.submit(self._compress, block)))
+        if not jobs:
+            return raw_pray
+        parts = []
+        position = 0
+        saved = 0
+        for start, end, job in jobs:
+            block = job.result()
+            with self._lock:
+                self.bytes_in += end - start
+                if len(block) > (end - start) * (1 - self.min_saving):
+                    self.kept += 1
+                    continue
+                self.compressed += 1
+            parts.append(view[position:start])
+            parts.append(block)
+            position = end
+            saved += end - start - len(block)
+        if not saved:
+            return raw_pray
+        with self._lock:
+            self.bytes_saved += saved
+        parts.append(view[position:])
+        return b"".join(parts)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "compressed": self.compressed,
+                "kept": self.kept,
+                "skipped": self.skipped,
+                "bytes_in": self.bytes_in,
+                "bytes_saved": self.bytes_saved,
+            }
+
+    def close(self):
+        self._pool.shutdown(wait=True)
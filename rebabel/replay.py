@@ -0,0 +1,256 @@
+"""
+Replays captured sessions against a server and checks its replies against
+the ones in the capture, see rebabel.capture.
+
+    python -m rebabel.replay capture.rbcap --speed 10
+
+Every session gets its own connection. Client data is sent at the captured
+times divided by --speed ("max" sends as fast as possible), but never before
+the replies the client had received at that point in the capture arrived,
+and never before the other sessions sent what was captured earlier.
+"""
+import argparse
+import collections
+import json
+import socket
+import threading
+import time
+
+from rebabel.capture import CLIENT, SERVER, frames, read_capture
+
+
+REPLY_TIMEOUT = 10
+
+
+def load_sessions(paths):
+    """Returns {(file index, session id): [Record, ...]} from capture files."""
+    sessions = collections.defaultdict(list)
+    for index, path in enumerate(paths):
+        for record in read_capture(path):
+            sessions[index, record.session].append(record)
+    return dict(sessions)
+
+
+class Ordering:
+    """
+    Keeps what the sessions send in captured order across sessions, so a
+    status request still finds a user online that was online when it was
+    captured. A session may send something captured at t once every other
+    session sent what it sent before t and got the replies it got before t.
+    """
+
+    def __init__(self):
+        self.sessions = []
+        self.changed = threading.Condition()
+
+    def wait_turn(self, session, timestamp):
+        with self.changed:
+            return self.changed.wait_for(
+                lambda: all(
+                    other.position() >= timestamp
+                    for other in self.sessions
+                    if other is not session
+                ),
+                timeout=REPLY_TIMEOUT,
+            )
+
+
+def normalize(frame):
+    """Blanks the parts of a server message that differ from run to run."""
+    message_type = int.from_bytes(frame[0:4], byteorder="little")
+    # Every session gets its own echo load.
+    frame = frame[:4] + bytes(8) + frame[12:]
+    if message_type == 0x18:
+        return frame[:32]  # NET: STAT, uptime, users online and byte counts
+    if message_type == 0x0221:
+        return frame[:12] + bytes(6) + frame[18:]  # NET: RUSO, a random user
+    return frame
+
+
+class ReplayedSession:
+    def __init__(self, key, records, options, ordering, start_time, first_timestamp):
+        self.key = key
+        self.options = options
+        self.ordering = ordering
+        self.start_time = start_time
+        self.first_timestamp = first_timestamp
+        # (timestamp, data, replies expected before sending it)
+        self.sends = []
+        self.expected = []
+        self.expected_times = []
+        expected = b""
+        for record in records:
+            if record.direction == CLIENT:
+                self.sends.append((record.timestamp, record.data, len(self.expected)))
+            elif record.direction == SERVER:
+                messages, expected = frames(expected + record.data)
+                self.expected += messages
+                self.expected_times += [record.timestamp] * len(messages)
+        self.last_timestamp = records[-1].timestamp
+        self.received = []
+        self.sent = 0
+        self.done = False
+        self.error = None
+
+    def position(self):
+        """Capture time of the next thing this session sends or waits for."""
+        if self.done:
+            return float("inf")
+        position = float("inf")
+        if self.sent < len(self.sends):
+            position = self.sends[self.sent][0]
+        if len(self.received) < len(self.expected):
+            position = min(position, self.expected_times[len(self.received)])
+        return position
+
+    def run(self):
+        try:
+            self._run()
+        except OSError as exception:
+            self.error = str(exception)
+        finally:
+            with self.ordering.changed:
+                self.done = True
+                self.ordering.changed.notify_all()
+
+    def _run(self):
+        sock = None
+        for timestamp, data, replies_before in self.sends:
+            self._wait_until(timestamp)
+            if not self._wait_for_replies(replies_before):
+                self.error = f"timed out waiting for reply {replies_before}"
+                return
+            self.ordering.wait_turn(self, timestamp)
+            if sock is None:
+                sock = socket.create_connection((self.options.host, self.options.port))
+                threading.Thread(target=self._read, args=(sock,), daemon=True).start()
+            sock.sendall(data)
+            with self.ordering.changed:
+                self.sent += 1
+                self.ordering.changed.notify_all()
+        if sock is None:
+            return
+        if not self._wait_for_replies(len(self.expected)):
+            self.error = "timed out waiting for the last replies"
+        self.ordering.wait_turn(self, self.last_timestamp)
+        sock.close()
+
+    def _wait_until(self, timestamp):
+        if self.options.speed is None:
+            return
+        offset = (timestamp - self.first_timestamp) / 1e9 / self.options.speed
+        delay = self.start_time + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _wait_for_replies(self, count):
+        with self.ordering.changed:
+            return self.ordering.changed.wait_for(
+                lambda: len(self.received) >= count, timeout=REPLY_TIMEOUT
+            )
+
+    def _read(self, sock):
+        buffer = b""
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            messages, buffer = frames(buffer + chunk)
+            if messages:
+                with self.ordering.changed:
+                    self.received += messages
+                    self.ordering.changed.notify_all()
+
+    def compare(self):
+        """Returns the (missing, unexpected) replies."""
+        expected = collections.Counter(map(normalize, self.expected))
+        received = collections.Counter(map(normalize, self.received))
+        return expected - received, received - expected
+
+
+def parse_speed(speed):
+    if speed == "max":
+        return None
+    speed = float(speed)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return speed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("captures", nargs="+", help="capture files")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1337)
+    parser.add_argument(
+        "--speed", type=parse_speed, default=1.0, help='1, 10, ... or "max"'
+    )
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    options = parser.parse_args(argv)
+
+    sessions = load_sessions(options.captures)
+    if not sessions:
+        parser.error("the captures hold no sessions")
+    first_timestamp = min(records[0].timestamp for records in sessions.values())
+    ordering = Ordering()
+    start_time = time.monotonic()
+    replayed = [
+        ReplayedSession(key, records, options, ordering, start_time, first_timestamp)
+        for key, records in sorted(sessions.items())
+    ]
+    ordering.sessions = replayed
+    threads = [threading.Thread(target=session.run) for session in replayed]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start_time
+
+    report = {
+        "sessions": len(replayed),
+        "seconds": elapsed,
+        "sent": sum(session.sent for session in replayed),
+        "expected": sum(len(session.expected) for session in replayed),
+        "received": sum(len(session.received) for session in replayed),
+        "failed": [],
+    }
+    for session in replayed:
+        missing, unexpected = session.compare()
+        if missing or unexpected or session.error:
+            report["failed"].append(
+                {
+                    "file": options.captures[session.key[0]],
+                    "session": session.key[1],
+                    "error": session.error,
+                    "missing": [frame.hex() for frame in missing.elements()],
+                    "unexpected": [frame.hex() for frame in unexpected.elements()],
+                }
+            )
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(
+            f"{report['sessions']} sessions, {report['sent']} client messages"
+            f" in {elapsed:.2f}s"
+        )
+        print(f"{report['received']} of {report['expected']} replies received")
+        for failure in report["failed"]:
+            print(
+                f"session {failure['session']} of {failure['file']}:"
+                f" {len(failure['missing'])} missing,"
+                f" {len(failure['unexpected'])} unexpected"
+                + (f", {failure['error']}" if failure["error"] else "")
+            )
+            for frame in failure["missing"][:5]:
+                print(f"  - {frame[:96]}")
+            for frame in failure["unexpected"][:5]:
+                print(f"  + {frame[:96]}")
+    raise SystemExit(1 if report["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
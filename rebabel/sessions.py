@@ -0,0 +1,96 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionTokens:
+    """
+    Echo load tokens handed out at login. A client sends its echo load back
+    when it reconnects, and a token that is still known lets it log in again
+    without its password being checked. Tokens expire ttl seconds after they
+    were issued or their session ended, at most max_entries are kept.
+    """
+
+    def __init__(self, ttl=10 * 60, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.resumed = 0
+        # token -> (user_id, expires_at, generation), oldest expiry first
+        self._tokens = OrderedDict()
+        # token -> [generation, sessions] of the tokens in use
+        self._live = {}
+        # user_id -> how often the user's tokens were revoked
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def issue(self, user_id):
+        """Returns a new 8 byte token for user_id."""
+        token = secrets.token_bytes(8)
+        with self._lock:
+            generation = self._generations.get(user_id, 0)
+            self._use_locked(token, generation)
+            self._put_locked(token, user_id, generation)
+        return token
+
+    def release(self, token, user_id):
+        """
+        The token's session ended, it can be resumed for ttl seconds unless
+        the user's tokens were revoked since it was issued.
+        """
+        token = bytes(token)
+        with self._lock:
+            live = self._live.get(token)
+            if live is None:
+                return
+            live[1] -= 1
+            if not live[1]:
+                del self._live[token]
+            if live[0] == self._generations.get(user_id, 0):
+                self._put_locked(token, user_id, live[0])
+
+    def _use_locked(self, token, generation):
+        live = self._live.setdefault(token, [generation, 0])
+        live[1] += 1
+
+    def _put_locked(self, token, user_id, generation):
+        self._tokens[token] = (user_id, time.monotonic() + self.ttl, generation)
+        self._tokens.move_to_end(token)
+        self._expire_locked()
+        while len(self._tokens) > self.max_entries:
+            self._tokens.popitem(last=False)
+
+    def resume(self, token, user_id):
+        """True if token was issued to user_id and hasn't expired."""
+        token = bytes(token)
+        with self._lock:
+            self._expire_locked()
+            entry = self._tokens.get(token)
+            if entry is None or entry[0] != user_id:
+                return False
+            if entry[2] != self._generations.get(user_id, 0):
+                return False
+            self._use_locked(token, entry[2])
+            self.resumed += 1
+            return True
+
+    def revoke_user(self, user_id):
+        """
+        Forgets all of a user's tokens, e.g. after a password change. Those
+        of sessions still going can't be resumed after they end either.
+        """
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            for token in [t for t, e in self._tokens.items() if e[0] == user_id]:
+                del self._tokens[token]
+
+    def _expire_locked(self):
+        now = time.monotonic()
+        while self._tokens:
+            token, (user_id, expires_at, _) = next(iter(self._tokens.items()))
+            if expires_at > now:
+                return
+            del self._tokens[token]
+
+    def __len__(self):
+        return len(self._tokens)
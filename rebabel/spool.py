@@ -0,0 +1,210 @@
+import os
+import struct
+import threading
+import time
+
+
+# Every spooled message is stored as a record header followed by the message.
+# +-------------------+-----------------+---------------+
+# | 8B Double stored  | 4B Int len(msg) | nB Message    |
+# +-------------------+-----------------+---------------+
+RECORD = struct.Struct("<dI")
+
+
+class Spool:
+    """
+    An append-only on-disk store of messages for users that are offline.
+    Each recipient has its own file in `directory`; only the offsets and
+    sizes of the records are kept in memory.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_bytes_per_user=16 * 1024 * 1024,
+        max_age=7 * 24 * 60 * 60,
+        batch_size=256 * 1024,
+        fsync=True,
+    ):
+        self.directory = directory
+        self.max_bytes_per_user = max_bytes_per_user
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.fsync = fsync
+        # user_id -> list of (offset, length, stored_at) of each message
+        self.index = {}
+        self.sizes = {}
+        # Users whose messages deliver() is sending right now.
+        self._delivering = set()
+        # Guards index, sizes and _delivering.
+        self._lock = threading.Lock()
+        # A user's file is written by whoever holds their lock in here, so
+        # one slow fsync doesn't hold up the messages for everyone else.
+        self._file_locks = [threading.Lock() for _ in range(64)]
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.spool")
+
+    def _load(self):
+        for filename in os.listdir(self.directory):
+            name, extension = os.path.splitext(filename)
+            if extension != ".spool" or not name.isdigit():
+                continue
+            user_id = int(name)
+            records, size = self._scan(self._path(user_id))
+            if records:
+                self.index[user_id] = records
+                self.sizes[user_id] = size
+            else:
+                os.remove(self._path(user_id))
+        self.expire()
+
+    @staticmethod
+    def _scan(path):
+        records = []
+        offset = 0
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                stored_at, length = RECORD.unpack(header)
+                if len(f.read(length)) < length:
+                    break
+                records.append((offset + RECORD.size, length, stored_at))
+                offset += RECORD.size + length
+        if offset != os.path.getsize(path):
+            # Drop a record that was only partially written.
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        return records, offset
+
+    def _file_lock(self, user_id):
+        return self._file_locks[user_id % len(self._file_locks)]
+
+    def append(self, user_id, data, length=None):
+        """
+        Spools a message for user_id. Returns False if it's over the limit,
+        after the user's messages older than max_age were dropped.
+        With length given, data is an iterable of the message's parts.
+        """
+        if length is None:
+            data, length = (data,), len(data)
+        with self._file_lock(user_id):
+            self._expire_user(user_id, time.time() - self.max_age)
+            with self._lock:
+                size = self.sizes.get(user_id, 0)
+            if size + RECORD.size + length > self.max_bytes_per_user:
+                return False
+            stored_at = time.time()
+            with open(self._path(user_id), "ab") as f:
+                f.write(RECORD.pack(stored_at, length))
+                for part in data:
+                    f.write(part)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            with self._lock:
+                self.index.setdefault(user_id, []).append(
+                    (size + RECORD.size, length, stored_at)
+                )
+                self.sizes[user_id] = size + RECORD.size + length
+        return True
+
+    def pending(self, user_id):
+        return len(self.index.get(user_id, ()))
+
+    def deliver(self, user_id, send):
+        """
+        Hands the messages spooled for user_id to `send`, joined into batches
+        of up to batch_size bytes, and removes the ones it took from the
+        spool. `send` returns False for a batch it couldn't take, the batch
+        and everything after it stay spooled. Returns the number of messages
+        delivered.
+        """
+        with self._file_lock(user_id), self._lock:
+            if user_id in self._delivering:
+                return 0
+            records = list(self.index.get(user_id, ()))
+            if not records:
+                return 0
+            self._delivering.add(user_id)
+        oldest = time.time() - self.max_age
+        delivered = 0
+        # The first done records were sent, or expired, and can be removed.
+        done = 0
+        try:
+            batch = []
+            batch_len = 0
+            # Only appended to meanwhile, nothing rewrites it while the user
+            # is in _delivering.
+            with open(self._path(user_id), "rb") as f:
+                for position, (offset, length, stored_at) in enumerate(records):
+                    if stored_at >= oldest:
+                        f.seek(offset)
+                        batch.append(f.read(length))
+                        batch_len += length
+                    if batch_len >= self.batch_size or position == len(records) - 1:
+                        if batch and not send(b"".join(batch)):
+                            break
+                        delivered += len(batch)
+                        done = position + 1
+                        batch = []
+                        batch_len = 0
+        finally:
+            with self._file_lock(user_id):
+                with self._lock:
+                    self._delivering.discard(user_id)
+                    records = self.index[user_id][done:]
+                if done:
+                    self._replace(user_id, records)
+        return delivered
+
+    def _replace(self, user_id, records):
+        """
+        Rewrites the user's file with only the given records, or removes it
+        if there are none. Called with the user's file lock held.
+        """
+        path = self._path(user_id)
+        if not records:
+            with self._lock:
+                del self.index[user_id]
+                del self.sizes[user_id]
+            os.remove(path)
+            return
+        with open(path, "rb") as f:
+            messages = []
+            for offset, length, stored_at in records:
+                f.seek(offset)
+                messages.append((stored_at, f.read(length)))
+        with open(path + ".tmp", "wb") as f:
+            for stored_at, message in messages:
+                f.write(RECORD.pack(stored_at, len(message)))
+                f.write(message)
+        os.replace(path + ".tmp", path)
+        records, size = self._scan(path)
+        with self._lock:
+            self.index[user_id], self.sizes[user_id] = records, size
+
+    def _expire_user(self, user_id, oldest):
+        """Drops a user's messages stored before oldest, see _replace()."""
+        with self._lock:
+            records = self.index.get(user_id)
+            if not records or records[0][2] >= oldest:
+                return
+            if user_id in self._delivering:
+                # deliver() skips them, and the offsets must stay put.
+                return
+            live = [record for record in records if record[2] >= oldest]
+        self._replace(user_id, live)
+
+    def expire(self):
+        """Drops messages older than max_age from the spool."""
+        oldest = time.time() - self.max_age
+        with self._lock:
+            user_ids = list(self.index)
+        for user_id in user_ids:
+            with self._file_lock(user_id):
+                self._expire_user(user_id, oldest)
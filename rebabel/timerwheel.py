@@ -0,0 +1,90 @@
+import logging
+import math
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class Timer:
+    __slots__ = ("callback", "slot", "rounds")
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.slot = None
+        self.rounds = 0
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel: timers are kept in one of `slots` buckets by their
+    deadline, and each tick only looks at the bucket under the hand. Adding
+    and cancelling a timer is O(1), so is a tick for timers spread evenly
+    over the wheel. Deadlines are rounded up to whole ticks, callbacks run
+    on the wheel's thread and should be quick.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._position = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def schedule(self, delay, callback):
+        """Calls callback() after delay seconds, returns a Timer to cancel."""
+        ticks = max(1, math.ceil(delay / self.tick))
+        timer = Timer(callback)
+        with self._lock:
+            timer.slot = (self._position + ticks) % len(self._slots)
+            timer.rounds = (ticks - 1) // len(self._slots)
+            self._slots[timer.slot].add(timer)
+            self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        with self._lock:
+            if timer.slot is not None and timer in self._slots[timer.slot]:
+                self._slots[timer.slot].discard(timer)
+                self._count -= 1
+            timer.slot = None
+
+    def advance(self):
+        """Moves the hand one tick and runs the timers that are due."""
+        with self._lock:
+            self._position = (self._position + 1) % len(self._slots)
+            bucket = self._slots[self._position]
+            expired = []
+            for timer in bucket:
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    expired.append(timer)
+            bucket.difference_update(expired)
+            self._count -= len(expired)
+            for timer in expired:
+                timer.slot = None
+        for timer in expired:
+            try:
+                timer.callback()
+            except Exception:
+                log.exception("timer callback failed")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="timers", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stopped.wait(max(0.0, next_tick - time.monotonic())):
+            self.advance()
+            next_tick += self.tick
+
+    def __len__(self):
+        return self._count
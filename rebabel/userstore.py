@@ -0,0 +1,284 @@
+import abc
+import hashlib
+import hmac
+import os
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# PBKDF2 parameters used for newly stored passwords. The iteration count is
+# stored next to every hash, so it can be raised later without breaking
+# existing accounts.
+HASH_NAME = "sha256"
+HASH_ITERATIONS = 100000
+SALT_SIZE = 16
+
+
+def hash_password(password, salt=None, iterations=HASH_ITERATIONS):
+    """Returns a (salt, iterations, digest) tuple for the given password."""
+    if salt is None:
+        salt = os.urandom(SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac(
+        HASH_NAME, password.encode("latin-1"), salt, iterations
+    )
+    return salt, iterations, digest
+
+
+def check_password(password, credential):
+    salt, iterations, digest = credential
+    _, _, candidate = hash_password(password, salt=salt, iterations=iterations)
+    return hmac.compare_digest(candidate, digest)
+
+
+class UserStore(abc.ABC):
+    """
+    Interface every user store backend implements.
+    A credential is a (salt, iterations, digest) tuple as returned by
+    `hash_password`, user ids are plain integers.
+    """
+
+    @abc.abstractmethod
+    def get_user_id(self, username):
+        pass
+
+    @abc.abstractmethod
+    def get_username(self, user_id):
+        pass
+
+    @abc.abstractmethod
+    def get_credential(self, username):
+        """Returns (user_id, credential), or None for an unknown username."""
+
+    @abc.abstractmethod
+    def add_user(self, username, password, user_id=None):
+        pass
+
+    @abc.abstractmethod
+    def set_password(self, username, password):
+        pass
+
+    def verify(self, username, password):
+        """Returns the user id if the password matches, None otherwise."""
+        entry = self.get_credential(username)
+        if entry is None:
+            return None
+        user_id, credential = entry
+        return user_id if check_password(password, credential) else None
+
+    def close(self):
+        pass
+
+
+class SQLiteUserStore(UserStore):
+    """
+    A UserStore backed by a local SQLite file. Connections are kept in a
+    small pool, so concurrent lookups don't queue behind a single connection.
+    """
+
+    def __init__(self, path, pool_size=4):
+        self.path = path
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._pool.put(connection)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " id INTEGER PRIMARY KEY,"
+                " username TEXT UNIQUE NOT NULL,"
+                " salt BLOB NOT NULL,"
+                " iterations INTEGER NOT NULL,"
+                " digest BLOB NOT NULL)"
+            )
+
+    def _connection(self):
+        return _PooledConnection(self._pool)
+
+    def get_user_id(self, username):
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT id FROM users WHERE username = ?", (username,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def get_username(self, user_id):
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT username FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def get_credential(self, username):
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT id, salt, iterations, digest FROM users WHERE username = ?",
+                (username,),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], (row[1], row[2], row[3])
+
+    def add_user(self, username, password, user_id=None):
+        salt, iterations, digest = hash_password(password)
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "INSERT INTO users (id, username, salt, iterations, digest)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (user_id, username, salt, iterations, digest),
+            )
+            return cursor.lastrowid
+
+    def set_password(self, username, password):
+        salt, iterations, digest = hash_password(password)
+        with self._connection() as connection:
+            connection.execute(
+                "UPDATE users SET salt = ?, iterations = ?, digest = ?"
+                " WHERE username = ?",
+                (salt, iterations, digest, username),
+            )
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class _PooledConnection:
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __enter__(self):
+        self.connection = self._pool.get()
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self._pool.put(self.connection)
+
+
+class LRUCache:
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                return self._data[key]
+            except KeyError:
+                return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_MISSING = object()
+
+
+class CachedUserStore(UserStore):
+    """
+    Wraps another UserStore with LRU caches for id -> username and
+    username -> credential lookups. Password checks are hashed on a bounded
+    worker pool, so a burst of logins can't occupy every handler thread with
+    PBKDF2 at once.
+    """
+
+    def __init__(self, store, cache_size=4096, hash_workers=4):
+        self.store = store
+        self.usernames = LRUCache(cache_size)
+        self.credentials = LRUCache(cache_size)
+        self._hash_pool = ThreadPoolExecutor(
+            max_workers=hash_workers, thread_name_prefix="password-hash"
+        )
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """callback(user_id) is called whenever a user's profile changes."""
+        self._listeners.append(callback)
+
+    def get_user_id(self, username):
+        entry = self._get_credential_entry(username)
+        return None if entry is None else entry[0]
+
+    def get_username(self, user_id):
+        username = self.usernames.get(user_id, _MISSING)
+        if username is _MISSING:
+            username = self.store.get_username(user_id)
+            self.usernames.put(user_id, username)
+        return username
+
+    def get_credential(self, username):
+        return self._get_credential_entry(username)
+
+    def _get_credential_entry(self, username):
+        entry = self.credentials.get(username, _MISSING)
+        if entry is _MISSING:
+            entry = self.store.get_credential(username)
+            self.credentials.put(username, entry)
+        return entry
+
+    def verify(self, username, password):
+        """UserStore.verify(), hashing on the worker pool."""
+        entry = self._get_credential_entry(username)
+        if entry is None:
+            return None
+        user_id, credential = entry
+        if self._hash_pool.submit(check_password, password, credential).result():
+            return user_id
+        return None
+
+    def add_user(self, username, password, user_id=None):
+        user_id = self.store.add_user(username, password, user_id=user_id)
+        self.invalidate(username=username, user_id=user_id)
+        return user_id
+
+    def set_password(self, username, password):
+        self.store.set_password(username, password)
+        self.invalidate(username=username)
+
+    def invalidate(self, username=None, user_id=None):
+        if username is not None:
+            entry = self.credentials.get(username)
+            self.credentials.invalidate(username)
+            if user_id is None and entry is not None:
+                user_id = entry[0]
+        if user_id is not None:
+            self.usernames.invalidate(user_id)
+            for callback in self._listeners:
+                callback(user_id)
+
+    def clear(self):
+        self.usernames.clear()
+        self.credentials.clear()
+
+    def close(self):
+        self._hash_pool.shutdown(wait=False)
+        self.store.close()
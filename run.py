@@ -1,5 +1,12 @@
+import argparse
 import socket
 import random
+import signal
+import sys
+import threading
+
+from rebabel.capture import CLIENT, SERVER, BackgroundCaptureWriter
+from rebabel.netbabel import MessageReader
 
 echo_load = '40524b28eb000000'
 user_id = (2342).to_bytes(4, byteorder='little').hex()
@@ -11,6 +18,9 @@ server_ehlo = {
     'name': 'ThunderStorm'
 }
 
+# Each direction of a proxied connection is received into a buffer this big.
+PROXY_BUFFER = 256 * 1024
+
 player_database = {
     'ham5ter': {'id': 1337, 'password': "herpderp"},
     'testuser': {'id': 42, 'password': "hurrdurr"},
@@ -86,19 +96,17 @@ def server_program():
     server_socket.listen(2)
     conn, address = server_socket.accept()  # accept new connection
     print("Connection from: " + str(address))
+    reader = MessageReader(conn.recv)
     while True:
-        # receive data stream. it won't accept data packet greater than 1024 bytes
-        data = conn.recv(1024)
-        if not data:
+        # receive one message at a time, however the client's packets were split
+        message = reader.read_message()
+        if message is None:
             print('NODATA')
             break
-        make_bytes_beautifull(data,recv=True)
-        if data[0:4] == bytes.fromhex('25000000'):
-            package_count = int.from_bytes(data[20:24], byteorder='little')
-            username_len = int.from_bytes(data[44:47], byteorder='little') - 1
-            password_len = int.from_bytes(data[48:52], byteorder='little') - 1
-            username = data[52:52 + username_len].decode('latin-1')
-            password = data[52 + username_len + 1:52 + username_len + 1 + password_len].decode('latin-1')
+        make_bytes_beautifull(message.data,recv=True)
+        package_count = message.package_count
+        if message.type == 0x25:
+            username, password = message.credentials
             print("login request received!")
             print("username %s , password %s" % (username, password))
             if username in player_database:
@@ -113,19 +121,17 @@ def server_program():
                 reply = _return_failed_login(package_count)
                 make_bytes_beautifull(bytes.fromhex(reply))
                 conn.send(bytes.fromhex(reply))
-        elif data[0:4] == bytes.fromhex('13000000'):  # NET: ULIN
+        elif message.type == 0x13:  # NET: ULIN
             print("NET: ULIN")
-            requested_user_id = int.from_bytes(data[12:15], byteorder='little')
-            package_count = int.from_bytes(data[20:24], byteorder='little')
+            requested_user_id = message.user_id
             if requested_user_id <= 100:
                 response = bytes.fromhex('1300000000000000000000000000000000000000' + package_count.to_bytes(4,byteorder='little').hex() + '0000000000000000')
             else:
                 response = bytes.fromhex('13000000acc5eed6000000000000000000000000' + package_count.to_bytes(4,byteorder='little').hex() + '000000000a000000')
             make_bytes_beautifull(response)
             conn.send(response)  # Offline Response
-        elif data[0:4] == bytes.fromhex('18000000'):  # NET: STAT
+        elif message.type == 0x18:  # NET: STAT
             print("NET: STAT")
-            package_count = int.from_bytes(data[20:24], byteorder='little')
             bytes_received = (12345).to_bytes(4, byteorder='little').hex()
             bytes_sent = (54321).to_bytes(4, byteorder='little').hex()
             player_online = (0).to_bytes(4, byteorder='little').hex()
@@ -133,18 +139,17 @@ def server_program():
             response = bytes.fromhex('1800000000000000000000000000000000000000' + package_count.to_bytes(4,byteorder='little').hex() + '00000000 00000000' + mil_seconds_online + player_online + bytes_sent + bytes_received)
             make_bytes_beautifull(response)
             conn.send(response)
-        elif data[0:4] == bytes.fromhex('21020000'):  # NET: RUSO
+        elif message.type == 0x0221:  # NET: RUSO
             print('NET: RUSO')
-            package_count = int.from_bytes(data[20:24], byteorder='little')
             reply = '21020000' + echo_load + random.randint(1, 9999).to_bytes(4,byteorder='little').hex() + '01000a00' + package_count.to_bytes(4, byteorder='little').hex() + '0000000001000000'
             print("> " + reply)
             conn.send(bytes.fromhex(reply))
             conn.send(bytes.fromhex(
                 '0900000000000000000000000000000000000000000000005600000000000000560000000100cccc1b0000003e00000000000000010000000c0000000100000000000000130000006164645f746f5f636f6e746163745f626f6f6ba40900000200000007000000313431312b31300200000000000000'))
-        elif data[0:4] == bytes.fromhex('0f000000'):  # NET: UNIK
-            package_count = int.from_bytes(data[20:24], byteorder='little')
+        elif message.type == 0x0f:  # NET: UNIK
             print('NET: UNIK')
-            user_id = int.from_bytes(data[12:16], byteorder='little')
+            user_id = message.user_id
+            user_id_hex = user_id.to_bytes(4, byteorder='little').hex()
             username = 'wonbato'
             if user_id == 1337:
                 username = 'ham5ter'
@@ -152,18 +157,100 @@ def server_program():
                 username = 'herpidy'
             if user_id == 42:
                 username = 'derpidy'
-            reply = '0f000000' + echo_load + data[12:16].hex() + '0b000000' + package_count.to_bytes(4,byteorder='little').hex() + '290000000000000029000000' + data[12:16].hex() + '0b00cccc05000000050000000700000048617070794d65696c69' + username.encode(
+            reply = '0f000000' + echo_load + user_id_hex + '0b000000' + package_count.to_bytes(4,byteorder='little').hex() + '290000000000000029000000' + user_id_hex + '0b00cccc05000000050000000700000048617070794d65696c69' + username.encode(
                 'latin-1').hex()
             print("> " + reply)
             conn.send(bytes.fromhex(reply))
-        elif data[0:4] in [bytes.fromhex('1e000000'), bytes.fromhex('14000000'),
-                           bytes.fromhex('1f000000')]:  # NET: WRIT
+        elif message.type in [0x1e, 0x14, 0x1f]:  # NET: WRIT
             print("ECHO---LOL")
-            conn.send(data)
+            conn.send(message.data)
         else:
-            print("# unknown # " + data.hex())
+            print("# unknown # " + message.data.hex())
     conn.close()
 
 
+def pump(source, destination, session, direction, capture):
+    """Forwards what source receives to destination until either side closes."""
+    buffer = bytearray(PROXY_BUFFER)
+    view = memoryview(buffer)
+    try:
+        while True:
+            count = source.recv_into(buffer)
+            if not count:
+                break
+            destination.sendall(view[:count])
+            if capture is not None:
+                capture.write(session, direction, view[:count])
+    except OSError:
+        pass
+    # Wake up the pump going the other way.
+    for sock in (source, destination):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def proxy_connection(conn, address, upstream, capture):
+    try:
+        upstream_conn = socket.create_connection(upstream)
+    except OSError as e:
+        print('Upstream %s:%s not reachable: %s' % (upstream + (e,)))
+        conn.close()
+        return
+    session = capture.session() if capture is not None else None
+    print('Connection from: %s, session %s' % (address, session))
+    for sock in (conn, upstream_conn):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    downstream = threading.Thread(
+        target=pump, args=(upstream_conn, conn, session, SERVER, capture), daemon=True
+    )
+    downstream.start()
+    pump(conn, upstream_conn, session, CLIENT, capture)
+    downstream.join()
+    conn.close()
+    upstream_conn.close()
+    print('Session %s closed' % session)
+
+
+def proxy_program(upstream, port=1337, capture_path=None):
+    """
+    Relays every client connecting to port to the NetBabel server at upstream,
+    recording both directions to capture_path (see rebabel.capture) on the side.
+    """
+    capture = None
+    if capture_path is not None:
+        capture = BackgroundCaptureWriter(capture_path)
+    server_socket = socket.socket()
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(("0.0.0.0", port))
+    server_socket.listen(16)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Proxying port %s to %s:%s' % ((port,) + upstream))
+    try:
+        while True:
+            conn, address = server_socket.accept()
+            threading.Thread(
+                target=proxy_connection,
+                args=(conn, address, upstream, capture),
+                daemon=True,
+            ).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server_socket.close()
+        if capture is not None:
+            capture.close()
+
+
 if __name__ == '__main__':
-    server_program()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--proxy', metavar='HOST:PORT', help='relay to this server instead of answering')
+    parser.add_argument('--port', type=int, default=1337)
+    parser.add_argument('--capture', help='record proxied sessions to this file')
+    arguments = parser.parse_args()
+    if arguments.proxy is None:
+        server_program()
+    else:
+        host, port = arguments.proxy.rsplit(':', 1)
+        proxy_program((host, int(port)), arguments.port, arguments.capture)
@@ -1,18 +1,49 @@
+import argparse
+import logging
+import os
 import random
+import signal
+import socket
 import socketserver
+import sys
 from socket import SHUT_RDWR
 import threading
 from threading import Thread
+import time
+import tracemalloc
 
 from prayer.prayer import Pray
 from prayer.blocks import TagBlock
+from rebabel.admin import AdminError, AdminServer
+from rebabel.capture import CLIENT, SERVER, CaptureWriter
+from rebabel.cluster import ClusterClient, fork_workers
+from rebabel.history import HistoryStore
+from rebabel.memory import Assembly, MemoryBudget
+from rebabel.metrics import Metrics, message_name, serve_metrics
+from rebabel.netbabel import (
+    PRAY_DATA_OFFSET,
+    MessageReader,
+    describe_pray,
+    pray_data,
+    pray_filename,
+    server_frame_length,
+)
+from rebabel.outbound import OutboundQueue
+from rebabel.profiler import SamplingProfiler
+from rebabel.presence import StatusReplyCache, WatchIndex, with_package_count
+from rebabel.protolog import hex_dump, log, log_message, setup_logging, trace_dump
+from rebabel.ratelimit import RateLimiter
+from rebabel.recompress import Recompressor
+from rebabel.sessions import SessionTokens
+from rebabel.spool import Spool
+from rebabel.timerwheel import TimerWheel
+from rebabel.userstore import CachedUserStore, SQLiteUserStore
 
 
-echo_load = "40524b28eb000000"
-
 server_ehlo = {"host": "192.168.0.61", "port": 1337, "name": "ThunderStorm"}
 
-player_database = {
+# Accounts created the first time the user database is set up.
+default_players = {
     "alice": {"id": 123, "password": "alice"},
     "bob": {"id": 234, "password": "bob"},
     "ham5ter": {"id": 1337, "password": "notsecure"},
@@ -20,25 +51,258 @@ player_database = {
     "nac9tar": {"id": 364, "password": "notsecure"},
 }
 
+USER_DATABASE = "rebabel.db"
+user_store = None
+
+# Limits for each connection's outbound queue, see rebabel.outbound.
+# Replies and other messages up to bulk_threshold bytes go out ahead of
+# longer ones, like big PRAYs, between their messages.
+OUTBOUND_OPTIONS = {
+    "high_watermark": 4 * 1024 * 1024,
+    "low_watermark": 1024 * 1024,
+    "policy": "disconnect",
+    "block_timeout": 5.0,
+    "bulk_threshold": 16 * 1024,
+    "chunk_size": 64 * 1024,
+}
+
+# Messages for offline users are kept here until they log in.
+SPOOL_DIRECTORY = "./spool"
+SPOOL_OPTIONS = {
+    "max_bytes_per_user": 16 * 1024 * 1024,
+    "max_age": 7 * 24 * 60 * 60,
+    "batch_size": 256 * 1024,
+}
+spool = None
+
+# CREA HIST packages are kept here, indexed by creature moniker and user.
+# Cluster workers keep theirs in HISTORY_DIRECTORY/<worker index>.
+HISTORY_DIRECTORY = "./history"
+HISTORY_OPTIONS = {"max_pending": 4096, "batch_size": 512}
+history = None
+
+# Set METRICS_PORT to serve Prometheus metrics on http://127.0.0.1:<port>/metrics
+METRICS_PORT = None
+metrics = Metrics()
+# Switched on and off with the console's profile command.
+profiler = SamplingProfiler(interval=0.005)
+
+# Per message type levels are set in rebabel.protolog.message_levels.
+# PROTOCOL_TRACE enables sampled hex dumps of the traffic.
+LOG_LEVEL = logging.INFO
+PROTOCOL_TRACE = False
+
+# With more than one worker, each worker process accepts connections on the
+# same port (SO_REUSEPORT) and they share presence and PRAY routing through
+# a hub on the CLUSTER_BUS Unix socket.
+WORKERS = 1
+CLUSTER_BUS = "./rebabel-bus.sock"
+cluster = None
+
+# Connections are closed after LOGIN_TIMEOUT seconds without a login and
+# after IDLE_TIMEOUT seconds without receiving anything once logged in.
+# None disables the timeout. TCP keepalive probes find dead peers sooner.
+LOGIN_TIMEOUT = 30
+IDLE_TIMEOUT = 15 * 60
+TCP_KEEPALIVE = {"idle": 60, "interval": 15, "count": 4}
+timer_wheel = TimerWheel(tick=1.0)
+
+# A connection hears about the status changes of the last MAX_WATCHES users
+# it asked the status of, None for no limit.
+MAX_WATCHES = 256
+
+# Token bucket limits per message class, for each user and for the whole
+# server: (tokens per second, burst). PRAY costs its size in bytes, every
+# other message 1. See rebabel.ratelimit for the actions. Queries are never
+# dropped, no reply tells a client it is over a limit: one is answered
+# after it waited max_delay. A dropped CREA HIST is still acknowledged.
+# Generous enough for rebabel.replay and rebabel.loadgen at full speed.
+RATE_LIMITS = {
+    "pray": {
+        "user": (256 * 1024, 8 * 1024 * 1024),
+        "global": (16 * 1024 * 1024, 64 * 1024 * 1024),
+        "action": "queue",
+        "max_delay": 10.0,
+    },
+    "query": {
+        "user": (500, 2000),
+        "global": (50000, 100000),
+        "action": "queue",
+        "max_delay": 2.0,
+    },
+    "history": {"user": (50, 1000), "action": "drop"},
+}
+MESSAGE_CLASSES = {
+    0x09: "pray",
+    0x0F: "query",  # NET: UNIK
+    0x10: "query",  # User status
+    0x13: "query",  # NET: ULIN
+    0x18: "query",  # NET: STAT
+    0x0221: "query",  # NET: RUSO
+    0x0321: "history",  # CREA HIST
+}
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+# Set CAPTURE_FILE to record every session for `python -m rebabel.replay`.
+# Cluster workers write to CAPTURE_FILE.<worker index>.
+CAPTURE_FILE = None
+capture = None
+
+# Every session gets its own echo load at login. A client that reconnects
+# with it within SESSION_RESUME_TTL seconds is let in without a password
+# check.
+SESSION_RESUME_TTL = 10 * 60
+session_tokens = SessionTokens(ttl=SESSION_RESUME_TTL)
+
+# Replies to ULIN only differ in the echo load and package counter, which
+# are patched in.
+ULIN_ONLINE_REPLY = bytes.fromhex(
+    "13000000"
+    "0000000000000000"  # echo load
+    "0000000000000000"
+    "00000000"  # package counter
+    "00000000"
+    "0a000000"
+)
+ULIN_OFFLINE_REPLY = bytes.fromhex("13000000") + bytes(28)
+
+# PRAY messages at least CUT_THROUGH_THRESHOLD bytes long are forwarded to a
+# recipient on this server as they arrive, with at most PRAY_STREAM_BUFFER
+# bytes of each one held in memory. Others are received in full first.
+# Other messages that long are skipped.
+CUT_THROUGH_THRESHOLD = 64 * 1024
+PRAY_STREAM_BUFFER = 256 * 1024
+PRAY_CHUNK_SIZE = 64 * 1024
+
+# Messages claiming to be longer than MAX_MESSAGE_LENGTH close the sender's
+# connection. The outbound queues and PRAY assemblies of all connections
+# hold at most MEMORY_LIMIT bytes together, assemblies longer than
+# PRAY_SPILL_THRESHOLD go to temporary files in SPILL_DIRECTORY (None for
+# the system default).
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+MEMORY_LIMIT = 256 * 1024 * 1024
+PRAY_SPILL_THRESHOLD = 1024 * 1024
+SPILL_DIRECTORY = None
+memory = MemoryBudget(MEMORY_LIMIT)
+
+# Uncompressed PRAY blocks of at least RECOMPRESS_THRESHOLD bytes are
+# compressed before they are relayed if that makes them RECOMPRESS_MIN_SAVING
+# smaller, by RECOMPRESS_WORKERS threads compressing at most
+# RECOMPRESS_MAX_RATE bytes per second. None switches it off. PRAYs streamed
+# to their recipient (see CUT_THROUGH_THRESHOLD) or spilled to disk are
+# relayed as they are.
+RECOMPRESS_THRESHOLD = 16 * 1024
+RECOMPRESS_MIN_SAVING = 0.2
+RECOMPRESS_WORKERS = 2
+RECOMPRESS_MAX_RATE = 32 * 1024 * 1024
+recompressor = None
+if RECOMPRESS_THRESHOLD is not None:
+    recompressor = Recompressor(
+        RECOMPRESS_THRESHOLD,
+        RECOMPRESS_MIN_SAVING,
+        workers=RECOMPRESS_WORKERS,
+        max_rate=RECOMPRESS_MAX_RATE,
+    )
+
+# Set ADMIN_SOCKET to serve the JSON admin API (rebabel.admin) on a Unix
+# socket. Cluster workers listen on ADMIN_SOCKET.<worker index>.
+ADMIN_SOCKET = "./rebabel-admin.sock"
+# Set by the drain admin command, new connections are turned away.
+draining = False
+
 addrs = {}
 requests = {}
 threads = {}
+# Held while sessions are added to or removed from requests. Iterate over
+# sessions() rather than requests.
+requests_lock = threading.Lock()
+
+
+def sessions():
+    """A snapshot of the sessions on this server."""
+    with requests_lock:
+        return list(requests.values())
 
 
 def make_bytes_beautifull(payload, color_code="\033[96m"):
-    pairs = [payload[i : i + 16] for i in range(0, len(payload), 16)]
-    print(color_code)
-    print("     0  1  2  3  4  5  6  7  8  9  A  B  C  D  E  F")
-    print("    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+")
-    for i, pair in enumerate(pairs):
-        bytes = [pair[i : i + 1] for i in range(0, len(pair), 1)]
-        print(" %02x " % i, end="")
-        for byte in bytes:
-            print("|%s" % byte.hex(), end="")
-        print("|")
-        print("   ", "+--" * len(pair), end="")
-        print("+")
-    print("\033[00m")
+    print(hex_dump(payload, color_code))
+
+
+def print_latency(message_type=None):
+    """Reply latency per message type, or the histogram of one type."""
+    if message_type is None:
+        print(f"{'type':<12} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for message_type, histogram in sorted(metrics.latency.items()):
+            print(
+                f"{message_name(message_type):<12} {histogram.count:>8}"
+                f" {histogram.percentile(0.5) * 1000:>9.2f}"
+                f" {histogram.percentile(0.99) * 1000:>9.2f}"
+                f" {histogram.max * 1000:>9.2f}"
+            )
+        return
+    histogram = metrics.latency.get(message_type)
+    if histogram is None or not histogram.count:
+        print("no replies yet")
+        return
+    widest = max(histogram.counts)
+    bounds = [f"<= {bound * 1000:g} ms" for bound in histogram.buckets] + ["more"]
+    for bound, count in zip(bounds, histogram.counts):
+        print(f"{bound:>13} {count:>8} {'#' * round(40 * count / widest)}")
+
+
+def print_memory(count=10):
+    """Bytes held for messages in flight, overall and by connection."""
+    figures = memory.snapshot()
+    limit = "none" if figures["limit"] is None else figures["limit"]
+    print(f"total {figures['total']} of {limit}, peak {figures['peak']}")
+    for category, held in sorted(figures["held"].items()):
+        refused = figures["refused"].get(category, 0)
+        print(f"  {category:<10} {held:>12} held, {refused} refused")
+    connections = []
+    for session in sessions():
+        received = session.reader.buffered if session.reader is not None else 0
+        assembly = session.assembly
+        connections.append(
+            (
+                received,
+                assembly.in_memory if assembly is not None else 0,
+                assembly.size if assembly is not None else 0,
+                session.outbound.queued_bytes,
+                session.user_id,
+            )
+        )
+    connections.sort(key=lambda row: row[0] + row[1] + row[3], reverse=True)
+    print(
+        f"{'user':<12} {'receive':>10} {'assembly':>10} {'on disk':>10}"
+        f" {'outbound':>10}"
+    )
+    for received, in_memory, size, queued, user_id in connections[:count]:
+        on_disk = size - in_memory if size > in_memory else 0
+        print(
+            f"{user_id:<12} {received:>10} {in_memory:>10} {on_disk:>10}"
+            f" {queued:>10}"
+        )
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"tracemalloc: {current} bytes now, {peak} at most")
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:count]:
+            print(f"  {stat}")
+
+
+def print_connections(seconds=1.0):
+    """Throughput of every connection over the next `seconds`."""
+    before = {stats: (stats.bytes_in, stats.bytes_out) for stats in metrics.live()}
+    time.sleep(seconds)
+    print(f"{'connection':<24} {'in B/s':>10} {'out B/s':>10} {'queued B':>10}")
+    for stats, (bytes_in, bytes_out) in before.items():
+        session = requests.get(stats.name)
+        queued = session.outbound.queued_bytes if session is not None else 0
+        print(
+            f"{str(stats.name):<24}"
+            f" {(stats.bytes_in - bytes_in) / seconds:>10.0f}"
+            f" {(stats.bytes_out - bytes_out) / seconds:>10.0f}"
+            f" {queued:>10}"
+        )
 
 
 class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
@@ -49,226 +313,504 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
     client.
     """
 
+    def setup(self):
+        self.stats = metrics.connection(self.client_address)
+        self.capture_session = None
+        if capture is not None:
+            self.capture_session = capture.session()
+        self.user_id = None
+        self.reader = None
+        self.assembly = None
+        self.last_activity = time.monotonic()
+        self.idle_timer = None
+        if TCP_KEEPALIVE is not None:
+            set_keepalive(self.request, **TCP_KEEPALIVE)
+        self.schedule_idle_check(LOGIN_TIMEOUT)
+
+    def finish(self):
+        self.last_activity = None
+        if self.idle_timer is not None:
+            timer_wheel.cancel(self.idle_timer)
+        metrics.close(self.stats)
+
+    def schedule_idle_check(self, delay):
+        if delay is not None:
+            self.idle_timer = timer_wheel.schedule(delay, self.idle_check)
+
+    def idle_check(self):
+        """Runs on the timer wheel, closes the connection if it went quiet."""
+        timeout = LOGIN_TIMEOUT if self.user_id is None else IDLE_TIMEOUT
+        last_activity = self.last_activity
+        if timeout is None or last_activity is None:
+            return
+        idle = time.monotonic() - last_activity
+        if idle < timeout:
+            self.schedule_idle_check(timeout - idle)
+            return
+        log.info("%s> idle for %.0fs, disconnecting", self.stats.name, idle)
+        self.disconnect()
+
+    def disconnect(self):
+        """Closes the connection from any thread, handle() then returns."""
+        try:
+            self.request.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def receive(self, size):
+        data = self.request.recv(size)
+        self.last_activity = time.monotonic()
+        self.stats.received(data)
+        if self.capture_session is not None and data:
+            capture.write(self.capture_session, CLIENT, data)
+        return data
+
+    def sent(self, data):
+        if self.capture_session is not None:
+            capture.write(self.capture_session, SERVER, data)
+
     def handle(self):
-        data = self.request.recv(1024)
-        if data[0:4] == bytes.fromhex("25000000"):
-            reply, self.user_id = net_line_reply_package(data)
-            self.request.sendall(reply)
-            if self.user_id is not None:
-                self.session_run = True
-            else:
+        if draining:
+            log.info("%s> draining, connection refused", self.stats.name)
+            return
+        self.reader = MessageReader(self.receive)
+        message = self.reader.read_message(max_length=1024)
+        if message is not None and message.type == 0x25 and message.complete:
+            self.stats.received_message(0x25)
+            reply, self.user_id = net_line_reply_package(message)
+            if self.user_id is None:
+                self.request.sendall(reply)
+                self.stats.sent(reply)
+                self.sent(reply)
                 return
+            self.session_run = True
         else:
-            print(f"Whatever that was, It was not a 'NET: LINE' Request! Bye Bye! ;)")
+            log.info("Whatever that was, It was not a 'NET: LINE' Request! Bye Bye! ;)")
             return
-        requests[self.user_id] = self
-        threads[self.user_id] = threading.current_thread()
-        while self.session_run:
-            try:
-                data = self.request.recv(102400)
-            except ConnectionResetError as exception:
-                print(f"{self.user_id} BREAK, {exception}")
-                break
-            if not data:
-                print(f"{self.user_id} BREAK, NODATA")
-                break
-            if data[0:4].hex() in [
-                "13000000",
-                "18000000",
-                "21020000",
-                "21030000",
-                "0f000000",
-                "10000000",
-                "09000000",
-            ]:
-                pass
+        self.stats.name = self.user_id
+        self.echo_load = reply[4:12]
+        if IDLE_TIMEOUT is not None and LOGIN_TIMEOUT is None:
+            self.schedule_idle_check(IDLE_TIMEOUT)
+        self.outbound = OutboundQueue(
+            self.request,
+            name=self.user_id,
+            stats=self.stats,
+            tap=self.sent if self.capture_session is not None else None,
+            latency=metrics.observe_latency,
+            memory=memory,
+            frame_length=server_frame_length,
+            **OUTBOUND_OPTIONS,
+        )
+        # Queued first, so the login reply goes out ahead of whatever is sent
+        # to the user once they are in requests.
+        self.outbound.put(reply, block=True)
+        try:
+            with requests_lock:
+                requests[self.user_id] = self
+                threads[self.user_id] = threading.current_thread()
+            presence_changed(self.user_id)
+            if cluster is not None:
+                # The hub sends the user's spooled messages once it knows of them.
+                cluster.online(self.user_id)
             else:
-                print(f"{self.user_id}> \033[91m{data.hex()}\033[00m")
-            if data[0:4] == bytes.fromhex("13000000"):  # NET: ULIN
-                reply, ulin_user_id, ulin_online_status = net_ulin_reply_package(data)
-                print(
-                    f"{self.user_id}> NET: ULIN, User Online status request for UserID {ulin_user_id}, user online status: {ulin_online_status}."
-                )
-                self.request.sendall(reply)
-            elif data[0:4] == bytes.fromhex("18000000"):  # NET: STAT
-                reply = net_stat_reply_package(data)
-                print(f"{self.user_id}> NET: STAT, Request.")
-                self.request.sendall(reply)
-            elif data[0:4] == bytes.fromhex("21020000"):  # NET: RUSO
-                reply, random_user_id, random_user_hid = net_ruso_reply_package(data)
-                print(
-                    f"{self.user_id}> NET: RUSO, Requested Random online UserID, got: {random_user_id}+{random_user_hid}"
-                )
-                self.request.sendall(bytes.fromhex(reply))
-            elif data[0:4] == bytes.fromhex("0f000000"):  # NET: UNIK
-                (
-                    reply,
-                    unik_username,
-                    unik_user_id,
-                    unik_user_hid,
-                ) = net_unik_reply_package(data)
-                print(
-                    f"{self.user_id}> NET: UNIK, Requested screenname of UserID: {unik_user_id}+{unik_user_hid}: {unik_username}"
-                )
-                self.request.sendall(bytes.fromhex(reply))
-            elif data[0:4] == bytes.fromhex("10000000"):
-                user_id = int.from_bytes(data[12:16], byteorder="little")
-                user_hid = int.from_bytes(data[16:18], byteorder="little")
-                reply, user_status_online_status = user_status_package(
-                    user_id=user_id, user_hid=user_hid
-                )
-                print(
-                    f"{self.user_id}> USER_STATUS, Requested User online status of UserID: {user_id}+{user_hid}:  user online status: {user_status_online_status}."
+                delivered = spool.deliver(
+                    self.user_id, lambda batch: self.outbound.put(batch, block=True)
                 )
-                self.request.sendall(bytes.fromhex(reply))
-            elif data[0:4] == bytes.fromhex("21030000"):
-                self.request.sendall(data[0:24] + bytes.fromhex("0000000000000000"))
-                print(
-                    f"{self.user_id}> CREA HIST, Acknowledged a Creatures History package."
-                )
-            elif data[0:4] == bytes.fromhex("09000000"):  # PRAY Data :shrug:
-
-                raw_pray = data[76:]
-                pld_len = int.from_bytes(data[24:28], byteorder="little")
-                print(f"{self.user_id}> PRAY incomming, pld_len: {pld_len}")
-                moep = True
-                if pld_len == len(data[32:]) - 8:
-                    print(f"{self.user_id}>   SMALL PRAY, All good :D")
-                    moep = False
-                else:
-                    print(f"{self.user_id}>   BIG PRAY, assembling chunks.. ")
-                while moep:
-                    tmp = self.request.recv(1024)
-                    if not tmp:
-                        print(f"{self.user_id}> ERROR: PRAY CONN BROKE!!!!")
-                        moep = False
-                    raw_pray = raw_pray + tmp
-                    data = data[:76] + raw_pray
-                    if pld_len == len(data[32:]) - 8:
-                        moep = False
-                print("")
-                user_id = data[32:36]
-                pld_len = 36 + len(raw_pray)
-                reply = (
-                    bytes.fromhex(
-                        f"090000000000000000000000000000000000000000000000{pld_len.to_bytes(4,byteorder='little').hex()}00000000{pld_len.to_bytes(4,byteorder='little').hex()}0100cccc{self.user_id.to_bytes(4,byteorder='little').hex()}{(pld_len - 24).to_bytes(4, byteorder='little').hex()}00000000010000000c0000000000000000000000"
+                if delivered:
+                    log.info(
+                        "%s> delivered %s spooled messages", self.user_id, delivered
+                    )
+                if spool.pending(self.user_id):
+                    log.warning(
+                        "%s> %s spooled messages kept for the next login",
+                        self.user_id,
+                        spool.pending(self.user_id),
                     )
-                    + raw_pray
+            while self.session_run:
+                try:
+                    # PRAY messages from CUT_THROUGH_THRESHOLD bytes on come back
+                    # with only their start received, see relay_pray.
+                    message = self.reader.read_message(
+                        max_length=CUT_THROUGH_THRESHOLD - 1,
+                        prefix_length=PRAY_DATA_OFFSET,
+                    )
+                except ConnectionResetError as exception:
+                    log.info("%s BREAK, %s", self.user_id, exception)
+                    break
+                if message is None:
+                    log.info("%s BREAK, NODATA", self.user_id)
+                    break
+                message_type = message.type
+                # For the reply latency histograms.
+                request = (message_type, self.last_activity)
+                self.stats.received_message(message_type)
+                trace_dump(
+                    message.data, "%s> received", self.user_id, color_code="\033[92m"
                 )
-                print(f"{self.user_id}> PRAY Handled Sucesffully")
-                requests[int.from_bytes(user_id, byteorder="little")].request.sendall(
-                    reply
+                if message_type not in (0x13, 0x18, 0x0221, 0x0321, 0x0F, 0x10, 0x09):
+                    log.info("%s> unknown message %s", self.user_id, message.data.hex())
+                if message.length > MAX_MESSAGE_LENGTH:
+                    log.warning(
+                        "%s> message %#x claims to be %s bytes long, disconnecting",
+                        self.user_id,
+                        message_type,
+                        message.length,
+                    )
+                    break
+                if not message.complete and message_type != 0x09:
+                    log.info(
+                        "%s> skipped %s bytes of message %#x",
+                        self.user_id,
+                        message.length,
+                        message_type,
+                    )
+                    if not self.reader.skip(message.length - len(message.data)):
+                        break
+                    continue
+                message_class = MESSAGE_CLASSES.get(message_type)
+                if message_class is not None:
+                    cost = message.length if message_type == 0x09 else 1
+                    action = rate_limiter.acquire(self.user_id, message_class, cost)
+                    if action == "disconnect":
+                        log.warning(
+                            "%s> over the %s limit, disconnecting",
+                            self.user_id,
+                            message_class,
+                        )
+                        break
+                    if action == "drop" and message_class == "query":
+                        log.debug("%s> over the query limit, late", self.user_id)
+                    elif action == "drop":
+                        log.debug(
+                            "%s> over the %s limit, dropped",
+                            self.user_id,
+                            message_class,
+                        )
+                        remaining = message.length - len(message.data)
+                        if remaining and not self.reader.skip(remaining):
+                            break
+                        if message_type == 0x0321:
+                            # The client waits for the ack all the same.
+                            self.outbound.put(crea_hist_ack(message), request=request)
+                        continue
+                if message_type == 0x13:  # NET: ULIN
+                    reply, ulin_user_id, ulin_online_status = net_ulin_reply_package(
+                        message
+                    )
+                    log_message(
+                        0x13,
+                        "%s> NET: ULIN, User Online status request for UserID %s, user online status: %s.",
+                        self.user_id,
+                        ulin_user_id,
+                        ulin_online_status,
+                    )
+                    self.outbound.put(reply, request=request)
+                elif message_type == 0x18:  # NET: STAT
+                    reply = net_stat_reply_package(message, self.stats)
+                    log_message(0x18, "%s> NET: STAT, Request.", self.user_id)
+                    self.outbound.put(reply, request=request)
+                elif message_type == 0x0221:  # NET: RUSO
+                    reply, random_user_id, random_user_hid = net_ruso_reply_package(
+                        message
+                    )
+                    log_message(
+                        0x0221,
+                        "%s> NET: RUSO, Requested Random online UserID, got: %s+%s",
+                        self.user_id,
+                        random_user_id,
+                        random_user_hid,
+                    )
+                    self.outbound.put(bytes.fromhex(reply), request=request)
+                elif message_type == 0x0F:  # NET: UNIK
+                    (
+                        reply,
+                        unik_username,
+                        unik_user_id,
+                        unik_user_hid,
+                    ) = net_unik_reply_package(message)
+                    log_message(
+                        0x0F,
+                        "%s> NET: UNIK, Requested screenname of UserID: %s+%s: %s",
+                        self.user_id,
+                        unik_user_id,
+                        unik_user_hid,
+                        unik_username,
+                    )
+                    self.outbound.put(bytes.fromhex(reply), request=request)
+                elif message_type == 0x10:
+                    user_id = message.user_id
+                    user_hid = message.user_hid
+                    reply, user_status_online_status = user_status_package(
+                        user_id=user_id, user_hid=user_hid
+                    )
+                    log_message(
+                        0x10,
+                        "%s> USER_STATUS, Requested User online status of UserID: %s+%s:  user online status: %s.",
+                        self.user_id,
+                        user_id,
+                        user_hid,
+                        user_status_online_status,
+                    )
+                    self.outbound.put(reply, request=request)
+                    # NET: WHON asks this too, from then on the client wants to
+                    # hear when the user goes on or offline.
+                    if user_store.get_username(user_id) is not None:
+                        watch_index.watch(self, user_id, limit=MAX_WATCHES)
+                elif message_type == 0x0321:
+                    self.outbound.put(crea_hist_ack(message), request=request)
+                    log_message(
+                        0x0321,
+                        "%s> CREA HIST, Acknowledged a Creatures History package.",
+                        self.user_id,
+                    )
+                    if not history.append(self.user_id, message.data):
+                        log.error("ERROR: history backlog is full, package dropped")
+                elif message_type == 0x09:  # PRAY Data :shrug:
+                    pld_len = message.payload_length
+                    recipient_id = message.recipient_id
+                    log_message(
+                        0x09, "%s> PRAY incomming, pld_len: %s", self.user_id, pld_len
+                    )
+                    if not message.complete:
+                        log.debug("%s>   BIG PRAY, relaying chunks.. ", self.user_id)
+                        self.relay_pray(
+                            recipient_id,
+                            pld_len,
+                            message.raw_pray,
+                            message.length - len(message.data),
+                        )
+                        continue
+                    raw_pray = message.raw_pray
+                    if recompressor is not None:
+                        raw_pray = recompressor.recompress(raw_pray)
+                    reply = pray_package(self.user_id, raw_pray)
+                    log_message(0x09, "%s> PRAY Handled Sucesffully", self.user_id)
+                    deliver(recipient_id, reply, request=request)
+        finally:
+            with requests_lock:
+                # Unless the user logged in again in the meantime.
+                replaced = requests.get(self.user_id) is not self
+                if not replaced:
+                    del requests[self.user_id]
+                    del threads[self.user_id]
+            session_tokens.release(self.echo_load, self.user_id)
+            watch_index.clear(self)
+            presence_changed(self.user_id)
+            self.outbound.close()
+            if cluster is not None and not replaced:
+                cluster.offline(self.user_id)
+            log.info(" removed %s from requests", self.user_id)
+
+    def relay_pray(self, recipient_id, pld_len, raw_pray, remaining):
+        """
+        Forwards a big PRAY to a recipient connected to this server while it
+        is still being received, so neither side holds all of it. Recipients
+        elsewhere get it assembled, on disk once it is past
+        PRAY_SPILL_THRESHOLD, and delivered as usual.
+        """
+        header = pray_reply_header(self.user_id, pld_len)
+        session = requests.get(recipient_id)
+        stream = None
+        if session is not None:
+            stream = session.outbound.stream(
+                len(header) + len(raw_pray) + remaining,
+                max_buffered=PRAY_STREAM_BUFFER,
+            )
+        if stream is None:
+            self.assembly = Assembly(memory, PRAY_SPILL_THRESHOLD, SPILL_DIRECTORY)
+            self.assembly.write(header)
+            self.assembly.write(raw_pray)
+        elif not (stream.write(header) and stream.write(raw_pray)):
+            stream = None
+        try:
+            self.receive_pray(recipient_id, stream, remaining)
+        finally:
+            if stream is not None:
+                # Pads whatever of it didn't arrive, see OutboundStream.abort.
+                stream.abort()
+            if self.assembly is not None:
+                self.assembly.close()
+                self.assembly = None
+
+    def receive_pray(self, recipient_id, stream, remaining):
+        while remaining > 0:
+            try:
+                tmp = self.reader.read(min(remaining, PRAY_CHUNK_SIZE))
+            except OSError as exception:
+                log.info("%s> %s", self.user_id, exception)
+                break
+            if not tmp:
+                break
+            remaining -= len(tmp)
+            if stream is not None:
+                if not stream.write(tmp):
+                    log.info("%s> PRAY recipient went away", self.user_id)
+                    stream = None
+            elif self.assembly is not None:
+                self.assembly.write(tmp)
+        if remaining > 0:
+            log.error("%s> ERROR: PRAY CONN BROKE!!!!", self.user_id)
+            self.session_run = False
+            return
+        log_message(0x09, "%s> PRAY Handled Sucesffully", self.user_id)
+        if self.assembly is not None:
+            if self.assembly.spilled:
+                log.debug(
+                    "%s> PRAY of %s bytes was spilled to disk",
+                    self.user_id,
+                    self.assembly.size,
                 )
+                # Too big to be read back for recompressing, it is copied from
+                # the file to wherever it goes.
+                deliver(recipient_id, self.assembly)
+                return
+            reply = self.assembly.getvalue()
+            if recompressor is not None:
+                raw_pray = pray_data(reply, sent_by_server=True)
+                recompressed = recompressor.recompress(raw_pray)
+                if recompressed is not raw_pray:
+                    reply = pray_package(self.user_id, recompressed)
+            deliver(recipient_id, reply)
 
-        del requests[self.user_id]
-        print(f" removed {self.user_id} from requests")
 
+def set_keepalive(sock, idle, interval, count):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The tuning options are Linux specific.
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
 
-def poke_pray(pray_request_package, sent_by_server=False):
-    what = {
-        "tcp_pld_len": {"t": "print", "d": len(pray_request_package)},
-        "pld_len_no_header": {"t": "print", "d": len(pray_request_package[32:])},
-        "type": {"t": "raw", "d": pray_request_package[0:4]},
-        "echo_load": {"t": "raw", "d": pray_request_package[4:12]},
-        "user_id_01": {"t": "int", "d": pray_request_package[12:16]},
-        "user_hid": {"t": "int", "d": pray_request_package[16:18]},
-        "mystery_01": {"t": "raw", "d": pray_request_package[18:20]},
-        "mystery_02": {"t": "raw", "d": pray_request_package[20:24]},
-        "pld_len_01": {
-            "t": "int",
-            "d": pray_request_package[24:28],
-        },  # Always pld_len_no_header - 8
-        "mystery_03": {
-            "t": "raw",
-            "d": pray_request_package[28:32],
-        },  # The Payload len might occupy 8 Bytes ?
-        # HEADER END
-        "sender_uid": {"t": "int", "d": pray_request_package[32:36]},
-        "sender_hid": {"t": "int", "d": pray_request_package[36:38]},
-        "mystery_04": {"t": "raw", "d": pray_request_package[38:40]},
-        "pld_len_02": {"t": "int", "d": pray_request_package[40:44]},
-        "mystery_12": {"t": "int", "d": pray_request_package[44:48]},
-        "user_id_02": {"t": "int", "d": pray_request_package[48:52]},
-        "pld_len_minus_24_?": {
-            "t": "int",
-            "d": pray_request_package[52:56],
-        },  # SOme Length :shrug:
-        "mystery_07": {"t": "raw", "d": pray_request_package[56:60]},
-        "mystery_08": {"t": "raw", "d": pray_request_package[60:64]},
-        "mystery_09": {"t": "raw", "d": pray_request_package[64:68]},
-        "mystery_10": {"t": "raw", "d": pray_request_package[68:72]},
-        "mystery_11": {"t": "raw", "d": pray_request_package[72:76]},
-        "pray": {"t": "raw", "d": pray_request_package[76:]},
-        "pray_filename": {
-            "t": "str",
-            "d": pray_request_package[76 : 76 + 128]
-            .decode("latin-1")
-            .rstrip("\0")
-            .encode("latin-1"),
-        },
-    }
-    if sent_by_server:
-        what = {
-            "tcp_pld_len": {"t": "print", "d": len(pray_request_package)},
-            "pld_len_no_header": {"t": "print", "d": len(pray_request_package[32:])},
-            "type": {"t": "raw", "d": pray_request_package[0:4]},
-            "echo_load": {"t": "raw", "d": pray_request_package[4:12]},
-            "user_id_01": {"t": "int", "d": pray_request_package[12:16]},
-            "user_hid": {"t": "int", "d": pray_request_package[16:18]},
-            "mystery_01": {"t": "raw", "d": pray_request_package[18:20]},
-            "mystery_02": {"t": "raw", "d": pray_request_package[20:24]},
-            "pld_len_01": {
-                "t": "int",
-                "d": pray_request_package[24:28],
-            },  # Always pld_len_no_header - 8
-            "mystery_03": {
-                "t": "raw",
-                "d": pray_request_package[28:32],
-            },  # The Payload len might occupy 8 Bytes ?
-            # HEADER END
-            "pld_len": {"t": "int", "d": pray_request_package[32:36]},
-            "mystery_04": {"t": "raw", "d": pray_request_package[36:40]},
-            "mystery_12": {"t": "int", "d": pray_request_package[40:44]},
-            "pld_len_minus_24_?": {"t": "int", "d": pray_request_package[44:48]},
-            "mystery_10": {"t": "int", "d": pray_request_package[48:52]},
-            "mystery_06": {
-                "t": "int",
-                "d": pray_request_package[52:56],
-            },  # SOme Length :shrug:
-            "mystery_07": {"t": "raw", "d": pray_request_package[56:60]},
-            "mystery_08": {"t": "raw", "d": pray_request_package[60:64]},
-            "mystery_09": {"t": "raw", "d": pray_request_package[64:68]},
-            "pray": {"t": "raw", "d": pray_request_package[68:]},
-            "pray_filename": {
-                "t": "str",
-                "d": pray_request_package[68 : 68 + 128]
-                .decode("latin-1")
-                .rstrip("\0")
-                .encode("latin-1"),
-            },
-        }
-    for key, value in what.items():
-        if value["t"] == "int":
-            print(
-                f"i {key}: {int.from_bytes(value['d'], byteorder='little')} - {value['d'].hex()}"
-            )
-        elif value["t"] == "raw":
-            if len(value["d"]) > 9:
-                print(f"r {key}: {value['d'][:8].hex()}... {len(value['d'])}")
-            else:
-                print(f"r {key}: {value['d'].hex()} {len(value['d'])}")
-        elif value["t"] == "str":
-            print(f"s {key}: '{value['d'].decode('latin-1')}' - {value['d'].hex()}")
+
+def pray_reply_header(sender_id, pld_len):
+    """The 68 bytes in front of the raw PRAY data relayed to a recipient."""
+    return bytes.fromhex(
+        f"090000000000000000000000000000000000000000000000{pld_len.to_bytes(4,byteorder='little').hex()}00000000{pld_len.to_bytes(4,byteorder='little').hex()}0100cccc{sender_id.to_bytes(4,byteorder='little').hex()}{(pld_len - 24).to_bytes(4, byteorder='little').hex()}00000000010000000c0000000000000000000000"
+    )
+
+
+def pray_package(sender_id, raw_pray):
+    """
+    A PRAY message as it is relayed. Nothing in it depends on the recipient,
+    so one encoded message can be sent to any number of users.
+    """
+    return pray_reply_header(sender_id, 36 + len(raw_pray)) + raw_pray
+
+
+def fan_out(user_ids, data):
+    """
+    Sends the same message to many users. data is queued as is for every
+    connection, and users on other workers cost one bus message per worker.
+    """
+    remote = []
+    for user_id in user_ids:
+        session = requests.get(user_id)
+        if session is not None and not session.outbound.closed:
+            session.outbound.put(data)
+        elif cluster is not None and user_store.get_username(user_id) is not None:
+            remote.append(user_id)
         else:
-            print(f"e {key}: {value['d']}")
-    with open(
-        f"./poke_pray/{what['pray_filename']['d'].decode('latin-1')}.pray", "wb"
-    ) as f:
-        f.write(what["pray"]["d"])
+            deliver(user_id, data)
+    if remote:
+        cluster.fan_out(remote, data)
+
+
+def deliver(user_id, data, request=None):
+    """
+    Sends data to a user, or spools it if they are offline or their outbound
+    queue refused it. data can also be an Assembly, which is copied over in
+    parts. request is passed on to OutboundQueue.put() for a user on this
+    server.
+    """
+    session = requests.get(user_id)
+    if session is not None:
+        if put_message(session.outbound, data, request):
+            return True
+        log.warning("%s> outbound queue refused a message, spooling it", user_id)
+    elif user_store.get_username(user_id) is None:
+        log.error("ERROR: message for unknown user %s dropped", user_id)
+        return False
+    elif cluster is not None:
+        cluster.relay(user_id, *message_parts(data))
+        return True
+    if cluster is not None:
+        # The hub keeps the spool.
+        cluster.spool(user_id, *message_parts(data))
+        return True
+    if not spool.append(user_id, *message_parts(data)):
+        log.error("ERROR: spool for %s is full, message dropped", user_id)
+        return False
+    log.info("message for %s spooled", user_id)
+    return True
+
+
+def message_parts(data):
+    """The arguments for Spool.append() and the cluster's relay() and spool()."""
+    if isinstance(data, Assembly):
+        return data.chunks(PRAY_CHUNK_SIZE), data.size
+    return (data,)
+
+
+def put_message(outbound, data, request=None):
+    """
+    Queues data, or the message in an Assembly, on an OutboundQueue. Returns
+    False if it was not queued.
+    """
+    if not isinstance(data, Assembly):
+        return outbound.put(data, request=request)
+    stream = outbound.stream(data.size, max_buffered=PRAY_STREAM_BUFFER)
+    if stream is None:
+        return False
+    for chunk in data.chunks(PRAY_CHUNK_SIZE):
+        if not stream.write(chunk):
+            stream.abort()
+            return False
+    return True
+
+
+def deliver_from_cluster(user_id, data):
+    """Called for messages the hub routed to a user on this worker."""
+    session = requests.get(user_id)
+    # This runs on the thread reading the bus, which mustn't wait for one
+    # slow recipient. Spooled backlogs come this way too, what a congested
+    # queue can't take goes back to the spool rather than disconnecting.
+    if session is None or not session.outbound.put(data, policy="drop"):
+        cluster.spool(user_id, data)
+
+
+def user_online(user_id):
+    return user_id in requests or (
+        cluster is not None and user_id in cluster.remote_users
+    )
+
+
+def presence_changed(user_id):
+    """Called when user_id logged in or out, on this or another worker."""
+    status_replies.invalidate(user_id)
+    watchers = watch_index.watchers(user_id)
+    if watchers:
+        reply, online = user_status_package(user_id)
+        for watcher in watchers:
+            if watcher.user_id != user_id:
+                watcher.outbound.put(reply)
+
+
+def online_users():
+    if cluster is None:
+        return list(requests)
+    return list(requests) + list(cluster.remote_users)
+
+
+def poke_pray(pray_request_package, sent_by_server=False):
+    for line in describe_pray(pray_request_package, sent_by_server):
+        print(line)
+    raw_pray = pray_data(pray_request_package, sent_by_server)
+    with open(f"./poke_pray/{pray_filename(raw_pray)}.pray", "wb") as f:
+        f.write(raw_pray)
     pray = None
     try:
         print(f"Praying:")
-        pray = Pray(what["pray"]["d"])
+        pray = Pray(bytes(raw_pray))
         for block in pray.blocks:
             print(f"Block Type: {block.type}\nBlock Name: {block.name}")
             if block.type in ["ICHT", "IMSG", "MESG", "CHAT", "OMSG", "OCHT", "MOEP"]:
@@ -283,36 +825,39 @@ def poke_pray(pray_request_package, sent_by_server=False):
                 print(f"block_data_length: {len(tag_block.block_data)}")
     except Exception as e:
         print(e)
-    return what, pray
-
-
-def net_line_reply_package(line_request_package):
-    package_count = int.from_bytes(line_request_package[20:24], byteorder="little")
-    username_len = int.from_bytes(line_request_package[44:48], byteorder="little")
-    username = line_request_package[52 : 52 + username_len - 1].decode("latin-1")
-    password_len = int.from_bytes(line_request_package[48:52], byteorder="little")
-    password = line_request_package[
-        52 + username_len : 52 + username_len + password_len - 1
-    ].decode("latin-1")
-    user_id = None
-    if (
-        username in player_database
-        and player_database[username]["password"] == password
-    ):
-        user_id = player_database[username]["id"]
+    return pray
+
+
+def net_line_reply_package(message):
+    package_count = message.package_count
+    username, password = message.credentials
+    # A client that was logged in before sends its echo load and user id.
+    user_id = message.user_id
+    token = message.echo_load
+    if user_id and session_tokens.resume(token, user_id):
+        if user_store.get_username(user_id) != username:
+            user_id = None
+    else:
+        user_id = None
+    if user_id is None:
+        user_id = user_store.verify(username, password)
+        if user_id is not None:
+            token = session_tokens.issue(user_id)
+    else:
+        log.debug("%s resumed its session", username)
     user_hid = 1
     if user_id is None:
-        print(f"{username} LOGIN, failed")
+        log.info("%s LOGIN, failed", username)
         return (
             bytes.fromhex(
                 f"0a00000000000000000000000000000000000000{package_count.to_bytes(4,byteorder='little').hex()}000000000000000000000000000000000000000000000000000000000000000000000000"
             ),
             user_id,
         )
-    print(f"{username} has joined!")
+    log.info("%s has joined!", username)
     return (
         bytes.fromhex(
-            f"0a000000{echo_load}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}0a00{package_count.to_bytes(4, byteorder='little').hex()}0000000000000000"
+            f"0a000000{token.hex()}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}0a00{package_count.to_bytes(4, byteorder='little').hex()}0000000000000000"
             + f"00000000"
             + f"01000000"
             + f"00000000"
@@ -333,35 +878,48 @@ def net_line_reply_package(line_request_package):
     )
 
 
-def net_ulin_reply_package(ulin_request_package):
-    requested_user_id = int.from_bytes(ulin_request_package[12:16], byteorder="little")
-    package_count = int.from_bytes(ulin_request_package[20:24], byteorder="little")
-    package_count_hex = package_count.to_bytes(4, byteorder="little").hex()
-    if requested_user_id in requests:
+def crea_hist_ack(message):
+    return bytes(message.data[0:24]) + bytes(8)
+
+
+def net_ulin_reply_package(message):
+    requested_user_id = message.user_id
+    package_count = message.package_count
+    if user_online(requested_user_id):
+        reply = with_package_count(ULIN_ONLINE_REPLY, package_count)
+        reply[4:12] = message.echo_load
         return (
-            bytes.fromhex(
-                f"13000000{echo_load}0000000000000000{package_count_hex}000000000a000000"
-            ),
+            reply,
             requested_user_id,
             True,
         )
     else:
         return (
-            bytes.fromhex(
-                f"1300000000000000000000000000000000000000{package_count_hex}0000000000000000"
-            ),
+            with_package_count(ULIN_OFFLINE_REPLY, package_count),
             requested_user_id,
             False,
         )
 
 
-def net_stat_reply_package(stat_request_package):
-    """This whole thing is a mock, all the date, asside from the Online player count, returned by this is nonsense ;)"""
-    package_count = int.from_bytes(stat_request_package[20:24], byteorder="little")
-    bytes_received = (12345).to_bytes(4, byteorder="little").hex()
-    bytes_sent = (54321).to_bytes(4, byteorder="little").hex()
-    player_online = (len(requests)).to_bytes(4, byteorder="little").hex()
-    mil_seconds_online = (10602856).to_bytes(4, byteorder="little").hex()
+def net_stat_reply_package(message, stats=None):
+    """
+    Reports the time online and the bytes the server received from and sent
+    to the connection `stats` belongs to, or the server wide totals if no
+    stats are given. The client sees bytes_sent as its own bytes received.
+    """
+    package_count = message.package_count
+    if stats is None:
+        totals = metrics.totals()
+        uptime = totals["uptime"]
+        received, sent = totals["bytes_in"], totals["bytes_out"]
+    else:
+        uptime, received, sent = stats.uptime, stats.bytes_in, stats.bytes_out
+    bytes_received = (received & 0xFFFFFFFF).to_bytes(4, byteorder="little").hex()
+    bytes_sent = (sent & 0xFFFFFFFF).to_bytes(4, byteorder="little").hex()
+    player_online = (len(online_users())).to_bytes(4, byteorder="little").hex()
+    mil_seconds_online = (
+        (int(uptime * 1000) & 0xFFFFFFFF).to_bytes(4, byteorder="little").hex()
+    )
     return bytes.fromhex(
         "1800000000000000000000000000000000000000"
         + package_count.to_bytes(4, byteorder="little").hex()
@@ -373,90 +931,259 @@ def net_stat_reply_package(stat_request_package):
     )
 
 
-def net_ruso_reply_package(ruso_request_package):
-    package_count = int.from_bytes(ruso_request_package[20:24], byteorder="little")
-    package_count_hex = package_count.to_bytes(4, byteorder="little").hex()
-    random_user_id = random.choice(list(requests))
+def net_ruso_reply_package(message):
+    random_user_id = random.choice(online_users())
     random_user_hid = 1
     return (
-        f"21020000{echo_load}{random_user_id.to_bytes(4, byteorder='little').hex()}{random_user_hid.to_bytes(2,byteorder='little').hex()}0a00{package_count_hex}0000000001000000",
+        ruso_reply(message, random_user_id, random_user_hid),
         random_user_id,
         random_user_hid,
     )
 
 
-def net_unik_reply_package(unik_request_package):
-    package_count_hex = unik_request_package[20:24].hex()
-    user_id = int.from_bytes(unik_request_package[12:16], byteorder="little")
-    user_id_hex = unik_request_package[12:16].hex()
-    user_hid = int.from_bytes(unik_request_package[16:18], byteorder="little")
-    username = None
-    for name, user in player_database.items():
-        if user["id"] == user_id:
-            username = name
-            username_hex = username.encode("latin-1").hex()
-            username_len_hex = len(username).to_bytes(4, byteorder="little").hex()
-            break
-    payld_len = 34 + len(username)
+def ruso_reply(message, user_id, user_hid):
+    package_count_hex = message.package_count.to_bytes(4, byteorder="little").hex()
+    return f"21020000{message.echo_load.hex()}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}0a00{package_count_hex}0000000001000000"
+
+
+def net_unik_reply_package(message):
+    user_id = message.user_id
+    username = user_store.get_username(user_id)
     if username is None:
-        print(
-            f"ERROR: UNIK Requested User does Not exist!!!!"
-        )  # todo: so what happens if a requested user does not exist.
-    if username is not None:
-        reply = (
-            f"0f000000{echo_load}{user_id_hex}{unik_request_package[16:18].hex()}0000{package_count_hex}{payld_len.to_bytes(4, byteorder='little').hex()}00000000{payld_len.to_bytes(4, byteorder='little').hex()}{user_id_hex}0b00cccc0500000005000000{username_len_hex}48617070794d65696c69{username_hex}",
-            username,
-            user_id,
-            user_hid,
-        )
-    return reply
+        log.error("ERROR: UNIK Requested User does Not exist!!!!")
+        username = ""
+    return unik_reply(message, username), username, user_id, message.user_hid
 
 
-def user_status_package(user_id, user_hid=1):
-    username = None
-    for name, user in player_database.items():
-        if user["id"] == user_id:
-            username = name
-            break
+def unik_reply(message, username):
+    """The client gets an empty screenname for a user that doesn't exist."""
+    package_count_hex = message.package_count.to_bytes(4, byteorder="little").hex()
+    user_id_hex = message.user_id.to_bytes(4, byteorder="little").hex()
+    user_hid = message.user_hid
+    username_hex = username.encode("latin-1").hex()
+    username_len_hex = len(username).to_bytes(4, byteorder="little").hex()
+    payld_len = 34 + len(username)
+    return f"0f000000{message.echo_load.hex()}{user_id_hex}{user_hid.to_bytes(2, byteorder='little').hex()}0000{package_count_hex}{payld_len.to_bytes(4, byteorder='little').hex()}00000000{payld_len.to_bytes(4, byteorder='little').hex()}{user_id_hex}0b00cccc0500000005000000{username_len_hex}48617070794d65696c69{username_hex}"
+
+
+def unknown_user_status(user_id, user_hid=1):
+    """The reply to a user status request for a user that doesn't exist."""
+    username = "ERROR"
+    payld_len = 34 + len(username)
+    return bytes.fromhex(f"0e0000000000000000000000{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2, byteorder='little').hex()}0a0000000000{payld_len.to_bytes(4, byteorder='little').hex()}00000000{payld_len.to_bytes(4, byteorder='little').hex()}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2, byteorder='little').hex()}cccc0500000005000000{len(username).to_bytes(4, byteorder='little').hex()}48617070794d65696c69{username.encode('latin-1').hex()}")
+
+
+def encode_user_status(user_id, user_hid=1):
+    """
+    Builds the reply to a user status request, see status_replies.
+    Returns (reply, online, cacheable).
+    """
+    username = user_store.get_username(user_id)
 
     if not username:
-        username = "ERROR"
-        payld_len = 34 + len(username)
-        print(
-            f"ERROR - user_status_package: A User that is not in the database was requested!"
-        )
-        return (
-            f"0e0000000000000000000000{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2, byteorder='little').hex()}0a0000000000{payld_len.to_bytes(4, byteorder='little').hex()}00000000{payld_len.to_bytes(4, byteorder='little').hex()}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2, byteorder='little').hex()}cccc0500000005000000{len(username).to_bytes(4, byteorder='little').hex()}48617070794d65696c69{username.encode('latin-1').hex()}",
-            False,
+        log.error(
+            "ERROR - user_status_package: A User that is not in the database was requested!"
         )
+        return unknown_user_status(user_id, user_hid), False, False
 
-    print(
-        f"{username} {username.encode('latin-1').hex()} {len(username).to_bytes(4, byteorder='little').hex()} {user_id}+{user_hid}"
-    )
     payld_len = 34 + len(username)
-    if user_id in requests:
+    if user_online(user_id):
         reply, online_status = (
-            f"0d0000000000000000000000{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}000000000000{payld_len.to_bytes(4, byteorder='little').hex()}00000000{payld_len.to_bytes(4, byteorder='little').hex()}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}cccc0500000005000000{len(username).to_bytes(4, byteorder='little').hex()}48617070794d65696c69{username.encode('latin-1').hex()}",
+            bytes.fromhex(f"0d0000000000000000000000{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}000000000000{payld_len.to_bytes(4, byteorder='little').hex()}00000000{payld_len.to_bytes(4, byteorder='little').hex()}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}cccc0500000005000000{len(username).to_bytes(4, byteorder='little').hex()}48617070794d65696c69{username.encode('latin-1').hex()}"),
             True,
         )
-        print(f"{user_id}+{user_hid} is online")
+        log.debug("%s+%s is online", user_id, user_hid)
     else:
         reply, online_status = (
-            f"0e0000000000000000000000{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}0a0000000000{payld_len.to_bytes(4, byteorder='little').hex()}00000000{payld_len.to_bytes(4, byteorder='little').hex()}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}cccc0500000005000000{len(username).to_bytes(4, byteorder='little').hex()}48617070794d65696c69{username.encode('latin-1').hex()}",
+            bytes.fromhex(f"0e0000000000000000000000{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}0a0000000000{payld_len.to_bytes(4, byteorder='little').hex()}00000000{payld_len.to_bytes(4, byteorder='little').hex()}{user_id.to_bytes(4, byteorder='little').hex()}{user_hid.to_bytes(2,byteorder='little').hex()}cccc0500000005000000{len(username).to_bytes(4, byteorder='little').hex()}48617070794d65696c69{username.encode('latin-1').hex()}"),
             False,
         )
-        print(f"{user_id}+{user_hid} is offline")
-    return reply, online_status
+        log.debug("%s+%s is offline", user_id, user_hid)
+    return reply, online_status, True
+
+
+# Invalidated on login, logout and when the user store reports a change.
+status_replies = StatusReplyCache(encode_user_status)
+# Watched user id -> the connections that get pushed their status changes.
+watch_index = WatchIndex()
+
+
+def user_status_package(user_id, user_hid=1):
+    """Returns the cached (reply, online) of a user status request."""
+    return status_replies.get(user_id, user_hid)
+
+
+def admin_sessions():
+    now = time.monotonic()
+    result = []
+    for session in sessions():
+        stats = session.stats
+        last_activity = session.last_activity
+        result.append(
+            {
+                "user_id": session.user_id,
+                "username": user_store.get_username(session.user_id),
+                "address": "%s:%s" % session.client_address[:2],
+                "connected_for": stats.uptime,
+                "idle_for": None if last_activity is None else now - last_activity,
+                "bytes_in": stats.bytes_in,
+                "bytes_out": stats.bytes_out,
+                "messages_in": sum(dict(stats.messages_in).values()),
+                "messages_out": sum(dict(stats.messages_out).values()),
+                "queued_bytes": session.outbound.queued_bytes,
+                "dropped": session.outbound.dropped,
+            }
+        )
+    return result
+
+
+def admin_send(data, user_ids=None):
+    """Sends hex encoded data to user_ids, or to everyone online."""
+    message = bytes.fromhex(data)
+    recipients = online_users() if user_ids is None else [int(u) for u in user_ids]
+    fan_out(recipients, message)
+    return {"recipients": len(recipients), "bytes": len(message)}
+
+
+def admin_kick(user_ids):
+    user_ids = {int(user_id) for user_id in user_ids}
+    kicked = 0
+    for session in sessions():
+        if session.user_id in user_ids:
+            session.disconnect()
+            kicked += 1
+    return {"kicked": kicked}
+
+
+def admin_drain(timeout=30.0):
+    """
+    Turns new connections away, sends what is queued for every session
+    within timeout seconds and closes them.
+    """
+    global draining
+    draining = True
+    deadline = time.monotonic() + timeout
+    drained = sessions()
+    for session in drained:
+        session.outbound.close(
+            flush=True, timeout=max(0.0, deadline - time.monotonic())
+        )
+        session.disconnect()
+    return {"closed": len(drained)}
+
+
+def admin_history(moniker=None, user_id=None, limit=100):
+    """
+    The CREA HIST packages of a creature or of a user, hex encoded, and the
+    monikers found in a user's packages.
+    """
+    if moniker is not None:
+        records = history.creature(moniker, limit)
+        result = {"moniker": moniker}
+    elif user_id is not None:
+        user_id = int(user_id)
+        records = history.user(user_id, limit)
+        result = {"user_id": user_id, "creatures": history.creatures(user_id)}
+    else:
+        raise AdminError("history needs a moniker or a user_id")
+    result["packages"] = [
+        {"stored_at": stored_at, "user_id": sender, "data": data.hex()}
+        for stored_at, sender, data in records
+    ]
+    return result
+
+
+ADMIN_COMMANDS = {
+    "sessions": admin_sessions,
+    "history": admin_history,
+    "send": admin_send,
+    "kick": admin_kick,
+    "drain": admin_drain,
+}
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     pass
 
 
+def open_user_store(path=USER_DATABASE):
+    store = CachedUserStore(SQLiteUserStore(path))
+    store.add_listener(status_replies.invalidate)
+    store.add_listener(session_tokens.revoke_user)
+    for username, user in default_players.items():
+        if store.get_user_id(username) is None:
+            store.add_user(username, user["password"], user_id=user["id"])
+    return store
+
+
+def run_cluster_worker(index, host, port):
+    global user_store, cluster, capture, history
+    setup_logging(LOG_LEVEL, trace=PROTOCOL_TRACE)
+    user_store = open_user_store()
+    history = HistoryStore(
+        os.path.join(HISTORY_DIRECTORY, str(index)), **HISTORY_OPTIONS
+    )
+    if CAPTURE_FILE is not None:
+        capture = CaptureWriter(f"{CAPTURE_FILE}.{index}")
+    timer_wheel.start()
+    cluster = ClusterClient(
+        CLUSTER_BUS,
+        on_relay=deliver_from_cluster,
+        on_presence=presence_changed,
+    )
+    if METRICS_PORT is not None:
+        serve_metrics(metrics, METRICS_PORT + index, online=lambda: len(requests))
+    admin = None
+    if ADMIN_SOCKET is not None:
+        admin = AdminServer(f"{ADMIN_SOCKET}.{index}", ADMIN_COMMANDS)
+        admin.start()
+    ThreadedTCPServer.allow_reuse_address = True
+    ThreadedTCPServer.allow_reuse_port = True
+    server = ThreadedTCPServer((host, port), ThreadedTCPRequestHandler)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("worker %s (pid %s) listening on %s:%s", index, os.getpid(), host, port)
+    try:
+        server.serve_forever()
+    finally:
+        if admin is not None:
+            admin.close()
+        if capture is not None:
+            capture.close()
+        history.close(timeout=5)
+
+
 if __name__ == "__main__":
     # Port 0 means to select an arbitrary unused port
     HOST, PORT = "0.0.0.0", 1337
     BUFSIZ = 1024
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    arguments = parser.parse_args()
+    setup_logging(LOG_LEVEL, trace=PROTOCOL_TRACE)
+    if arguments.workers > 1:
+        # Open the user database once up front, so the workers don't all try
+        # to create the schema at the same time.
+        open_user_store().close()
+        fork_workers(
+            arguments.workers,
+            CLUSTER_BUS,
+            Spool(SPOOL_DIRECTORY, **SPOOL_OPTIONS),
+            lambda index: run_cluster_worker(index, HOST, PORT),
+        )
+        raise SystemExit
+    user_store = open_user_store()
+    spool = Spool(SPOOL_DIRECTORY, **SPOOL_OPTIONS)
+    history = HistoryStore(HISTORY_DIRECTORY, **HISTORY_OPTIONS)
+    if CAPTURE_FILE is not None:
+        capture = CaptureWriter(CAPTURE_FILE)
+    timer_wheel.start()
+    if METRICS_PORT is not None:
+        serve_metrics(metrics, METRICS_PORT, online=lambda: len(requests))
+    admin = None
+    if ADMIN_SOCKET is not None:
+        admin = AdminServer(ADMIN_SOCKET, ADMIN_COMMANDS)
+        admin.start()
     ThreadedTCPServer.allow_reuse_address = True
     server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
     ip, port = server.server_address
@@ -474,38 +1201,99 @@ if __name__ == "__main__":
         while True:
             comand = input("#")
             if comand == "ls":
-                print(requests)
+                print([session.user_id for session in sessions()])
             elif comand == "rr":
-                print(len(requests))
-                if len(requests) > 0:
-                    print(random.choice(list(requests)))
+                user_ids = [session.user_id for session in sessions()]
+                print(len(user_ids))
+                if len(user_ids) > 0:
+                    print(random.choice(user_ids))
             elif comand.startswith("mb "):
                 make_bytes_beautifull(bytes.fromhex(comand.split(" ")[1]))
             elif comand.startswith("send "):
                 comand, recipient, data = comand.split(" ")
-                requests[int(recipient)].request.sendall(bytes.fromhex(data))
+                deliver(int(recipient), bytes.fromhex(data))
             elif comand.startswith("quit"):
-                tmp = []
-                for foo in requests:
-                    tmp.append(foo)
-                for foo in tmp:
-                    print(f"{foo} is still connected ")
-                    requests[foo].request.shutdown(SHUT_RDWR)
-                    requests[foo].request.close()
+                for session in sessions():
+                    print(f"{session.user_id} is still connected ")
+                    session.disconnect()
                 server.shutdown()
                 server.server_close()
+                if admin is not None:
+                    admin.close()
+                if capture is not None:
+                    capture.close()
+                history.close(timeout=5)
                 break
+            elif comand.startswith("broadcast "):
+                # broadcast <sender user id> <PRAY file>, to everyone online
+                comand, sender_id, path = comand.split(" ", 2)
+                with open(path, "rb") as f:
+                    message = pray_package(int(sender_id), f.read())
+                recipients = online_users()
+                fan_out(recipients, message)
+                print(f"sent {len(message)} bytes to {len(recipients)} users")
             elif comand.startswith("pray "):
                 comand, data = comand.split(" ")
                 poke_pray(bytes.fromhex(data), sent_by_server=True)
+            elif comand.startswith("profile"):
+                # profile start [interval ms] | stop | reset | [own|total] [count]
+                arguments = comand.split()[1:]
+                if arguments[:1] == ["start"]:
+                    interval = float(arguments[1]) / 1000 if arguments[1:] else None
+                    profiler.start(interval)
+                elif arguments[:1] == ["stop"]:
+                    profiler.stop()
+                elif arguments[:1] == ["reset"]:
+                    profiler.reset()
+                else:
+                    by = "own"
+                    if arguments[:1] in (["own"], ["total"]):
+                        by = arguments.pop(0)
+                    count = int(arguments[0]) if arguments else 20
+                    print(profiler.report(count, by))
+                print(f"profiler {'running' if profiler.running else 'stopped'}")
+            elif comand.startswith("latency"):
+                # latency [message type, e.g. 0x13]
+                arguments = comand.split()[1:]
+                print_latency(int(arguments[0], 0) if arguments else None)
+            elif comand.startswith("mem"):
+                # mem [count] | mem trace start | mem trace stop
+                arguments = comand.split()[1:]
+                if arguments[:2] == ["trace", "start"]:
+                    tracemalloc.start()
+                elif arguments[:2] == ["trace", "stop"]:
+                    tracemalloc.stop()
+                else:
+                    print_memory(int(arguments[0]) if arguments else 10)
+            elif comand.startswith("conns"):
+                # conns [seconds]
+                arguments = comand.split()[1:]
+                print_connections(float(arguments[0]) if arguments else 1.0)
+            elif comand.startswith("hist "):
+                # hist <creature moniker or user id>
+                key = comand.split()[1]
+                if key.isdigit():
+                    print(history.creatures(int(key)))
+                    records = history.user(int(key), 20)
+                else:
+                    records = history.creature(key, 20)
+                for stored_at, user_id, data in records:
+                    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stored_at))
+                    print(f"{when} from {user_id}: {len(data)} bytes")
+            elif comand == "recompress":
+                if recompressor is None:
+                    print("recompression is off")
+                else:
+                    print(recompressor.snapshot())
 
     except KeyboardInterrupt as exception:
-        tmp = []
-        for foo in requests:
-            tmp.append(foo)
-        for foo in tmp:
-            print(f"{foo} is still connected ")
-            requests[foo].request.shutdown(SHUT_RDWR)
-            requests[foo].request.close()
+        for session in sessions():
+            print(f"{session.user_id} is still connected ")
+            session.disconnect()
         server.shutdown()
         server.server_close()
+        if admin is not None:
+            admin.close()
+        if capture is not None:
+            capture.close()
+        history.close(timeout=5)
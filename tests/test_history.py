@@ -0,0 +1,51 @@
+import shutil
+import tempfile
+import unittest
+
+from rebabel.history import HistoryStore, monikers
+
+MONIKER = b"001-norn-abcde-fghij-klmno-pqrst"
+OTHER = b"002-ettn-aaaaa-bbbbb-ccccc-ddddd"
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def store(self):
+        store = HistoryStore(self.directory, fsync=False)
+        self.addCleanup(store.close)
+        return store
+
+    def test_monikers(self):
+        data = bytes(4) + MONIKER + bytes(4) + OTHER + MONIKER
+        self.assertEqual(monikers(data), [MONIKER.decode(), OTHER.decode()])
+
+    def test_queries(self):
+        store = self.store()
+        store.append(1, b"a" + MONIKER)
+        store.append(2, b"b" + MONIKER)
+        store.append(1, b"c" + OTHER)
+        self.assertTrue(store.flush(5))
+        creature = store.creature(MONIKER.decode())
+        self.assertEqual(
+            [(u, m) for _, u, m in creature],
+            [(1, b"a" + MONIKER), (2, b"b" + MONIKER)],
+        )
+        self.assertEqual([m for _, _, m in store.user(1, limit=1)], [b"c" + OTHER])
+        self.assertEqual(store.creatures(1), [MONIKER.decode(), OTHER.decode()])
+
+    def test_index_rebuilt_on_start(self):
+        store = self.store()
+        for i in range(10):
+            store.append(i % 2, b"%d" % i + MONIKER)
+        store.close()
+        store = self.store()
+        self.assertEqual(store.records, 10)
+        self.assertEqual(len(store.user(0)), 5)
+        self.assertEqual(len(store.creature(MONIKER.decode())), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
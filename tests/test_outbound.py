@@ -0,0 +1,149 @@
+import socket
+import unittest
+
+from rebabel.memory import MemoryBudget
+from rebabel.outbound import OutboundQueue
+
+
+def frame(kind, length):
+    """A message whose first four bytes give its total length."""
+    return length.to_bytes(4, "little") + bytes([kind]) * (length - 4)
+
+
+def frame_length(data):
+    if len(data) < 4:
+        return None
+    return int.from_bytes(bytes(data[:4]), "little")
+
+
+class OutboundQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.peer.settimeout(5)
+        self.addCleanup(self.sock.close)
+        self.addCleanup(self.peer.close)
+
+    def queue(self, **options):
+        options.setdefault("frame_length", frame_length)
+        queue = OutboundQueue(self.sock, name="test", **options)
+        self.addCleanup(queue.close)
+        return queue
+
+    def read(self, count):
+        data = bytearray()
+        while len(data) < count:
+            chunk = self.peer.recv(count - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    def read_frames(self, count):
+        frames = []
+        for _ in range(count):
+            header = self.read(4)
+            frames.append(header + self.read(frame_length(header) - 4))
+        return frames
+
+    def test_in_order(self):
+        queue = self.queue()
+        messages = [frame(i, 8 + i) for i in range(10)]
+        for message in messages:
+            self.assertTrue(queue.put(message))
+        self.assertEqual(self.read_frames(10), messages)
+
+    def test_control_never_cuts_into_bulk_frames(self):
+        queue = self.queue(bulk_threshold=64, chunk_size=16)
+        messages = [frame(1, 100), frame(2, 100), frame(3, 8)]
+        # Two frames in one bulk entry, written 16 bytes at a time.
+        queue.put(messages[0] + messages[1])
+        queue.put(messages[2])
+        self.assertEqual(sorted(self.read_frames(3)), sorted(messages))
+
+    def test_stream(self):
+        queue = self.queue()
+        stream = queue.stream(64)
+        message = frame(1, 64)
+        self.assertTrue(stream.write(message[:30]))
+        self.assertTrue(stream.write(message[30:]))
+        self.assertEqual(self.read_frames(1), [message])
+        self.assertEqual(stream.sent, 64)
+
+    def test_stream_longer_than_declared(self):
+        stream = self.queue().stream(8)
+        with self.assertRaises(ValueError):
+            stream.write(bytes(9))
+
+    def test_abort_before_start(self):
+        queue = self.queue()
+        stream = queue.stream(64)
+        stream.abort()
+        self.assertFalse(stream.write(bytes(8)))
+        queue.put(frame(2, 8))
+        self.assertEqual(self.read_frames(1), [frame(2, 8)])
+        self.assertFalse(queue.closed)
+
+    def test_abort_after_start_pads(self):
+        queue = self.queue(chunk_size=16)
+        stream = queue.stream(100)
+        start = frame(1, 100)[:40]
+        stream.write(start)
+        self.assertEqual(self.read(40), start)
+        stream.abort()
+        queue.put(frame(2, 8))
+        # The rest of the declared length comes as zeros, then the next frame.
+        self.assertEqual(self.read(60), bytes(60))
+        self.assertEqual(self.read_frames(1), [frame(2, 8)])
+        self.assertFalse(queue.closed)
+        self.assertEqual(queue.queued_bytes, 0)
+
+    def test_abort_twice_and_after_completion(self):
+        queue = self.queue()
+        stream = queue.stream(8)
+        stream.abort()
+        stream.abort()
+        done = queue.stream(8)
+        done.write(frame(1, 8))
+        done.abort()
+        self.assertEqual(self.read_frames(1), [frame(1, 8)])
+
+    def test_drop_policy(self):
+        queue = self.queue(high_watermark=16, low_watermark=0, policy="drop")
+        # Nothing reads the peer, the socket buffer fills and the queue backs up.
+        queue.put(bytes(8 * 1024 * 1024))
+        self.assertFalse(queue.put(frame(1, 8)))
+        self.assertGreater(queue.dropped, 0)
+        self.assertFalse(queue.closed)
+
+    def test_disconnect_policy(self):
+        queue = self.queue(high_watermark=16, low_watermark=0)
+        queue.put(bytes(8 * 1024 * 1024))
+        self.assertFalse(queue.put(frame(1, 8)))
+        self.assertTrue(queue.closed)
+
+    def test_per_message_policy(self):
+        queue = self.queue(high_watermark=16, low_watermark=0)
+        queue.put(bytes(8 * 1024 * 1024))
+        self.assertFalse(queue.put(frame(1, 8), policy="drop"))
+        self.assertFalse(queue.closed)
+        self.assertFalse(queue.put(frame(1, 8)))
+        self.assertTrue(queue.closed)
+
+    def test_memory_budget(self):
+        budget = MemoryBudget(limit=10)
+        queue = self.queue(memory=budget)
+        self.assertFalse(queue.put(frame(1, 16)))
+        self.assertTrue(queue.put(frame(1, 16), block=True))
+        self.assertEqual(self.read_frames(1), [frame(1, 16)])
+        queue.close(flush=True)
+        self.assertEqual(budget.total, 0)
+
+    def test_put_after_close(self):
+        queue = self.queue()
+        queue.close()
+        self.assertFalse(queue.put(frame(1, 8)))
+        self.assertIsNone(queue.stream(8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import threading
+import time
+import unittest
+
+from rebabel.ratelimit import RateLimiter, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_try_take(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        self.assertEqual(bucket.try_take(2), 0.0)
+        self.assertGreater(bucket.try_take(2), 0.0)
+        self.assertEqual(bucket.try_take(1), 0.0)
+
+    def test_cost_above_burst(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        self.assertEqual(bucket.try_take(100), 0.0)
+        self.assertGreater(bucket.delay(1), 0.0)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_unlimited_class(self):
+        self.assertIsNone(RateLimiter({}).acquire(1, "query"))
+
+    def test_unknown_action(self):
+        with self.assertRaises(ValueError):
+            RateLimiter({"query": {"user": (1, 1), "action": "ignore"}})
+
+    def test_actions(self):
+        limiter = RateLimiter(
+            {
+                "drop": {"user": (0.001, 1), "action": "drop"},
+                "disconnect": {"user": (0.001, 1), "action": "disconnect"},
+            }
+        )
+        self.assertIsNone(limiter.acquire(1, "drop"))
+        self.assertEqual(limiter.acquire(1, "drop"), "drop")
+        self.assertIsNone(limiter.acquire(1, "disconnect"))
+        self.assertEqual(limiter.acquire(1, "disconnect"), "disconnect")
+        self.assertEqual(limiter.limited["drop"], 1)
+
+    def test_users_have_their_own_buckets(self):
+        limiter = RateLimiter({"query": {"user": (0.001, 1), "action": "drop"}})
+        self.assertIsNone(limiter.acquire(1, "query"))
+        self.assertIsNone(limiter.acquire(2, "query"))
+        self.assertEqual(limiter.acquire(1, "query"), "drop")
+
+    def test_global_bucket(self):
+        limiter = RateLimiter(
+            {"query": {"user": (0.001, 5), "global": (0.001, 2), "action": "drop"}}
+        )
+        self.assertIsNone(limiter.acquire(1, "query"))
+        self.assertIsNone(limiter.acquire(2, "query"))
+        self.assertEqual(limiter.acquire(3, "query"), "drop")
+        # A refused message takes nothing from the user's bucket either.
+        self.assertEqual(limiter.user_buckets[3]["query"].delay(5), 0.0)
+
+    def test_queue_waits(self):
+        limiter = RateLimiter(
+            {"query": {"user": (100, 1), "action": "queue", "max_delay": 1.0}}
+        )
+        limiter.acquire(1, "query")
+        started = time.monotonic()
+        self.assertIsNone(limiter.acquire(1, "query"))
+        self.assertGreater(time.monotonic() - started, 0.005)
+
+    def test_queue_gives_up_after_max_delay(self):
+        limiter = RateLimiter(
+            {"query": {"user": (0.001, 1), "action": "queue", "max_delay": 0.01}}
+        )
+        limiter.acquire(1, "query")
+        self.assertEqual(limiter.acquire(1, "query"), "drop")
+
+    def acquire_concurrently(self, limits, users):
+        limiter = RateLimiter(limits)
+        granted = []
+        barrier = threading.Barrier(len(users))
+
+        def run(user_id):
+            barrier.wait()
+            count = 0
+            for _ in range(200):
+                if limiter.acquire(user_id, "query") is None:
+                    count += 1
+            granted.append(count)
+
+        threads = [threading.Thread(target=run, args=(u,)) for u in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(granted)
+
+    def test_concurrent_acquire_global(self):
+        limits = {"query": {"global": (0.001, 100), "action": "drop"}}
+        self.assertEqual(self.acquire_concurrently(limits, range(8)), 100)
+
+    def test_concurrent_acquire_user_and_global(self):
+        limits = {
+            "query": {"user": (0.001, 1000), "global": (0.001, 100), "action": "drop"}
+        }
+        self.assertEqual(self.acquire_concurrently(limits, range(8)), 100)
+
+    def test_concurrent_acquire_one_user(self):
+        limits = {
+            "query": {"user": (0.001, 50), "global": (0.001, 1000), "action": "drop"}
+        }
+        self.assertEqual(self.acquire_concurrently(limits, [1] * 8), 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
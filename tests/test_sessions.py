@@ -0,0 +1,57 @@
+import time
+import unittest
+
+from rebabel.sessions import SessionTokens
+
+
+class SessionTokensTest(unittest.TestCase):
+    def test_resume_after_release(self):
+        tokens = SessionTokens(ttl=60)
+        token = tokens.issue(1)
+        tokens.release(token, 1)
+        self.assertTrue(tokens.resume(token, 1))
+        self.assertFalse(tokens.resume(token, 2))
+
+    def test_expired_token_is_not_resumed(self):
+        tokens = SessionTokens(ttl=0.01)
+        token = tokens.issue(1)
+        time.sleep(0.02)
+        self.assertFalse(tokens.resume(token, 1))
+
+    def test_revoke_then_release(self):
+        tokens = SessionTokens(ttl=60)
+        token = tokens.issue(1)
+        tokens.revoke_user(1)
+        # The session that was going when the password changed ends.
+        tokens.release(token, 1)
+        self.assertFalse(tokens.resume(token, 1))
+        self.assertEqual(len(tokens), 0)
+
+    def test_revoke_during_resumed_session(self):
+        tokens = SessionTokens(ttl=60)
+        token = tokens.issue(1)
+        tokens.release(token, 1)
+        self.assertTrue(tokens.resume(token, 1))
+        tokens.revoke_user(1)
+        tokens.release(token, 1)
+        self.assertFalse(tokens.resume(token, 1))
+
+    def test_revoke_leaves_other_users(self):
+        tokens = SessionTokens(ttl=60)
+        token = tokens.issue(1)
+        other = tokens.issue(2)
+        tokens.revoke_user(1)
+        tokens.release(token, 1)
+        tokens.release(other, 2)
+        self.assertTrue(tokens.resume(other, 2))
+
+    def test_new_token_after_revoke(self):
+        tokens = SessionTokens(ttl=60)
+        tokens.revoke_user(1)
+        token = tokens.issue(1)
+        tokens.release(token, 1)
+        self.assertTrue(tokens.resume(token, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
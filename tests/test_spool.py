@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from rebabel.spool import RECORD, Spool
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def spool(self, **options):
+        options.setdefault("fsync", False)
+        return Spool(self.directory, **options)
+
+    def age(self, spool, user_id, position, seconds):
+        offset, length, stored_at = spool.index[user_id][position]
+        spool.index[user_id][position] = (offset, length, stored_at - seconds)
+
+    def test_deliver_in_batches(self):
+        spool = self.spool(batch_size=16)
+        messages = [b"message %d" % i for i in range(5)]
+        for message in messages:
+            self.assertTrue(spool.append(1, message))
+        batches = []
+        self.assertEqual(spool.deliver(1, lambda b: batches.append(b) or True), 5)
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(b"".join(batches), b"".join(messages))
+        self.assertEqual(spool.pending(1), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "1.spool")))
+
+    def test_refused_batches_stay_spooled(self):
+        spool = self.spool(batch_size=1)
+        for i in range(4):
+            spool.append(1, b"%d" % i)
+        sent = []
+
+        def send(batch):
+            if len(sent) == 2:
+                return False
+            sent.append(batch)
+            return True
+
+        self.assertEqual(spool.deliver(1, send), 2)
+        self.assertEqual(spool.pending(1), 2)
+        # Also after a restart.
+        spool = self.spool(batch_size=1)
+        rest = []
+        spool.deliver(1, lambda b: rest.append(b) or True)
+        self.assertEqual(sent + rest, [b"0", b"1", b"2", b"3"])
+
+    def test_append_while_delivering(self):
+        spool = self.spool(batch_size=1)
+        spool.append(1, b"first")
+        sent = []
+
+        def send(batch):
+            spool.append(1, b"late")
+            sent.append(batch)
+            return True
+
+        spool.deliver(1, send)
+        self.assertEqual(sent, [b"first"])
+        later = []
+        spool.deliver(1, lambda b: later.append(b) or True)
+        self.assertEqual(later, [b"late"])
+
+    def test_full_spool_refuses(self):
+        spool = self.spool(max_bytes_per_user=2 * (RECORD.size + 4))
+        self.assertTrue(spool.append(1, b"1234"))
+        self.assertTrue(spool.append(1, b"1234"))
+        self.assertFalse(spool.append(1, b"1234"))
+        self.assertTrue(spool.append(2, b"1234"))
+
+    def test_append_expires_old_messages(self):
+        spool = self.spool(max_bytes_per_user=2 * (RECORD.size + 4), max_age=60)
+        spool.append(1, b"old!")
+        spool.append(1, b"new!")
+        self.age(spool, 1, 0, 120)
+        self.assertTrue(spool.append(1, b"next"))
+        delivered = []
+        spool.deliver(1, lambda b: delivered.append(b) or True)
+        self.assertEqual(delivered, [b"new!next"])
+
+    def test_expire(self):
+        spool = self.spool(max_age=60)
+        spool.append(1, b"old")
+        spool.append(2, b"old")
+        spool.append(2, b"new")
+        self.age(spool, 1, 0, 120)
+        self.age(spool, 2, 0, 120)
+        spool.expire()
+        self.assertEqual(spool.pending(1), 0)
+        self.assertEqual(spool.pending(2), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "1.spool")))
+
+    def test_deliver_skips_expired(self):
+        spool = self.spool(max_age=60)
+        spool.append(1, b"old")
+        spool.append(1, b"new")
+        self.age(spool, 1, 0, 120)
+        delivered = []
+        self.assertEqual(spool.deliver(1, lambda b: delivered.append(b) or True), 1)
+        self.assertEqual(delivered, [b"new"])
+        self.assertEqual(spool.pending(1), 0)
+
+    def test_parts(self):
+        spool = self.spool()
+        spool.append(1, iter([b"ab", b"cd"]), length=4)
+        delivered = []
+        spool.deliver(1, lambda b: delivered.append(b) or True)
+        self.assertEqual(delivered, [b"abcd"])
+
+    def test_concurrent_appends(self):
+        spool = self.spool()
+
+        def append(user_id):
+            for i in range(50):
+                spool.append(user_id, b"%d" % i)
+
+        threads = [threading.Thread(target=append, args=(u % 3,)) for u in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(spool.pending(u) for u in range(3)), 300)
+        # The index matches the files.
+        spool = self.spool()
+        self.assertEqual(sum(spool.pending(u) for u in range(3)), 300)
+
+
+if __name__ == "__main__":
+    unittest.main()
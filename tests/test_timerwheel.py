@@ -0,0 +1,50 @@
+import unittest
+
+from rebabel.timerwheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def test_fires_after_its_ticks(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        fired = []
+        wheel.schedule(3, lambda: fired.append("a"))
+        wheel.schedule(2.5, lambda: fired.append("b"))
+        for _ in range(2):
+            wheel.advance()
+        self.assertEqual(fired, [])
+        wheel.advance()
+        self.assertEqual(sorted(fired), ["a", "b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_more_than_one_round(self):
+        wheel = TimerWheel(tick=1.0, slots=4)
+        fired = []
+        wheel.schedule(10, lambda: fired.append(True))
+        for _ in range(9):
+            wheel.advance()
+        self.assertEqual(fired, [])
+        wheel.advance()
+        self.assertEqual(fired, [True])
+
+    def test_cancel(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        fired = []
+        timer = wheel.schedule(1, lambda: fired.append(True))
+        wheel.cancel(timer)
+        wheel.cancel(timer)
+        wheel.advance()
+        self.assertEqual(fired, [])
+        self.assertEqual(len(wheel), 0)
+
+    def test_failing_callback(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        fired = []
+        wheel.schedule(1, lambda: 1 / 0)
+        wheel.schedule(1, lambda: fired.append(True))
+        with self.assertLogs("rebabel.timerwheel", "ERROR"):
+            wheel.advance()
+        self.assertEqual(fired, [True])
+
+
+if __name__ == "__main__":
+    unittest.main()
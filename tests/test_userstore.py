@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rebabel.userstore import CachedUserStore, SQLiteUserStore, UserStore
+
+
+class UserStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = SQLiteUserStore(os.path.join(directory, "users.db"))
+        self.addCleanup(self.store.close)
+        self.store.add_user("alice", "secret", user_id=7)
+
+    def test_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            UserStore()
+
+    def test_verify(self):
+        self.assertEqual(self.store.verify("alice", "secret"), 7)
+        self.assertIsNone(self.store.verify("alice", "wrong"))
+        self.assertIsNone(self.store.verify("bob", "secret"))
+
+    def test_lookups(self):
+        self.assertEqual(self.store.get_user_id("alice"), 7)
+        self.assertEqual(self.store.get_username(7), "alice")
+        self.assertIsNone(self.store.get_username(8))
+
+    def test_cached_verify(self):
+        cached = CachedUserStore(self.store, hash_workers=1)
+        self.assertEqual(cached.verify("alice", "secret"), 7)
+        self.assertIsNone(cached.verify("alice", "wrong"))
+
+    def test_cache_sees_password_change(self):
+        cached = CachedUserStore(self.store, hash_workers=1)
+        changed = []
+        cached.add_listener(changed.append)
+        self.assertEqual(cached.verify("alice", "secret"), 7)
+        cached.set_password("alice", "new")
+        self.assertEqual(changed, [7])
+        self.assertIsNone(cached.verify("alice", "secret"))
+        self.assertEqual(cached.verify("alice", "new"), 7)
+
+    def test_cache_sees_new_user(self):
+        cached = CachedUserStore(self.store, hash_workers=1)
+        self.assertIsNone(cached.get_user_id("bob"))
+        cached.add_user("bob", "pw", user_id=9)
+        self.assertEqual(cached.get_user_id("bob"), 9)
+        self.assertEqual(cached.get_username(9), "bob")
+
+
+if __name__ == "__main__":
+    unittest.main()